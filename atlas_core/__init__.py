@@ -1,9 +1,11 @@
 from flask import Flask, cli
 
-from werkzeug.contrib.profiler import ProfilerMiddleware
-
 from .core import db
+from .data_versions import DataVersionRegistry, DataVersionRouter
 from .helpers.flask import APIError, handle_api_error
+from .metrics import Metrics, register_metrics_endpoint
+from .pool import DEFAULT_WARMUP_CONNECTIONS, PoolWarmup, engine_options, watch_pool
+from .profiling import SamplingProfiler
 from .serializers import JsonifySerializer
 
 
@@ -18,6 +20,8 @@ def load_config(app, overrides={}):
 def add_profiler(app):
     """Add a profiler that runs on every request when PROFILE set to True."""
     if app.config.get("PROFILE", False):
+        from werkzeug.contrib.profiler import ProfilerMiddleware
+
         app.wsgi_app = ProfilerMiddleware(
             app.wsgi_app,
             restrictions=[30],
@@ -57,18 +61,68 @@ def create_app(
     # Load config from FLASK_CONFIG env variable.
     app = load_config(app, overrides=additional_config)
 
+    # Pool settings from DB_POOL_SIZE etc
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+    engine_hooks = [watch_pool] if app.config.get("DB_POOL_STATS", False) else []
+    warmup_connections = app.config.get(
+        "DB_WARMUP_CONNECTIONS", DEFAULT_WARMUP_CONNECTIONS
+    )
+
     # Load extensions
     db.init_app(app)
 
+    # Serve the data version named in the registry file, and switch over when
+    # it changes without having to restart
+    if app.config.get("DATA_VERSION_REGISTRY", None):
+        router = DataVersionRouter(
+            app.config["SQLALCHEMY_DATABASE_URI"],
+            registry=DataVersionRegistry(app.config["DATA_VERSION_REGISTRY"]),
+            engine_kwargs=app.config["SQLALCHEMY_ENGINE_OPTIONS"],
+            warmup_connections=warmup_connections,
+            engine_hooks=engine_hooks,
+            poll_interval=app.config.get("DATA_VERSION_POLL_INTERVAL", 5),
+        )
+        router.init_app(app)
+    elif warmup_connections or engine_hooks:
+        # Open DB_WARMUP_CONNECTIONS connections in the pool before the first
+        # request of each worker process
+        PoolWarmup(warmup_connections, engine_hooks).init_app(app)
+
     # Debug tools
     if app.debug:
         app = add_profiler(app)
 
+    # Sampled profiling that's cheap enough for production
+    if app.config.get("PROFILE_SAMPLE_RATE", None) or app.config.get(
+        "PROFILE_SLOW_THRESHOLD", None
+    ):
+        profiler = SamplingProfiler(
+            sample_rate=app.config.get("PROFILE_SAMPLE_RATE", None) or 0,
+            slow_threshold=app.config.get("PROFILE_SLOW_THRESHOLD", None),
+            interval=app.config.get("PROFILE_SAMPLE_INTERVAL", 0.005),
+            profile_dir=app.config.get("PROFILE_DIR", None),
+            dump_interval=app.config.get("PROFILE_DUMP_INTERVAL", 60),
+        )
+        profiler.init_app(app)
+
+    # Request, cache and DB metrics for prometheus
+    metrics = None
+    if app.config.get("METRICS", False):
+        metrics = Metrics(
+            directory=app.config.get("METRICS_DIR", None),
+            flush_interval=app.config.get("METRICS_FLUSH_INTERVAL", 5),
+        )
+        metrics.init_app(app)
+        register_metrics_endpoint(app, app.config.get("METRICS_URL", "/metrics"))
+
     if standalone:
         create_db(app, db)
 
     if app.config.get("CATCH_API_EXCEPTIONS", True):
-        app.errorhandler(APIError)(handle_api_error)
+        error_handler = handle_api_error
+        if metrics is not None:
+            error_handler = metrics.count_api_errors(handle_api_error)
+        app.errorhandler(APIError)(error_handler)
 
     # For flask's jsonify
     if custom_json_encoder:
@@ -1,6 +1,20 @@
 """Contains common flask extensions."""
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
+
+
+class SQLAlchemy(_SQLAlchemy):
+    """Flask-SQLAlchemy, except if the app has a
+    :py:class:`~atlas_core.data_versions.DataVersionRouter`, the default
+    engine is the one for the data version currently being served."""
+
+    def get_engine(self, app=None, bind=None):
+        app = self.get_app(app)
+        router = app.extensions.get("data_version_router")
+        if bind is None and router is not None and router.engine is not None:
+            return router.engine
+        return super().get_engine(app, bind)
+
 
 #: Flask-SQLAlchemy db object
 db = SQLAlchemy()
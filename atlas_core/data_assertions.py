@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 
+from collections import namedtuple
 from functools import reduce
 from operator import mul
 
@@ -16,6 +17,10 @@ def assert_none_missing(series):
 
 def assert_is_zeropadded_string(series):
 
+    # For categoricals, it's enough to check the categories
+    if pd.api.types.is_categorical_dtype(series):
+        series = pd.Series(series.cat.categories)
+
     # Must be a string
     assert series.dtype in [np.object, np.str]
 
@@ -23,6 +28,17 @@ def assert_is_zeropadded_string(series):
     assert series.str.len().nunique() == 1
 
 
+MatchingStats = namedtuple(
+    "MatchingStats",
+    [
+        "percent_rows_not_in_classification",
+        "percent_unique_not_in_classification",
+        "codes_missing",
+        "codes_unused",
+    ],
+)
+
+
 def matching_stats(series, classification_level):
 
     num_rows = series.shape[0]
@@ -45,7 +61,7 @@ def matching_stats(series, classification_level):
     codes_missing = unique[unique_not_in_classification]
     codes_unused = classification_unique[~classification_unique.isin(series)]
 
-    return (
+    return MatchingStats(
         percent_rows_not_in_classification,
         percent_unique_not_in_classification,
         codes_missing,
@@ -59,25 +75,450 @@ def assert_matches_classification_level(series, classification_level):
 
 def fillin(df, entities):
     """STATA style "fillin", make sure all permutations of entities in the
-    index are in the dataset."""
+    index are in the dataset. This builds the whole cartesian product at
+    once, see :py:func:`~iter_fillin` and
+    :py:func:`~iter_missing_combinations` for big ones."""
     df = df.set_index(entities)
     return df.reindex(pd.MultiIndex.from_product(df.index.levels, names=df.index.names))
 
 
+def chunk_entity_first(entities, chunk_entity=None):
+    entities = list(entities)
+    if chunk_entity is None:
+        return entities
+    if chunk_entity not in entities:
+        raise ValueError("{} is not one of {}".format(chunk_entity, entities))
+    return [chunk_entity] + [x for x in entities if x != chunk_entity]
+
+
+def iter_fillin(df, entities, chunk_entity=None):
+    """Same as :py:func:`~fillin`, but yields the filled in dataframe one
+    value of `chunk_entity` (by default the first entity) at a time, so only
+    one slice of the cartesian product is in memory at once. With the default
+    chunk entity, concatenating the chunks gives exactly fillin()'s output."""
+    entities = chunk_entity_first(entities, chunk_entity)
+    df = df.set_index(entities)
+    levels = list(df.index.levels)
+
+    # Sort once by the chunk entity, then each chunk is a contiguous slice
+    chunk_codes = df.index.codes[0]
+    order = np.argsort(chunk_codes, kind="stable")
+    boundaries = np.searchsorted(
+        chunk_codes[order], np.arange(len(levels[0]) + 1), side="left"
+    )
+
+    for i, value in enumerate(levels[0]):
+        chunk = df.iloc[order[boundaries[i] : boundaries[i + 1]]]
+        chunk_index = pd.MultiIndex.from_product(
+            [levels[0][i : i + 1]] + levels[1:], names=entities
+        )
+        yield chunk.reindex(chunk_index)
+
+
+def iter_missing_combinations(df, entities, chunk_entity=None):
+    """Yield dataframes of the entity combinations that aren't in the
+    dataset, one value of `chunk_entity` (by default the first entity) at a
+    time, without building the cartesian product: present combinations are
+    encoded into one integer each, and the missing ones are found per
+    chunk as the gaps in those."""
+    entities = chunk_entity_first(entities, chunk_entity)
+
+    codes_list, uniques_list = [], []
+    for entity in entities:
+        codes, uniques = pd.factorize(df[entity], sort=True)
+        codes_list.append(codes)
+        uniques_list.append(uniques)
+
+    # Rows with missing entities don't count as a combination
+    present_rows = np.logical_and.reduce([codes != -1 for codes in codes_list])
+    shape = tuple(len(uniques) for uniques in uniques_list)
+    if reduce(mul, shape, 1) >= 2 ** 63:
+        raise ValueError("Too many combinations of {} to encode.".format(entities))
+
+    present = np.unique(
+        np.ravel_multi_index(
+            [codes[present_rows] for codes in codes_list], shape
+        ).astype(np.int64)
+    )
+
+    chunk_size = reduce(mul, shape[1:], 1)
+    for i in range(shape[0]):
+        start, stop = i * chunk_size, (i + 1) * chunk_size
+        present_chunk = present[
+            np.searchsorted(present, start) : np.searchsorted(present, stop)
+        ]
+        missing = np.setdiff1d(
+            np.arange(start, stop, dtype=np.int64), present_chunk, assume_unique=True
+        )
+        if len(missing) == 0:
+            continue
+
+        missing_codes = np.unravel_index(missing, shape)
+        yield pd.DataFrame(
+            {
+                entity: uniques.take(codes)
+                for entity, uniques, codes in zip(entities, uniques_list, missing_codes)
+            }
+        )
+
+
+def missing_combinations(df, entities, chunk_entity=None):
+    """All entity combinations that aren't in the dataset, i.e. the rows
+    that fillin() would add."""
+    chunks = list(iter_missing_combinations(df, entities, chunk_entity))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=chunk_entity_first(entities, chunk_entity))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def is_rectangularized(unique_counts, num_rows):
+    """In a rectangularized matrix, the number of unique entities multiplied
+    should give you the number of rows. Works off of counts alone, so it
+    doesn't need to build anything."""
+    return reduce(mul, unique_counts, 1) == num_rows
+
+
 def assert_rectangularized(df, entities):
     """Check if all possibilities of all entities have been used"""
-    unique_entities = [df[entity].size for entity in entities]
-    uniques_multiplied = reduce(mul, unique_entities)
-
-    # In a rectangularized matrix, the number of unique entities multiplied
-    # should give you the number of rows
-    assert uniques_multiplied == df.shape[0]
+    unique_entities = [df[entity].nunique() for entity in entities]
+    assert is_rectangularized(unique_entities, df.shape[0])
 
 
 def assert_entities_not_duplicated(df, entities):
     assert df.duplicated(subset=entities).any() == False
 
 
+def factorize_column(series):
+    """Integer codes (-1 for missing) and unique values of a column. For
+    categoricals, this reuses the existing codes instead of hashing again."""
+    if pd.api.types.is_categorical_dtype(series):
+        codes = series.cat.codes.values.astype(np.int64)
+        uniques = pd.Index(series.cat.categories)
+    else:
+        codes, uniques = pd.factorize(series, sort=False)
+        uniques = pd.Index(uniques)
+
+    # Drop unused categories so that counting uniques works the same for both
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    if (counts == 0).any():
+        used = np.flatnonzero(counts)
+        remap = np.full(len(uniques), -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        codes = np.where(codes == -1, -1, remap[codes])
+        uniques = uniques[used]
+        counts = counts[used]
+
+    return codes, uniques, counts
+
+
+def is_zeropadded(uniques):
+    return uniques.dtype == object and uniques.str.len().nunique() == 1
+
+
+def pad_uniques(codes, uniques, length):
+    """Zero-pad the unique values, merging any that become the same (e.g. 1
+    and "01"), and remap the codes to match."""
+    padded = pd.Series(uniques).astype(int).astype(str).str.zfill(length).values
+    padded_uniques, inverse = np.unique(padded, return_inverse=True)
+    codes = np.where(codes == -1, -1, inverse[codes])
+    counts = np.bincount(codes[codes >= 0], minlength=len(padded_uniques))
+    return codes, pd.Index(padded_uniques, dtype=object), counts
+
+
+def combined_codes(codes_list):
+    """Combine the codes of several columns into a single int64 code per row,
+    or None if there are too many combinations to fit."""
+    combined = np.zeros(len(codes_list[0]), dtype=np.int64)
+    size = 1
+    for codes in codes_list:
+        # Shift by one so that missing values get a code of their own
+        radix = int(codes.max()) + 2 if len(codes) else 1
+        size *= radix
+        if size >= 2 ** 63:
+            return None
+        combined = combined * radix + (codes + 1)
+    return combined
+
+
+def stratified_sample(df, fraction, strata=None, random_state=0):
+    """Reproducible sample of `fraction` of the rows of each stratum (e.g.
+    each year, rounded up), and at least one row of each. Row positions are
+    drawn straight from a seeded generator, which is much cheaper than the
+    checks we'd run on the rows we leave out."""
+    if not 0 < fraction <= 1:
+        raise ValueError(
+            "Sample fraction must be in (0, 1], you gave {}".format(fraction)
+        )
+
+    num_rows = df.shape[0]
+    if num_rows == 0:
+        return df
+
+    random = np.random.RandomState(random_state)
+
+    def sample_size(size):
+        return max(1, int(np.ceil(fraction * size)))
+
+    if not strata:
+        positions = random.choice(num_rows, sample_size(num_rows), replace=False)
+    else:
+        codes = df.groupby(strata, sort=False, dropna=False).ngroup().values
+        sizes = np.bincount(codes)
+        # Small ints get a radix sort
+        codes = codes.astype(np.min_scalar_type(len(sizes)))
+        by_stratum = np.argsort(codes, kind="stable")
+        starts = np.cumsum(sizes) - sizes
+        positions = by_stratum[
+            np.concatenate(
+                [
+                    start + random.choice(size, sample_size(size), replace=False)
+                    for start, size in zip(starts, sizes)
+                ]
+            )
+        ]
+
+    return df.iloc[np.sort(positions)]
+
+
+def proportion_bounds(count, sample_size, population_size=None, z=1.96):
+    """Wilson score interval (95% by default) of a percentage estimated from
+    `count` hits out of `sample_size` sampled rows, with a finite population
+    correction if the size of the population is given."""
+    if sample_size == 0:
+        return (0.0, 100.0)
+
+    p = count / sample_size
+    n = sample_size
+    if population_size is not None:
+        if sample_size >= population_size:
+            return (100.0 * p, 100.0 * p)
+        # Shrinks the interval as the sample approaches the whole population
+        n = n * (population_size - 1) / (population_size - sample_size)
+
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return (
+        100.0 * max(0.0, center - half_width),
+        100.0 * min(1.0, center + half_width),
+    )
+
+
+class ValidationReport(object):
+    """Results of :py:func:`~validate_dataset`. Nothing is raised on failure:
+    look at the individual results, :py:meth:`~ValidationReport.failures`, or
+    call :py:meth:`~ValidationReport.assert_passed` to raise on any of them.
+
+    - missing: number of missing values per facet field
+    - zeropadded: whether each digit padding field already is a zero-padded
+      string
+    - matching: :py:class:`~MatchingStats` per classification field, as
+      returned by :py:func:`~matching_stats`
+    - rectangularized: whether every combination of facet field values is
+      there
+    - duplicated: boolean mask of rows whose facet fields are duplicated,
+      including the first occurrence
+
+    If the checks ran on a sample, counts and percentages are of the sampled
+    rows (`sample_index`), and `bounds` has the 95% interval of the
+    percentage of rows in the whole dataset with missing values
+    ("missing", field) and not matching the classification
+    ("nonmatching", field)."""
+
+    def __init__(self, num_rows, sample_index=None):
+        self.num_rows = num_rows
+        self.sample_index = sample_index
+        self.missing = {}
+        self.zeropadded = {}
+        self.matching = {}
+        self.num_unique = {}
+        self.rectangularized = None
+        self.duplicated = None
+        self.bounds = {}
+
+    @property
+    def sampled(self):
+        return self.sample_index is not None
+
+    @property
+    def num_checked_rows(self):
+        return len(self.sample_index) if self.sampled else self.num_rows
+
+    def duplicated_rows(self, df):
+        if self.duplicated is None:
+            return df.iloc[:0]
+        if self.sampled:
+            return df.loc[self.sample_index[self.duplicated]]
+        return df[self.duplicated]
+
+    @property
+    def num_duplicated(self):
+        if self.duplicated is None:
+            return 0
+        return int(self.duplicated.sum())
+
+    def failures(self):
+        failures = []
+        for field, count in self.missing.items():
+            if count > 0:
+                failures.append(
+                    "Field '{}' has {} missing values{}.".format(
+                        field, count, self.sample_description()
+                    )
+                )
+        for field, padded in self.zeropadded.items():
+            if not padded:
+                failures.append("Field '{}' is not zero-padded.".format(field))
+        for field, stats in self.matching.items():
+            if stats.percent_rows_not_in_classification > 0:
+                failures.append(
+                    "{}% of rows of field '{}' don't match the "
+                    "classification{}.".format(
+                        stats.percent_rows_not_in_classification,
+                        field,
+                        self.sample_description(),
+                    )
+                )
+        if self.rectangularized is False:
+            failures.append("Dataset is not rectangularized.")
+        if self.num_duplicated > 0:
+            failures.append(
+                "Dataset has {} rows with duplicated entities{}.".format(
+                    self.num_duplicated, self.sample_description()
+                )
+            )
+        return failures
+
+    def sample_description(self):
+        if not self.sampled:
+            return ""
+        return " in a sample of {} rows".format(self.num_checked_rows)
+
+    @property
+    def passed(self):
+        return len(self.failures()) == 0
+
+    def assert_passed(self):
+        failures = self.failures()
+        assert len(failures) == 0, "\n".join(failures)
+
+    def __repr__(self):
+        return "<ValidationReport: {} rows, {}>".format(
+            self.num_rows,
+            "passed" if self.passed else "{} failures".format(len(self.failures())),
+        )
+
+
+def validate_dataset(
+    df,
+    entities,
+    digit_padding={},
+    classification_levels={},
+    check_entities=True,
+    sample_fraction=None,
+    strata=None,
+    random_state=0,
+):
+    """Run the checks above in a single pass: each column is factorized once
+    and all checks work off of its codes and unique values, instead of every
+    assertion scanning the column again.
+
+    `entities` are the facet fields, checked for missing values, and unless
+    `check_entities` is False, for rectangularization and duplicates.
+    `digit_padding` maps fields to the number of digits they should be
+    padded to, and `classification_levels` maps fields to the classification
+    level (with a code column) their values should match. If a field isn't
+    padded yet, rectangularization, duplicates and matching are checked on
+    the padded values, i.e. how the dataset will look once it's fixed.
+
+    For quick runs during development, pass `sample_fraction` to run the
+    checks on a reproducible :py:func:`~stratified_sample` by `strata`
+    instead of on every row. Percentages then come with error bounds, and
+    rectangularization isn't checked since a sample never is. Duplicates
+    found in the sample are real, but there may be more.
+
+    Returns a :py:class:`~ValidationReport`."""
+    if sample_fraction is not None:
+        num_rows = df.shape[0]
+        df = stratified_sample(df, sample_fraction, strata, random_state)
+        report = ValidationReport(num_rows, sample_index=df.index)
+    else:
+        report = ValidationReport(df.shape[0])
+    num_checked_rows = df.shape[0]
+
+    fields = list(entities)
+    for field in list(digit_padding) + list(classification_levels):
+        if field not in fields:
+            fields.append(field)
+
+    factorized = {}
+    for field in fields:
+        codes, uniques, counts = factorize_column(df[field])
+
+        if field in digit_padding:
+            report.zeropadded[field] = is_zeropadded(uniques)
+            if not report.zeropadded[field]:
+                codes, uniques, counts = pad_uniques(
+                    codes, uniques, digit_padding[field]
+                )
+
+        factorized[field] = (codes, uniques, counts)
+        report.num_unique[field] = len(uniques)
+
+    for field in entities:
+        codes = factorized[field][0]
+        report.missing[field] = int((codes == -1).sum())
+        if report.sampled:
+            report.bounds[("missing", field)] = proportion_bounds(
+                report.missing[field], num_checked_rows, report.num_rows
+            )
+
+    for field, classification_level in classification_levels.items():
+        codes, uniques, counts = factorized[field]
+        num_missing = int((codes == -1).sum())
+
+        classification_unique = classification_level.code
+        in_classification = uniques.isin(classification_unique)
+
+        # Missing values count as a unique value that's not in the
+        # classification, like in matching_stats()
+        rows_not_in_classification = counts[~in_classification].sum() + num_missing
+        unique_not_in_classification = (~in_classification).sum() + (num_missing > 0)
+        num_unique = len(uniques) + (num_missing > 0)
+
+        codes_missing = pd.Series(uniques[~in_classification])
+        if num_missing > 0:
+            codes_missing = pd.concat([codes_missing, pd.Series([np.nan])])
+
+        report.matching[field] = MatchingStats(
+            100.0 * (rows_not_in_classification / num_checked_rows),
+            100.0 * (unique_not_in_classification / num_unique),
+            codes_missing,
+            classification_unique[~classification_unique.isin(uniques)],
+        )
+        if report.sampled:
+            report.bounds[("nonmatching", field)] = proportion_bounds(
+                rows_not_in_classification, num_checked_rows, report.num_rows
+            )
+
+    if check_entities and len(entities) > 0:
+        if not report.sampled:
+            unique_counts = [report.num_unique[x] for x in entities]
+            report.rectangularized = is_rectangularized(unique_counts, report.num_rows)
+
+        combined = combined_codes([factorized[field][0] for field in entities])
+        if combined is None:
+            codes_df = pd.DataFrame({x: factorized[x][0] for x in entities})
+            report.duplicated = codes_df.duplicated(keep=False).values
+        else:
+            _, inverse, counts = np.unique(
+                combined, return_inverse=True, return_counts=True
+            )
+            report.duplicated = counts[inverse] > 1
+
+    return report
+
+
 # Thoughts:
 # - Dataset  python class?
 # - Layered approach: pandas -> assertions -> classification specific reckoner assertions -> reckoner
@@ -1,34 +1,170 @@
 """Import from an ingested .hdf file to an sql database."""
+import queue
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+from sqlalchemy import Column, MetaData, String, Table, inspect
 from sqlalchemy.exc import SQLAlchemyError
 
+# Trade durability for speed while bulk loading into sqlite: no rollback
+# journal, no fsync, and a 1GB page cache (negative values are in KiB). If
+# the load crashes halfway, the database file should be thrown away anyway.
+SQLITE_FAST_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": -(2 ** 20),
+    "temp_store": "MEMORY",
+}
 
-def import_data_sqlite(
-    file_name="./data.h5",
-    engine=None,
-    keys=None,
-    source_chunksize=10 ** 6,
-    dest_chunksize=10 ** 6,
-):
-    # Keeping this import inlined to avoid a dependency unless needed
-    import pandas as pd
+# Content hashes of the HDF keys each database was loaded from, so the next
+# load can tell which tables it can reuse. Deliberately kept out of db.metadata.
+table_hashes = Table(
+    "hdf_table_hashes",
+    MetaData(),
+    Column("hdf_key", String, primary_key=True),
+    Column("hash", String),
+)
 
-    print("Reading from file:'{}'".format(file_name))
-    store = pd.HDFStore(file_name, mode="r")
 
-    if keys is None:
-        keys = store.keys()
+def read_table_hashes(bind, schema=None):
+    """Get the {hdf key: content hash} recorded in a database, or an empty
+    dict if nothing was recorded."""
+    table = table_hashes.tometadata(MetaData(), schema=schema)
+    try:
+        return dict(bind.execute(table.select()).fetchall())
+    except SQLAlchemyError:
+        return {}
+
+
+def write_table_hashes(bind, hashes):
+    table_hashes.create(bind, checkfirst=True)
+    bind.execute(table_hashes.delete())
+    if hashes:
+        bind.execute(
+            table_hashes.insert(),
+            [{"hdf_key": key, "hash": value} for key, value in hashes.items()],
+        )
+
+
+def loaded_table_hashes(catalog, keys):
+    """Content hashes of just the HDF keys that made it into the new
+    database, i.e. the ones loaded from the file or copied over from the
+    previous database. Keys that were left out or failed to load must not be
+    recorded, or the next incremental load would take their tables as
+    unchanged and copy them forward."""
+    hashes = catalog.content_hashes()
+    return {key: hashes[key] for key in keys if key in hashes}
+
+
+def table_columns(bind, table_name, schema=None):
+    return [column["name"] for column in inspect(bind).get_columns(table_name, schema)]
+
+
+def reusable_tables(catalog, previous_hashes, source, dest, keys=None, schema=None):
+    """Figure out which sql tables can be copied over from the previous
+    database: the ones whose HDF keys haven't changed, as long as the table
+    still has the same columns. Returns those tables and the HDF keys that
+    need to be loaded from the file instead."""
+    unchanged_tables, changed_keys = catalog.diff(previous_hashes, keys)
+    sql_to_hdf, _ = catalog.hdf_metadata(keys)
+
+    reusable = {}
+    for table_name in sorted(unchanged_tables):
+        columns = table_columns(dest, table_name)
+        try:
+            previous_columns = table_columns(source, table_name, schema)
+        except SQLAlchemyError:
+            previous_columns = []
+
+        if columns and sorted(columns) == sorted(previous_columns):
+            reusable[table_name] = columns
+        else:
+            changed_keys.extend(sorted(sql_to_hdf[table_name]))
+
+    return reusable, changed_keys
+
+
+def copy_unchanged_tables_sqlite(engine, previous_database, catalog, keys=None):
+    """Copy tables that haven't changed since the load of `previous_database`
+    (an sqlite file name) straight from it. Returns the HDF keys that still
+    need to be loaded."""
+    with engine.connect() as conn:
+        conn.execute("ATTACH DATABASE ? AS previous", (previous_database,))
+        try:
+            previous_hashes = read_table_hashes(conn, schema="previous")
+            reusable, changed_keys = reusable_tables(
+                catalog, previous_hashes, conn, conn, keys=keys, schema="previous"
+            )
+
+            for table_name, columns in reusable.items():
+                print("Reusing unchanged table {}".format(table_name))
+                columns = ", ".join('"{}"'.format(column) for column in columns)
+                conn.execute(
+                    f'INSERT INTO main."{table_name}" ({columns}) '
+                    f'SELECT {columns} FROM previous."{table_name}"'
+                )
+        finally:
+            conn.execute("DETACH DATABASE previous")
+
+    return changed_keys
+
+
+def coerce_classification(df):
+    """Make sure 'name_en' is populated by renaming 'name' or dropping 'name'
+    if 'name_en' already exists"""
+    if "name_en" in df.columns:
+        return df.rename(columns={"index": "id"}).drop(
+            columns=["name"], errors="ignore"
+        )
+    else:
+        return df.rename(columns={"index": "id", "name": "name_en"})
+
+
+def read_hdf_chunks(store, key, metadata, source_chunksize=10 ** 6):
+    """Read a table from an already open HDFStore, yielding dataframes ready
+    to be written into the sql table."""
+    if key.startswith("/classifications/"):
+        yield coerce_classification(store.select(key))
+    else:
+        # If it's a timeseries data table, load it in chunks to not
+        # exhaust memory all at once
+        iterator = store.select(key, chunksize=source_chunksize, iterator=True)
+
+        for i, df in enumerate(iterator):
+            print(i * source_chunksize)
+
+            # Add in level fields
+            if "levels" in metadata:
+                for entity, level_value in metadata["levels"].items():
+                    df[entity + "_level"] = level_value
+
+            yield df
 
+
+def iter_hdf_tables(store, keys, source_chunksize=10 ** 6, catalog=None):
+    """Go through the given keys of an HDFStore, yielding (key, sql table
+    name, dataframe chunk) for the ones that have an sql table to go to. If
+    an :py:class:`~atlas_core.hdf_catalog.HDFCatalog` is given, metadata is
+    taken from that instead of the store."""
     for key in keys:
         print("-----------------------------------")
         print("HDF Table: {}".format(key))
 
         try:
-            metadata = store.get_storer(key).attrs.atlas_metadata
+            if catalog is not None:
+                metadata = catalog.metadata(key)
+            else:
+                metadata = store.get_storer(key).attrs.atlas_metadata
             print("Metadata: {}".format(metadata))
         except AttributeError:
             print("Skipping {}".format(key))
             continue
 
+        if metadata is None:
+            print("Skipping {}".format(key))
+            continue
+
         table_name = metadata.get("sql_table_name", None)
         print("SQL Table: {}".format(table_name))
 
@@ -36,54 +172,272 @@ def import_data_sqlite(
             print("Skipping {}".format(key))
             continue
 
+        for df in read_hdf_chunks(store, key, metadata, source_chunksize):
+            yield key, table_name, df
+
+
+def prefetch(iterable, maxsize=2):
+    """Consume an iterable in a background thread, keeping up to `maxsize`
+    items ready in a queue. This lets us decompress and prepare the next HDF
+    chunk while the current one is being written to the database, while
+    capping how many chunks are held in memory at once. Exceptions in the
+    background thread are re-raised in the consumer."""
+
+    if maxsize <= 0:
+        yield from iterable
+        return
+
+    item_queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    ITEM, DONE, ERROR = range(3)
+
+    def put(message):
+        # Don't block forever on a full queue if the consumer went away
+        while not stop.is_set():
+            try:
+                item_queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
         try:
-            if key.startswith("/classifications/"):
-                df = pd.read_hdf(file_name, key=key)
-
-                # Make sure 'name_en' is populated by renaming 'name' or dropping 'name'
-                # if 'name_en' already exists
-                if "name_en" in df.columns:
-                    df = df.rename(columns={"index": "id"}).drop(
-                        columns=["name"], errors="ignore"
-                    )
-                else:
-                    df = df.rename(columns={"index": "id", "name": "name_en"})
-                df.to_sql(
-                    table_name,
-                    engine,
-                    index=False,
-                    chunksize=dest_chunksize,
-                    if_exists="append",
-                )
+            for item in iterable:
+                if not put((ITEM, item)):
+                    return
+            put((DONE, None))
+        except BaseException as exc:
+            put((ERROR, exc))
 
-            else:
-                # If it's a timeseries data table, load it in chunks to not
-                # exhaust memory all at once
-                iterator = pd.read_hdf(
-                    file_name, key=key, chunksize=source_chunksize, iterator=True
-                )
+    thread = threading.Thread(target=producer, name="prefetch", daemon=True)
+    thread.start()
 
-                for i, df in enumerate(iterator):
-                    print(i * source_chunksize)
+    try:
+        while True:
+            kind, item = item_queue.get()
+            if kind == DONE:
+                break
+            elif kind == ERROR:
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
-                    # Add in level fields
-                    if "levels" in metadata:
-                        for entity, level_value in metadata["levels"].items():
-                            df[entity + "_level"] = level_value
 
-                    df.to_sql(
-                        table_name,
-                        engine,
-                        index=False,
-                        chunksize=dest_chunksize,
-                        if_exists="append",
-                    )
+class ToSQLWriter(object):
+    """Write dataframes using pandas' DataFrame.to_sql()."""
 
-                    # Hint that this object should be garbage collected
-                    del df
+    def __init__(self, engine, dest_chunksize=10 ** 6):
+        self.engine = engine
+        self.dest_chunksize = dest_chunksize
 
-        except SQLAlchemyError as exc:
-            print(exc)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def write(self, df, table_name):
+        df.to_sql(
+            table_name,
+            self.engine,
+            index=False,
+            chunksize=self.dest_chunksize,
+            if_exists="append",
+        )
+
+
+@contextmanager
+def sqlite_pragmas(connection, pragmas=SQLITE_FAST_PRAGMAS):
+    """Temporarily change sqlite pragmas on a DBAPI connection, restoring the
+    old values afterwards."""
+    cursor = connection.cursor()
+    old_values = {}
+    for pragma, value in pragmas.items():
+        old_values[pragma] = cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    try:
+        yield connection
+    finally:
+        for pragma, value in old_values.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+
+class SQLiteBulkWriter(object):
+    """Fast path for loading into sqlite: sets speed-over-safety pragmas for
+    the duration of the load, inserts each chunk with a single executemany()
+    inside one explicit transaction, and drops the indexes of the tables it
+    writes to, recreating them once all the data is in."""
+
+    def __init__(self, engine, pragmas=SQLITE_FAST_PRAGMAS):
+        self.engine = engine
+        self.pragmas = pragmas
+        self.connection = None
+        self.dropped_indexes = {}
+
+    def __enter__(self):
+        self.connection = self.engine.raw_connection()
+        self._pragmas = sqlite_pragmas(self.connection, self.pragmas)
+        self._pragmas.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.create_indexes()
+        finally:
+            self._pragmas.__exit__(*exc_info)
+            self.connection.close()
+            self.connection = None
+        return False
+
+    def table_exists(self, table_name):
+        cursor = self.connection.cursor()
+        row = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,),
+        ).fetchone()
+        cursor.close()
+        return row is not None
+
+    def drop_indexes(self, table_name):
+        """Drop indexes on a table, remembering their definitions so we can
+        recreate them later."""
+        if table_name in self.dropped_indexes:
+            return
+
+        cursor = self.connection.cursor()
+        indexes = cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL",
+            (table_name,),
+        ).fetchall()
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+        self.connection.commit()
+        cursor.close()
+
+        self.dropped_indexes[table_name] = [sql for _, sql in indexes]
+
+    def create_indexes(self):
+        cursor = self.connection.cursor()
+        for table_name, index_statements in self.dropped_indexes.items():
+            print("Creating {} indexes on {}".format(len(index_statements), table_name))
+            for statement in index_statements:
+                cursor.execute(statement)
+        self.connection.commit()
+        cursor.close()
+        self.dropped_indexes = {}
+
+    def write(self, df, table_name):
+        if not self.table_exists(table_name):
+            # Let pandas figure out the schema if the models didn't
+            df.head(0).to_sql(table_name, self.engine, index=False)
+
+        self.drop_indexes(table_name)
+
+        columns = ", ".join('"{}"'.format(column) for column in df.columns)
+        placeholders = ", ".join(["?"] * len(df.columns))
+        statement = f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})'
+
+        # tolist() converts numpy scalars to python objects sqlite3 can bind
+        rows = zip(*[df[column].tolist() for column in df.columns])
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("BEGIN")
+            cursor.executemany(statement, rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def import_data_sqlite(
+    file_name="./data.h5",
+    engine=None,
+    keys=None,
+    source_chunksize=10 ** 6,
+    dest_chunksize=10 ** 6,
+    fast=False,
+    prefetch_chunks=2,
+    catalog=None,
+    previous_database=None,
+):
+    """Import an HDF file into sqlite. With `fast=True`, use
+    :py:class:`~SQLiteBulkWriter` instead of pandas' to_sql(), which is much
+    faster but turns off journaling while loading.
+
+    Reading from the HDF file happens in a separate thread that stays up to
+    `prefetch_chunks` chunks ahead of the writer. Set it to 0 to read and
+    write one after the other.
+
+    Pass an :py:class:`~atlas_core.hdf_catalog.HDFCatalog` to take keys and
+    metadata from it instead of from the store.
+
+    If `previous_database` (file name of an sqlite database loaded by an
+    earlier run) is given, tables whose HDF contents haven't changed are
+    copied from there instead of being read from the HDF file. Either way,
+    when there is a catalog, the content hashes of the keys that were loaded
+    or copied are recorded in the new database for the next run."""
+
+    # Keeping this import inlined to avoid a dependency unless needed
+    import pandas as pd
+
+    print("Reading from file:'{}'".format(file_name))
+    store = pd.HDFStore(file_name, mode="r")
+
+    reused_keys = set()
+    if previous_database is not None:
+        from .hdf_catalog import HDFCatalog
+
+        if catalog is None:
+            catalog = HDFCatalog.load(file_name)
+        sql_to_hdf, _ = catalog.hdf_metadata(keys)
+        keys = copy_unchanged_tables_sqlite(engine, previous_database, catalog, keys)
+        reused_keys = set().union(*sql_to_hdf.values()) - set(keys)
+
+    if keys is None:
+        keys = list(catalog.tables.keys()) if catalog else store.keys()
+
+    if fast:
+        writer = SQLiteBulkWriter(engine)
+    else:
+        writer = ToSQLWriter(engine, dest_chunksize)
+
+    # Read and prepare the next chunks in a background thread while the
+    # current one is being written
+    chunks = prefetch(
+        iter_hdf_tables(store, keys, source_chunksize, catalog), prefetch_chunks
+    )
+
+    written_keys = set()
+    failed_keys = set()
+    try:
+        with writer, closing(chunks):
+            for key, table_name, df in chunks:
+                if key in failed_keys:
+                    continue
+
+                written_keys.add(key)
+                try:
+                    writer.write(df, table_name)
+                except (SQLAlchemyError, sqlite3.Error) as exc:
+                    print(exc)
+                    failed_keys.add(key)
+
+                # Hint that this object should be garbage collected
+                del df
+    finally:
+        store.close()
+
+    if catalog is not None:
+        loaded_keys = reused_keys | (written_keys - failed_keys)
+        write_table_hashes(engine, loaded_table_hashes(catalog, loaded_keys))
 
 
 def import_data(
@@ -95,6 +449,9 @@ def import_data(
     database="postgres",
     processes=4,
     new_db_name=None,
+    sqlite_fast=False,
+    catalog=None,
+    previous_database=None,
 ):
     """Import data from a data.h5 (i.e. HDF) file into the SQL DB. This
     needs to be run from within the flask app context in order to be able to
@@ -124,6 +481,27 @@ def import_data(
     It is worth noting that this does use the atlas_core.db object to connect
     to to create the new database as well as use its metadata to create the
     database structures in the destination db.
+
+    SQLite-specific:
+    ----------------
+    Pass `sqlite_fast=True` to bulk insert with journaling and syncing turned
+    off, and indexes built after the load. Use this when the database file is
+    disposable if the import fails, e.g. test fixtures or embedded builds.
+
+    Catalog:
+    --------
+    Optionally, pass in an :py:class:`~atlas_core.hdf_catalog.HDFCatalog` (e.g.
+    `HDFCatalog.load(file_name)`) so that loaders plan from the catalog
+    instead of scanning the HDF store again for metadata and data version.
+
+    Incremental loads:
+    ------------------
+    Pass `previous_database` (the postgres database name / data version, or
+    the sqlite file name of an earlier load) to only load the HDF keys whose
+    contents changed since then, and copy all other tables over from the
+    previous database. This needs a catalog, which is loaded automatically if
+    not given. Content hashes are recorded in the new database whenever a
+    catalog is used, so the next load can be incremental.
     """
 
     if database == "postgres":
@@ -138,9 +516,20 @@ def import_data(
             keys=keys,
             maintenance_work_mem="1GB",
             processes=processes,
+            catalog=catalog,
+            previous_db_name=previous_database,
         )
     elif database == "sqlite":
-        import_data_sqlite(file_name, engine, keys, source_chunksize, dest_chunksize)
+        import_data_sqlite(
+            file_name,
+            engine,
+            keys,
+            source_chunksize,
+            dest_chunksize,
+            fast=sqlite_fast,
+            catalog=catalog,
+            previous_database=previous_database,
+        )
     else:
         raise ValueError(
             f"Database must be one of 'postgres' or 'sqlite', you gave {database}"
@@ -1,12 +1,19 @@
 """All the stuff related to cleaning up raw datasets, merging them with
 classifications, etc."""
 
+import multiprocessing
+import os
+import sys
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 
 from clint.textui import puts, indent, colored
+import numpy as np
 import pandas as pd
 
 from . import data_assertions as assertions
+from .ingestion_cache import hash_object
 
 
 def good(msg):
@@ -25,81 +32,384 @@ def indented():
     return indent(4, quote=colored.cyan("> "))
 
 
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "?"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return "{:.1f}{}".format(num_bytes, unit)
+        num_bytes /= 1024
+    return "{:.1f}TB".format(num_bytes)
+
+
+def memory_usage():
+    """Current and peak resident memory of this process in bytes, or None
+    where we can't tell on this platform."""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, mac reports bytes
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        peak = None
+
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = None
+
+    return current, peak
+
+
+def report_memory(stage, df=None):
+    current, peak = memory_usage()
+    msg = "Memory after {}: {} current, {} peak".format(
+        stage, format_bytes(current), format_bytes(peak)
+    )
+    if df is not None:
+        msg += ", dataframe {} x {} is {}".format(
+            df.shape[0], df.shape[1], format_bytes(df.memory_usage(deep=True).sum())
+        )
+    puts(msg)
+
+
+def shrink_dtypes(df, dataset):
+    """Turn code and year columns into categoricals and downcast integer
+    columns, in place. Floats are left alone, since aggregating in float32
+    would change the results."""
+    categorical_fields = (
+        set(dataset["classification_fields"]) | set(dataset["digit_padding"]) | {"year"}
+    )
+    for column in df.columns:
+        if column in categorical_fields:
+            df[column] = df[column].astype("category")
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+    return df
+
+
+def zfill_categorical(series, length):
+    """Zero-pad a categorical column by padding its categories instead of
+    every row. Categories that end up the same after padding (e.g. 1 and
+    "01") are merged."""
+    padded = pd.Series(series.cat.categories).astype(int).astype(str).str.zfill(length)
+    categories, category_codes = np.unique(padded.values, return_inverse=True)
+    codes = series.cat.codes.values
+    codes = np.where(codes == -1, -1, category_codes[codes])
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=categories),
+        index=series.index,
+        name=series.name,
+    )
+
+
+class CodeToIdMapper(object):
+    """Maps codes of a classification level (a dataframe indexed by id, with
+    a code column) to ids. Codes are sorted once when the mapper is built,
+    then each lookup factorizes the column and finds each unique code with
+    searchsorted, so nothing is merged or copied. See
+    :py:func:`~code_to_id_mapper` for a cached one per level."""
+
+    def __init__(self, classification_level):
+        codes = classification_level.code.values
+        order = np.argsort(codes, kind="stable")
+        self.codes = codes[order]
+        self.code_positions = order
+        self.classification_codes = classification_level.code
+        self.classification_ids = classification_level.index
+        self.id_dtype = pd.CategoricalDtype(
+            categories=classification_level.index.values
+        )
+
+    def matches(self, classification_level):
+        """Whether this mapper is still up to date with a classification
+        level, i.e. it has the same codes and ids."""
+        return self.classification_ids.equals(
+            classification_level.index
+        ) and self.classification_codes.equals(classification_level.code)
+
+    def positions(self, values):
+        """Position of each value in the classification level, or -1."""
+        values = np.asarray(values)
+        try:
+            found = np.searchsorted(self.codes, values)
+        except TypeError:
+            # Can't sort e.g. ints and strings together, fall back to hashing
+            return pd.Index(self.classification_codes).get_indexer(values)
+
+        found = np.minimum(found, len(self.codes) - 1)
+        matched = self.codes[found] == values if len(self.codes) > 0 else False
+        return np.where(matched, self.code_positions[found], -1)
+
+    def map(self, series):
+        """Look up the ids of a column of codes. Returns a categorical of ids
+        (with all ids of the level as categories, and missing values where
+        the code didn't match) and the
+        :py:class:`~atlas_core.data_assertions.MatchingStats` of the column,
+        computed from the same lookup."""
+        codes, uniques, counts = assertions.factorize_column(series)
+        unique_positions = self.positions(uniques.values)
+
+        row_positions = np.where(codes == -1, -1, unique_positions[codes])
+        ids = pd.Categorical.from_codes(row_positions, dtype=self.id_dtype)
+
+        # Missing values count as a unique value that's not in the
+        # classification, like in matching_stats()
+        num_missing = int((codes == -1).sum())
+        unmatched = unique_positions == -1
+        num_rows = max(len(codes), 1)
+        num_unique = max(len(uniques) + (num_missing > 0), 1)
+
+        codes_missing = pd.Series(uniques[unmatched])
+        if num_missing > 0:
+            codes_missing = pd.concat([codes_missing, pd.Series([np.nan])])
+
+        used = np.zeros(len(self.codes), dtype=bool)
+        used[unique_positions[~unmatched]] = True
+
+        stats = assertions.MatchingStats(
+            100.0 * ((counts[unmatched].sum() + num_missing) / num_rows),
+            100.0 * ((unmatched.sum() + (num_missing > 0)) / num_unique),
+            codes_missing,
+            self.classification_codes[~used],
+        )
+        return ids, stats
+
+
+# classification -> {level: mapper}, dropped along with the classification
+_code_to_id_mappers = weakref.WeakKeyDictionary()
+
+
+def code_to_id_mapper(classification, level):
+    """A :py:class:`~CodeToIdMapper` for a level of a classification, reused
+    across calls as long as the level's codes and ids stay the same.
+    Classifications that can't be weakly referenced aren't cached."""
+    classification_level = classification.level(level)
+    try:
+        mappers = _code_to_id_mappers.setdefault(classification, {})
+    except TypeError:
+        return CodeToIdMapper(classification_level)
+
+    mapper = mappers.get(level, None)
+    if mapper is None or not mapper.matches(classification_level):
+        mapper = mappers[level] = CodeToIdMapper(classification_level)
+    return mapper
+
+
 def merge_ids_from_codes(df, df_merge_on, classification, classification_column):
-    """Merge a classification id column to a table, given the code field, and
-    rename things nicely."""
-    code_to_id = classification.reset_index()[["code", "index"]].set_index("code")
-    code_to_id.columns = [classification_column]
-    return df.merge(code_to_id, left_on=df_merge_on, right_index=True, how="left")
+    """Return a copy of a table with a classification id column added, given
+    the code field, and rename things nicely. Codes that aren't in the
+    classification get a missing id."""
+    ids, _ = CodeToIdMapper(classification).map(df[df_merge_on])
+    return df.assign(**{classification_column: np.asarray(ids)})
+
+
+def compute_facet(df, facet_fields, aggregations):
+    """Group by the facet fields once and run each of the aggregations on
+    that same groupby object, e.g. mean, first, min, rank etc. Aggregations
+    are either functions that take the groupby, or the name of a pandas
+    aggregation like "sum"."""
+
+    # Newer Pandas requires multiple groupby to be list, not tuple
+    if type(facet_fields) == tuple:
+        facet_groupby = df.groupby(list(facet_fields))
+    else:
+        facet_groupby = df.groupby(facet_fields)
+
+    # Do specified aggregations / groupings for each column
+    agg_outputs = []
+    for agg_field, agg_func in aggregations.items():
+        if isinstance(agg_func, str):
+            agged_row = facet_groupby[[agg_field]].agg(agg_func)
+        else:
+            agged_row = agg_func(facet_groupby[[agg_field]])
+        agg_outputs.append(agged_row)
 
+    return pd.concat(agg_outputs, axis=1)
 
-def process_dataset(dataset):
 
-    puts("=" * 80)
-    good("Processing a new dataset!")
+# Set right before forking the worker processes, so they inherit the base
+# dataframe and the facet config (which often has lambdas that can't be
+# pickled) instead of having them pickled and sent for each task.
+_facet_state = {}
+
+
+def _compute_facet_in_worker(facet_fields):
+    df, facets = _facet_state["df"], _facet_state["facets"]
+    return facet_fields, compute_facet(df, facet_fields, facets[facet_fields])
+
 
-    # Read dataset and fix up columns
-    df = dataset["read_function"]()
-    df = df[list(dataset["field_mapping"].keys())]
-    df = df.rename(columns=dataset["field_mapping"])
+def compute_facets(df, facets, executor=None, workers=None):
+    """Compute each facet from the base dataframe. Facets are independent of
+    each other, so they can run concurrently:
+
+        - executor=None: one after the other.
+        - executor="thread": on a thread pool, all sharing the dataframe.
+        - executor="process": on a pool of forked processes, which share the
+        dataframe pages with the parent copy-on-write. Only the facet
+        outputs get pickled, to be sent back.
+    """
+    if executor is None:
+        facet_outputs = {}
+        for facet_fields, aggregations in facets.items():
+            puts("Working on facet: {}".format(facet_fields))
+            with indented():
+                for agg_field in aggregations:
+                    puts("Working on: {}".format(agg_field))
+            facet_outputs[facet_fields] = compute_facet(df, facet_fields, aggregations)
+        return facet_outputs
+
+    puts("Working on {} facets with {} pool".format(len(facets), executor))
+
+    if executor == "thread":
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                facet_fields: pool.submit(compute_facet, df, facet_fields, aggregations)
+                for facet_fields, aggregations in facets.items()
+            }
+            return {
+                facet_fields: future.result()
+                for facet_fields, future in futures.items()
+            }
+
+    elif executor == "process":
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            raise ValueError("executor='process' needs a platform that can fork()")
+
+        _facet_state.update(df=df, facets=facets)
+        try:
+            with context.Pool(workers) as pool:
+                results = pool.map(_compute_facet_in_worker, list(facets.keys()))
+        finally:
+            _facet_state.clear()
+        return dict(results)
+
+    else:
+        raise ValueError(
+            "executor must be one of None, 'thread' or 'process', you gave {}".format(
+                executor
+            )
+        )
+
+
+def clean_columns(df, dataset, low_memory=False):
+    """Pick and rename the columns we care about, and run the pre-merge
+    hook. With low_memory, this happens in place so we don't hold on to both
+    the raw and the cleaned up data at once."""
+    if low_memory:
+        field_mapping = dataset["field_mapping"]
+        df.drop(columns=[x for x in df.columns if x not in field_mapping], inplace=True)
+        df.rename(columns=field_mapping, inplace=True)
+    else:
+        df = df[list(dataset["field_mapping"].keys())]
+        df = df.rename(columns=dataset["field_mapping"])
 
     if "hook_pre_merge" in dataset:
         df = dataset["hook_pre_merge"](df)
 
-    puts("Dataset overview:")
-    with indented():
-        infostr = StringIO()
-        df.info(buf=infostr, memory_usage=True, null_counts=True)
-        puts(infostr.getvalue())
+    return df
+
+
+def format_bounds(report, check, field):
+    if (check, field) not in report.bounds:
+        return ""
+    return " (95% interval {:.2f}% - {:.2f}% of all rows)".format(
+        *report.bounds[(check, field)]
+    )
+
+
+def check_dataset(df, dataset, check_entities=True, sample=None):
+    """Run all data checks in one pass with
+    :py:func:`~atlas_core.data_assertions.validate_dataset`, warn about
+    anything that failed, and return the report so that later steps can
+    reuse its results.
+
+    With `sample` (a fraction of rows), only check a sample stratified by
+    `dataset["check_strata"]`, which defaults to year."""
+    classification_levels = {
+        field: c["classification"].level(c["level"])
+        for field, c in dataset["classification_fields"].items()
+    }
+    strata = dataset.get("check_strata", ["year"] if "year" in df.columns else None)
+    report = assertions.validate_dataset(
+        df,
+        dataset["facet_fields"],
+        digit_padding=dataset["digit_padding"],
+        classification_levels=classification_levels,
+        check_entities=check_entities,
+        sample_fraction=sample,
+        strata=strata,
+    )
+
+    if report.sampled:
+        warn(
+            "Only checking a sample of {} of {} rows.".format(
+                report.num_checked_rows, report.num_rows
+            )
+        )
 
-    for field in dataset["facet_fields"]:
-        try:
-            assertions.assert_none_missing(df[field])
-        except AssertionError:
+    for field, count in report.missing.items():
+        if count > 0:
             warn(
-                "Field '{}' has {} missing values.".format(
-                    field, df[field].isnull().sum()
+                "Field '{}' has {} missing values{}{}.".format(
+                    field,
+                    count,
+                    report.sample_description(),
+                    format_bounds(report, "missing", field),
                 )
             )
 
-    # Zero-pad digits of n-digit codes
-    for field, length in dataset["digit_padding"].items():
-        try:
-            assertions.assert_is_zeropadded_string(df[field])
-        except AssertionError:
-            warn("Field '{}' is not padded to {} digits.".format(field, length))
-            df[field] = df[field].astype(int).astype(str).str.zfill(length)
-
-    # Make sure the dataset is rectangularized by the facet fields
-    try:
-        assertions.assert_rectangularized(df, dataset["facet_fields"])
-    except AssertionError:
+    if report.rectangularized is False:
+        # Make sure the dataset is rectangularized by the facet fields
         warn(
             "Dataset is not rectangularized on fields {}".format(
                 dataset["facet_fields"]
             )
         )
 
-    try:
-        assertions.assert_entities_not_duplicated(df, dataset["facet_fields"])
-    except AssertionError:
+    if report.num_duplicated > 0:
         bad(
             "Dataset has duplicate rows for entity combination: {}".format(
                 dataset["facet_fields"]
             )
         )
-        bad(df[df.duplicated(subset=dataset["facet_fields"], keep=False)])
+        bad(report.duplicated_rows(df))
 
-    # Merge in IDs for entity codes
-    for field_name, c in dataset["classification_fields"].items():
-        classification_table = c["classification"].level(c["level"])
+    return report
 
-        (
-            p_nonmatch_rows,
-            p_nonmatch_unique,
-            codes_missing,
-            codes_unused,
-        ) = assertions.matching_stats(df[field_name], classification_table)
+
+def fix_padding(df, dataset, report=None):
+    """Zero-pad digits of n-digit codes"""
+    for field, length in dataset["digit_padding"].items():
+        # A sample could miss unpadded values, so check them all
+        if report is not None and not report.sampled:
+            padded = report.zeropadded[field]
+        else:
+            padded = assertions.is_zeropadded(assertions.factorize_column(df[field])[1])
+
+        if not padded:
+            warn("Field '{}' is not padded to {} digits.".format(field, length))
+            if pd.api.types.is_categorical_dtype(df[field]):
+                df[field] = zfill_categorical(df[field], length)
+            else:
+                df[field] = df[field].astype(int).astype(str).str.zfill(length)
+
+    return df
+
+
+def merge_classifications(df, dataset):
+    """Merge in IDs for entity codes, dropping rows with codes that don't
+    exist in the classification. Ids and matching stats come out of the same
+    lookup over all rows, see :py:class:`~CodeToIdMapper`, so the stats are
+    exact even when :py:func:`~check_dataset` only checked a sample."""
+    for field_name, c in dataset["classification_fields"].items():
+        mapper = code_to_id_mapper(c["classification"], c["level"])
+        ids, stats = mapper.map(df[field_name])
+        p_nonmatch_rows, p_nonmatch_unique, codes_missing, codes_unused = stats
 
         if p_nonmatch_rows > 0:
             bad("Errors when Merging field {}:".format(field_name))
@@ -114,121 +424,440 @@ def process_dataset(dataset):
                 puts("Codes unused:\n{}".format(codes_unused.reset_index(drop=True)))
 
             bad("Dropping nonmatching rows.")
-            df = df[~df[field_name].isin(codes_missing)]
-
-        df = merge_ids_from_codes(
-            df, field_name, classification_table, field_name + "_id"
+            matched = ids.codes != -1
+            df = df[matched].copy()
+            ids = ids[matched]
+
+        df[field_name + "_id"] = ids
+
+    return df
+
+
+# Aggregations that can be computed chunk by chunk, mapped to the aggregation
+# that combines the partial results of each chunk.
+MERGEABLE_AGGREGATIONS = {
+    "sum": "sum",
+    "count": "sum",
+    "min": "min",
+    "max": "max",
+    "first": "first",
+}
+
+
+def unmergeable_aggregations(facets):
+    """List (facet, field, aggregation) for aggregations that can't be
+    computed in chunks. Only aggregations given by name in
+    MERGEABLE_AGGREGATIONS can, arbitrary functions can't."""
+    return [
+        (facet_fields, agg_field, agg_func)
+        for facet_fields, aggregations in facets.items()
+        for agg_field, agg_func in aggregations.items()
+        if not (isinstance(agg_func, str) and agg_func in MERGEABLE_AGGREGATIONS)
+    ]
+
+
+def combine_partial_facets(partials, aggregations):
+    """Combine per-chunk facet outputs into one, e.g. sum up partial sums and
+    counts, take the min of partial mins, etc."""
+    combined = pd.concat(partials)
+    return combined.groupby(level=list(range(combined.index.nlevels))).agg(
+        {
+            agg_field: MERGEABLE_AGGREGATIONS[agg_func]
+            for agg_field, agg_func in aggregations.items()
+        }
+    )
+
+
+def compute_facets_chunked(
+    chunks, dataset, executor=None, workers=None, check_sample=None
+):
+    """Out-of-core version of the cleaning, merging and facet steps of
+    :py:func:`~process_dataset`, for datasets that don't fit in memory. Each
+    chunk is cleaned, merged with the classifications and aggregated on its
+    own, and the partial results get folded into a running total, so only one
+    chunk of raw data is in memory at once.
+
+    Checks that need the whole dataset (rectangularization, duplicates)
+    are skipped, and years are kept as-is instead of being turned into a
+    categorical, since we don't know all the years until the end."""
+
+    facets = dataset["facets"]
+    unmergeable = unmergeable_aggregations(facets)
+    if unmergeable:
+        bad("These aggregations can't be computed in chunks:")
+        with indented():
+            for facet_fields, agg_field, agg_func in unmergeable:
+                puts("{} {}: {}".format(facet_fields, agg_field, agg_func))
+        raise ValueError(
+            "Chunked processing only supports these aggregations, given by "
+            "name: {}".format(sorted(MERGEABLE_AGGREGATIONS))
         )
 
-        df[field_name + "_id"] = df[field_name + "_id"].astype(
-            pd.CategoricalDtype(categories=classification_table.index.values)
-        )
+    facet_outputs = {}
+    for i, df in enumerate(chunks):
+        puts("Working on chunk {} ({} rows)".format(i, df.shape[0]))
 
-    if "year" in df.columns:
-        df["year"] = df["year"].astype(
-            pd.CategoricalDtype(
-                categories=df.year.sort_values(ascending=True).unique(), ordered=True
-            )
-        )
+        df = clean_columns(df, dataset)
+        report = check_dataset(df, dataset, check_entities=False, sample=check_sample)
+        df = fix_padding(df, dataset, report)
+        df = merge_classifications(df, dataset)
 
-    # Gather each facet dataset (e.g. DY, PY, DPY variables from DPY dataset)
-    facet_outputs = {}
-    for facet_fields, aggregations in dataset["facets"].items():
-        puts("Working on facet: {}".format(facet_fields))
+        chunk_outputs = compute_facets(df, facets, executor=executor, workers=workers)
+        del df
 
-        # Newer Pandas requires multiple groupby to be list, not tuple
-        if type(facet_fields) == tuple:
-            facet_groupby = df.groupby(list(facet_fields))
-        else:
-            facet_groupby = df.groupby(facet_fields)
+        for facet_fields, partial in chunk_outputs.items():
+            if facet_fields in facet_outputs:
+                partial = combine_partial_facets(
+                    [facet_outputs[facet_fields], partial], facets[facet_fields]
+                )
+            facet_outputs[facet_fields] = partial
 
-        # Do specified aggregations / groupings for each column
-        # like mean, first, min, rank, etc
-        agg_outputs = []
-        for agg_field, agg_func in aggregations.items():
-            with indented():
-                puts("Working on: {}".format(agg_field))
+    warn("Skipped rectangularization and duplicate checks in chunked mode.")
 
-            agged_row = agg_func(facet_groupby[[agg_field]])
-            agg_outputs.append(agged_row)
+    return facet_outputs
 
-        facet = pd.concat(agg_outputs, axis=1)
-        facet_outputs[facet_fields] = facet
 
-    # Perform aggregations by classification (e.g. aggregate 4digit products to
-    # 2digit and locations to regions, or both, etc)
+def ancestor_mapping(dataset, field, agg_level_to):
+    """For a classification id field in a facet, find the ids at
+    `agg_level_to` that each id at the field's own level rolls up into.
+    Returns the child ids, and for each of them the position of its parent in
+    the returned parent categories (which keep the order of the aggregation
+    table)."""
+
+    # Infer classification table and level we're aggregating from, from
+    # field name
+    assert field.endswith("_id")
+    classification_name = field[:-3]
+    classifications = dataset["classification_fields"]
+    classification_table = classifications[classification_name]["classification"]
+    agg_level_from = classifications[classification_name]["level"]
+
+    # Check agg level to is a valid level
+    assert agg_level_to in classification_table.levels
+    assert agg_level_from in classification_table.levels
+
+    # Check agg_level to is higher than agg_level_from
+    assert (
+        classification_table.levels[agg_level_to]
+        < classification_table.levels[agg_level_from]
+    )
+
+    # Get table that gives us mapping from agg_level_from to agg_level_to
+    aggregation_table = classification_table.aggregation_table(
+        agg_level_from, agg_level_to
+    )
+    parent_ids = aggregation_table.iloc[:, 0].astype(int)
+
+    parent_categories = pd.Index(parent_ids.unique())
+    parent_codes = parent_categories.get_indexer(parent_ids.values)
+
+    return pd.Index(aggregation_table.index), parent_codes, parent_categories
+
+
+def gather_parent_ids(ids, mapping):
+    """Replace a column of ids with their parents' ids in a single gather over
+    the column's categories. Returns the new categorical column, and a mask
+    of rows that have no parent (which an inner join would have dropped)."""
+    child_ids, parent_codes, parent_categories = mapping
+
+    if not pd.api.types.is_categorical_dtype(ids):
+        ids = ids.astype("category")
+
+    # Where each category of the column sits in the aggregation table, then
+    # the code of its parent
+    positions = child_ids.get_indexer(ids.cat.categories)
+    category_parent_codes = np.where(
+        positions == -1, -1, parent_codes[positions]
+    ).astype(np.int64)
+
+    codes = ids.cat.codes.values
+    codes = np.where(codes == -1, -1, category_parent_codes[codes])
+
+    parents = pd.Categorical.from_codes(codes, categories=parent_categories)
+    return parents, codes == -1
+
+
+def compute_classification_aggregations(facet_outputs, dataset):
+    """Perform aggregations by classification (e.g. aggregate 4digit products
+    to 2digit and locations to regions, or both, etc)
+
+    Each facet is reset and each (field, level) parent mapping is looked up
+    only once however many aggregations use it, and aggregations that roll up
+    the same facet to the same levels share one groupby."""
+    clagg_settings_all = dataset.get("classification_aggregations", {})
+
+    # Group aggregations that roll up the same base facet to the same levels
+    rollups = {}
+    for clagg_name, clagg_settings in clagg_settings_all.items():
+        rollup = (
+            clagg_settings["facet"],
+            tuple(sorted(clagg_settings["agg_fields"].items())),
+        )
+        rollups.setdefault(rollup, []).append(clagg_name)
+
+    base_dfs = {}
+    mappings = {}
     clagg_outputs = {}
-    for clagg_name, clagg_settings in dataset.get(
-        "classification_aggregations", {}
-    ).items():
+    for (facet, agg_fields), clagg_names in rollups.items():
 
         # Here is the output dataframe we now want to aggregate up
-        facet = clagg_settings["facet"]
-        base_df = facet_outputs[facet].reset_index()
+        if facet not in base_dfs:
+            assert "parent_id" not in facet_outputs[facet].columns
+            base_dfs[facet] = facet_outputs[facet].reset_index()
+        base_df = base_dfs[facet]
 
         # First, find out new higher_level ids, e.g. each product_id entry
         # should be replaced from the 4digit id to its 2digit parent etc.
-        for field, agg_level_to in clagg_settings["agg_fields"].items():
-
-            # Infer classification table and level we're aggregating from, from
-            # field name
-            assert field.endswith("_id")
-            classification_name = field[:-3]
-            classifications = dataset["classification_fields"]
-            classification_table = classifications[classification_name][
-                "classification"
-            ]
-            agg_level_from = classifications[classification_name]["level"]
-
-            # Check agg level to is a valid level
-            assert agg_level_to in classification_table.levels
-            assert agg_level_from in classification_table.levels
-
-            # Check agg_level to is higher than agg_level_from
-            assert (
-                classification_table.levels[agg_level_to]
-                < classification_table.levels[agg_level_from]
+        rolled_up = {}
+        unmatched = np.zeros(base_df.shape[0], dtype=bool)
+        for field, agg_level_to in agg_fields:
+            if (field, agg_level_to) not in mappings:
+                mappings[(field, agg_level_to)] = ancestor_mapping(
+                    dataset, field, agg_level_to
+                )
+            rolled_up[field], field_unmatched = gather_parent_ids(
+                base_df[field], mappings[(field, agg_level_to)]
             )
+            unmatched |= field_unmatched
 
-            # Get table that gives us mapping from agg_level_from to agg_level_to
-            aggregation_table = classification_table.aggregation_table(
-                agg_level_from, agg_level_to
+        rolled_up_df = base_df.assign(**rolled_up)
+        if unmatched.any():
+            rolled_up_df = rolled_up_df[~unmatched]
+
+        # Now that we have the new parent ids for every field, perform
+        # aggregation
+        # Newer Pandas requires multiple groupby to be list, not tuple
+        if type(facet) == tuple:
+            grouped = rolled_up_df.groupby(list(facet))
+        else:
+            grouped = rolled_up_df.groupby(facet)
+
+        # Add it to the list of classification aggregation results!
+        for clagg_name in clagg_names:
+            clagg_outputs[clagg_name] = grouped.agg(
+                clagg_settings_all[clagg_name]["agg_params"]
             )
 
-            # Rename column so that when we join the aggregation table we don't
-            # get a duplicate column name accidentally
-            assert "parent_id" not in facet_outputs[facet].columns
-            aggregation_table.columns = ["parent_id"]
+    return clagg_outputs
+
 
-            # Convert the new ID field into a categorical type
-            aggregation_table.parent_id = aggregation_table.parent_id.astype(
-                int
-            ).astype(
+def prepare_dataset(data, dataset, low_memory=False, check_sample=None):
+    """Clean up the columns of a raw dataset, run checks, and merge in the
+    classification ids, for when the whole dataset fits in memory.
+
+    With low_memory, code and year columns become categoricals and integer
+    columns get downcast right away, most steps work on categories instead
+    of rows, and memory use is reported after each step.
+
+    With check_sample (a fraction), data checks only look at a sample of
+    the rows, see :py:func:`~check_dataset`."""
+    df = clean_columns(data, dataset, low_memory=low_memory)
+    del data
+
+    if low_memory:
+        df = shrink_dtypes(df, dataset)
+        report_memory("reading", df)
+    else:
+        puts("Dataset overview:")
+        with indented():
+            infostr = StringIO()
+            df.info(buf=infostr, memory_usage=True, null_counts=True)
+            puts(infostr.getvalue())
+
+    report = check_dataset(df, dataset, sample=check_sample)
+    df = fix_padding(df, dataset, report)
+    if low_memory:
+        report_memory("checks", df)
+
+    df = merge_classifications(df, dataset)
+    if low_memory:
+        report_memory("merging classifications", df)
+
+    if "year" in df.columns:
+        if pd.api.types.is_categorical_dtype(df["year"]):
+            # Categories are already sorted
+            df["year"] = df["year"].cat.remove_unused_categories().cat.as_ordered()
+        else:
+            df["year"] = df["year"].astype(
                 pd.CategoricalDtype(
-                    categories=aggregation_table.parent_id.astype(int).unique()
+                    categories=df.year.sort_values(ascending=True).unique(),
+                    ordered=True,
                 )
             )
 
-            # Join aggregation table
-            # Drop old field and replace with new aggregation table field
-            base_df = (
-                base_df.merge(aggregation_table, left_on=field, right_index=True)
-                .drop(columns=field)
-                .rename(columns={"parent_id": field})
+    return df
+
+
+def merge_config(dataset, low_memory=False):
+    """The parts of a dataset config that affect the merged dataframe,
+    including the classification tables themselves."""
+    return {
+        "low_memory": low_memory,
+        "field_mapping": dataset["field_mapping"],
+        "hook_pre_merge": dataset.get("hook_pre_merge", None),
+        "digit_padding": dataset["digit_padding"],
+        "classification_fields": {
+            field_name: [c["level"], c["classification"].level(c["level"])]
+            for field_name, c in dataset["classification_fields"].items()
+        },
+    }
+
+
+def compute_facets_cached(
+    dataset, cache, executor=None, workers=None, low_memory=False, check_sample=None
+):
+    """Like the in-memory path of :py:func:`~process_dataset`, but the merged
+    dataframe and each facet output are stored in an
+    :py:class:`~atlas_core.ingestion_cache.IngestionCache`, keyed by hashes of
+    the raw data and of the config and classifications they depend on. Only
+    what's missing from the cache gets computed.
+
+    The raw data is hashed after reading it, unless the dataset config has an
+    "input_hash" (a string, or a function returning one, e.g. based on the
+    file's modification time). In that case, the raw file doesn't even get
+    read if everything else is cached."""
+
+    input_hash = dataset.get("input_hash", None)
+    if callable(input_hash):
+        input_hash = input_hash()
+
+    def uncached(chunks):
+        warn("Caching isn't supported for chunked datasets, ignoring cache.")
+        return compute_facets_chunked(
+            chunks,
+            dataset,
+            executor=executor,
+            workers=workers,
+            check_sample=check_sample,
+        )
+
+    data = None
+    if input_hash is None:
+        data = dataset["read_function"]()
+        if not isinstance(data, pd.DataFrame):
+            return uncached(data)
+        input_hash = hash_object(data)
+
+    merge_key = hash_object([input_hash, merge_config(dataset, low_memory)])
+    facet_keys = {
+        facet_fields: hash_object([merge_key, facet_fields, aggregations])
+        for facet_fields, aggregations in dataset["facets"].items()
+    }
+
+    facet_outputs = {
+        facet_fields: cache.get("facet", key)
+        for facet_fields, key in facet_keys.items()
+    }
+    missing_facets = {
+        facet_fields: dataset["facets"][facet_fields]
+        for facet_fields, output in facet_outputs.items()
+        if output is None
+    }
+
+    if len(missing_facets) == 0:
+        good("Using cached facets.")
+        return facet_outputs
+
+    df = cache.get("merged", merge_key)
+    if df is None:
+        if data is None:
+            data = dataset["read_function"]()
+            if not isinstance(data, pd.DataFrame):
+                return uncached(data)
+        df = cache.put(
+            "merged",
+            merge_key,
+            prepare_dataset(data, dataset, low_memory, check_sample=check_sample),
+        )
+        del data
+    else:
+        good("Using cached merged dataset.")
+
+    good(
+        "Using {} cached facets, computing {}.".format(
+            len(facet_outputs) - len(missing_facets), len(missing_facets)
+        )
+    )
+    computed = compute_facets(df, missing_facets, executor=executor, workers=workers)
+    for facet_fields, output in computed.items():
+        facet_outputs[facet_fields] = cache.put(
+            "facet", facet_keys[facet_fields], output
+        )
+
+    return facet_outputs
+
+
+def process_dataset(
+    dataset,
+    facet_executor=None,
+    facet_workers=None,
+    cache=None,
+    low_memory=False,
+    check_sample=None,
+):
+    """Clean up a raw dataset, merge in classification ids and compute its
+    facets and classification aggregations. See
+    :py:func:`~compute_facets` for `facet_executor` and `facet_workers`.
+
+    If `dataset["read_function"]()` returns an iterable of dataframes instead
+    of a single one, the dataset is processed in chunks, see
+    :py:func:`~compute_facets_chunked`.
+
+    Pass an :py:class:`~atlas_core.ingestion_cache.IngestionCache` as `cache`
+    to reuse intermediate results from previous runs, see
+    :py:func:`~compute_facets_cached`.
+
+    Pass `low_memory=True` to shrink dtypes early and avoid intermediate
+    copies, see :py:func:`~prepare_dataset`. Chunked datasets ignore it,
+    since they only hold one chunk at a time anyway.
+
+    For quick runs during development, pass `check_sample` (e.g. 0.01) to
+    run data checks on a stratified sample of the rows instead of all of
+    them, see :py:func:`~check_dataset`. Leave it out for release builds."""
+
+    puts("=" * 80)
+    good("Processing a new dataset!")
+
+    if cache is not None:
+        facet_outputs = compute_facets_cached(
+            dataset,
+            cache,
+            executor=facet_executor,
+            workers=facet_workers,
+            low_memory=low_memory,
+            check_sample=check_sample,
+        )
+    else:
+        # Read dataset and fix up columns
+        data = dataset["read_function"]()
+
+        if isinstance(data, pd.DataFrame):
+            df = prepare_dataset(
+                data, dataset, low_memory=low_memory, check_sample=check_sample
+            )
+            del data
+
+            # Gather each facet dataset (e.g. DY, PY, DPY variables from DPY
+            # dataset)
+            facet_outputs = compute_facets(
+                df, dataset["facets"], executor=facet_executor, workers=facet_workers
             )
+            if low_memory:
+                report_memory("facets")
 
-        # Now that we have the new parent ids for every field, perform
-        # aggregation
-        # Newer Pandas requires multiple groupby to be list, not tuple
-        if type(facet) == tuple:
-            agg_df = base_df.groupby(list(facet)).agg(clagg_settings["agg_params"])
         else:
-            agg_df = base_df.groupby(facet).agg(clagg_settings["agg_params"])
-
-        # Add it to the list of classification aggregation results!
-        clagg_outputs[clagg_name] = agg_df
+            good("Processing dataset in chunks.")
+            facet_outputs = compute_facets_chunked(
+                data,
+                dataset,
+                executor=facet_executor,
+                workers=facet_workers,
+                check_sample=check_sample,
+            )
 
-    facet_outputs["classification_aggregations"] = clagg_outputs
+    facet_outputs["classification_aggregations"] = compute_classification_aggregations(
+        facet_outputs, dataset
+    )
 
     puts("Done! ヽ(◔◡◔)ﾉ")
 
@@ -240,7 +869,7 @@ def process_dataset(dataset):
 # [] Merge similar facet data (DY datasets together, etc)
 # [] Function to generate other cross-dataset columns: gdp per capita
 
-# [] Save merged facets into hdf5 file
+# [x] Save merged facets into hdf5 file (see hdf_writer.HDFWriter)
 # [] Load merged facet to given model
 # [] Move classification merging code into classification class:
 # Classification.merge_to_table Classification.merge_index
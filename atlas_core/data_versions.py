@@ -0,0 +1,382 @@
+"""Keep track of which data version (i.e. which database loaded by
+:py:func:`~atlas_core.hdf_to_postgres.multiload`) the app is serving, and
+switch between them without restarting the app."""
+
+import json
+import logging
+import os
+import string
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+from .pool import DEFAULT_WARMUP_CONNECTIONS, warmup_engine
+
+logger = logging.getLogger(__name__)
+
+
+def coerce_data_version(version):
+    """try to coerce a data version string into a valid sql92 database name.
+    according to the standard, db identifiers can only have letters,
+    underscores and digits:
+        https://db.apache.org/derby/docs/10.9/ref/crefsqlj1003454.html"""
+
+    # for name/date-based versions, replace dashes with underscores
+    version_new = version.replace("-", "_")
+
+    # for v2.3.1 style version,s replace dots with underscores
+    version_new = version_new.replace(".", "_")
+
+    valid_chars = set(string.digits + string.ascii_letters + "_")
+    if not all(x in valid_chars for x in version_new):
+        raise ValueError(
+            "Database names can only contain ASCII letters and "
+            "numbers, and the underscore. You provided {} which we "
+            "coerced into {}.".format(version, version_new)
+        )
+
+    return version_new
+
+
+class DataVersionRegistry(object):
+    """A small json file that lists the data versions that have been loaded,
+    and which one of them should currently be served, e.g.:
+
+        {"current": "2019_06_01", "versions": ["2019_01_01", "2019_06_01"]}
+
+    Writes are atomic (write to a temp file and rename) so that a process
+    watching the file never sees half of it."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def read(self):
+        try:
+            with open(self.file_name, "r") as f:
+                contents = json.loads(f.read())
+        except FileNotFoundError:
+            contents = {}
+
+        contents.setdefault("current", None)
+        contents.setdefault("versions", [])
+        return contents
+
+    def write(self, contents):
+        tmp_file_name = self.file_name + ".tmp"
+        with open(tmp_file_name, "w") as f:
+            f.write(json.dumps(contents, indent=4, separators=(",", ": ")))
+        os.replace(tmp_file_name, self.file_name)
+
+    def mtime(self):
+        try:
+            return os.stat(self.file_name).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def current(self):
+        return self.read()["current"]
+
+    @property
+    def versions(self):
+        return self.read()["versions"]
+
+    def add_version(self, version):
+        contents = self.read()
+        version = coerce_data_version(version)
+        if version not in contents["versions"]:
+            contents["versions"].append(version)
+        self.write(contents)
+
+    def set_current(self, version):
+        contents = self.read()
+        version = coerce_data_version(version)
+        if version not in contents["versions"]:
+            raise ValueError(
+                "Data version {} is not in the registry. Available versions: "
+                "{}".format(version, contents["versions"])
+            )
+        contents["current"] = version
+        self.write(contents)
+
+
+class DataVersionRouter(object):
+    """Keeps one pooled engine per data version and hands out the engine for
+    the version currently being served. At most two versions are kept open:
+    the current one and the next one, which can be prepared (and warmed up)
+    in advance. Switching from one to the other is a single attribute
+    assignment, so requests see either the old or the new engine, never a mix.
+
+    The previous engine isn't closed immediately: it's kept around until all
+    of its checked out connections have been returned, so in-flight requests
+    can finish on the data version they started with.
+
+    To use it with flask, call :py:meth:`~DataVersionRouter.init_app`.
+    :py:attr:`atlas_core.core.db` then uses the engine of the current version
+    instead of `SQLALCHEMY_DATABASE_URI`."""
+
+    def __init__(
+        self,
+        base_url,
+        registry=None,
+        engine_kwargs={},
+        warmup_connections=DEFAULT_WARMUP_CONNECTIONS,
+        warmup_hooks=[],
+        engine_hooks=[],
+        poll_interval=5,
+    ):
+        self.base_url = make_url(base_url)
+        self.registry = registry
+        self.engine_kwargs = dict(engine_kwargs)
+        self.warmup_connections = warmup_connections
+        self.warmup_hooks = list(warmup_hooks)
+        self.engine_hooks = list(engine_hooks)
+        self.poll_interval = poll_interval
+
+        self._lock = threading.RLock()
+        # (version, engine) tuple so that both are swapped in a single step
+        self._active = (None, None)
+        self._next = (None, None)
+        self._draining = []
+
+        self._registry_mtime = None
+        self._last_poll = 0
+        # Held while checking the registry and switching, so that only one
+        # thread does that at a time
+        self._poll_lock = threading.Lock()
+        self._switch_thread = None
+        # Process the engines were created in, see poll_registry()
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def version_url(self, version):
+        """Database URL for a data version, derived from the base url. For
+        sqlite, this is a file next to the base database file."""
+        version = coerce_data_version(version)
+        url = make_url(str(self.base_url))
+        if url.drivername.startswith("sqlite"):
+            directory = os.path.dirname(self.base_url.database or "")
+            url.database = os.path.join(directory, version + ".db")
+        else:
+            url.database = version
+        return url
+
+    @property
+    def current(self):
+        return self._active[0]
+
+    @property
+    def next(self):
+        return self._next[0]
+
+    @property
+    def engine(self):
+        """Engine of the version that is currently being served."""
+        return self._active[1]
+
+    def warmup(self, engine):
+        """Open up connections in the pool in advance so the first requests
+        don't pay for connection setup, and run any warmup hooks (e.g. to
+        fill caches). Failing to connect only gets logged, since requests
+        that don't use the database can still be served."""
+        try:
+            warmup_engine(engine, self.warmup_connections)
+        except Exception:
+            logger.exception("Couldn't warm up the connection pool")
+
+        for hook in self.warmup_hooks:
+            hook(engine)
+
+    def prepare(self, version):
+        """Create and warm up an engine for the next data version."""
+        version = coerce_data_version(version)
+
+        with self._lock:
+            if version == self.current:
+                return self.engine
+            if version == self.next:
+                return self._next[1]
+
+        engine = create_engine(self.version_url(version), **self.engine_kwargs)
+        for hook in self.engine_hooks:
+            hook(engine)
+        self.warmup(engine)
+
+        with self._lock:
+            # Only keep one next version around
+            if self._next[1] is not None:
+                self._draining.append(self._next[1])
+            self._next = (version, engine)
+            self.drain()
+
+        logger.info("Prepared data version {}".format(version))
+        return engine
+
+    def switch(self, version):
+        """Atomically start serving a different data version."""
+        version = coerce_data_version(version)
+        if version == self.current:
+            return self.engine
+
+        engine = self.prepare(version)
+
+        with self._lock:
+            old_version, old_engine = self._active
+            self._active = (version, engine)
+            self._next = (None, None)
+            if old_engine is not None:
+                self._draining.append(old_engine)
+            self.drain()
+
+        logger.info("Switched data version from {} to {}".format(old_version, version))
+        return engine
+
+    def set_current(self, version):
+        """Record `version` as the current one in the registry, if there is
+        one, and switch to it. Holds the same lock as
+        :py:meth:`~DataVersionRouter.poll_registry`, so that this doesn't
+        race with a switch it started in the background."""
+        with self._poll_lock:
+            if self.registry is not None:
+                self.registry.set_current(version)
+            return self.switch(version)
+
+    def drain(self):
+        """Dispose of previous engines once no connections are checked out
+        from them anymore."""
+        with self._lock:
+            still_draining = []
+            for engine in self._draining:
+                checkedout = getattr(engine.pool, "checkedout", lambda: 0)
+                if checkedout() == 0:
+                    engine.dispose()
+                else:
+                    still_draining.append(engine)
+            self._draining = still_draining
+
+    def poll_registry(self, force=False):
+        """Switch versions if the registry file says so. Only actually reads
+        the file when its modification time changes, and at most every
+        `poll_interval` seconds once a version is being served.
+
+        Once a version is being served, the next one is prepared and switched
+        to in a background thread, and requests that poll in the meantime
+        don't wait for it. With `force`, or before any version is being
+        served, this switches before returning."""
+        if self.registry is None:
+            return
+
+        if self._pid != os.getpid():
+            self.forget_engines()
+
+        now = time.monotonic()
+        blocking = force or self.current is None
+        if not blocking and now - self._last_poll < self.poll_interval:
+            return
+
+        # Another thread is already checking or switching
+        if not self._poll_lock.acquire(blocking=blocking):
+            return
+
+        in_background = False
+        try:
+            self._last_poll = now
+            mtime = self.registry.mtime()
+            if mtime != self._registry_mtime:
+                version = self.registry.current
+                if version is None or version == self.current:
+                    self._registry_mtime = mtime
+                elif blocking:
+                    self.switch(version)
+                    self._registry_mtime = mtime
+                else:
+                    # The background thread releases the lock when it's done
+                    self._switch_thread = threading.Thread(
+                        target=self._switch_in_background,
+                        args=(version, mtime),
+                        name="data-version-switch",
+                        daemon=True,
+                    )
+                    self._switch_thread.start()
+                    in_background = True
+
+            self.drain()
+        finally:
+            if not in_background:
+                self._poll_lock.release()
+
+    def _switch_in_background(self, version, mtime):
+        try:
+            self.switch(version)
+            self._registry_mtime = mtime
+        except Exception:
+            # Keep serving the current version, and retry on the next poll
+            logger.exception("Couldn't switch to data version {}".format(version))
+        finally:
+            self._poll_lock.release()
+
+    def forget_engines(self):
+        """Stop using engines created in the parent of a forked process. They
+        aren't disposed of, since their connections belong to the parent."""
+        with self._lock:
+            self._inherited.extend(
+                engine
+                for engine in [self._active[1], self._next[1]] + self._draining
+                if engine is not None
+            )
+            self._active = (None, None)
+            self._next = (None, None)
+            self._draining = []
+            self._registry_mtime = None
+            self._pid = os.getpid()
+
+    def init_app(self, app):
+        """Register the router with the flask app so that `db` uses it, and
+        watch the registry file before each request. The first request of
+        each process switches to the current version, so that no
+        connections are opened before gunicorn --preload forks its
+        workers."""
+        app.extensions["data_version_router"] = self
+
+        if self.registry is not None:
+            app.before_request(self.poll_registry)
+
+        return app
+
+
+def register_data_version_endpoint(app, url_pattern="/admin/data_version"):
+    """Register an admin endpoint that shows the served data version on GET,
+    and switches to the one given in the `version` parameter on POST. This
+    does no authentication, so make sure to protect this URL."""
+    from flask import request
+
+    from .helpers.flask import abort
+    from .serializers import get_serializer
+
+    router = app.extensions["data_version_router"]
+
+    def data_version():
+        if request.method == "POST":
+            version = request.values.get("version", None)
+            if version is None:
+                abort(400, message="Specify a data version to switch to.")
+            try:
+                router.set_current(version)
+            except ValueError as exc:
+                abort(400, message=str(exc))
+
+        versions = router.registry.versions if router.registry is not None else []
+        return get_serializer().serialize(
+            data=dict(current=router.current, next=router.next, versions=versions)
+        )
+
+    app.add_url_rule(
+        url_pattern,
+        endpoint="data_version",
+        view_func=data_version,
+        methods=["GET", "POST"],
+    )
+
+    return app
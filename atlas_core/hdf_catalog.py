@@ -0,0 +1,197 @@
+"""A sidecar file next to an ingested .hdf file that records what's in it, so
+loaders don't have to open and scan the whole store every time to find out."""
+
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+#: Bump this when the catalog layout changes so old sidecar files get rebuilt
+CATALOG_VERSION = 1
+
+
+def catalog_file_name(file_name):
+    return file_name + ".catalog.json"
+
+
+def file_signature(file_name):
+    """Modification time and size of a file. If either changes, the catalog
+    is stale."""
+    stat = os.stat(file_name)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def leaf_size(leaf):
+    try:
+        return leaf.size_on_disk
+    except NotImplementedError:
+        # e.g. VLArrays that fixed format uses for object columns
+        return leaf.size_in_memory
+
+
+def node_size(store, key):
+    """Bytes taken up on disk by an HDF key, including all its sub-nodes."""
+    node = store.get_node(key)
+    if hasattr(node, "_f_walknodes"):
+        return int(sum(leaf_size(leaf) for leaf in node._f_walknodes("Leaf")))
+    return int(leaf_size(node))
+
+
+def scan_table(store, key, chunksize=10 ** 6):
+    """Read through an HDF key once, returning its row count, column dtypes
+    and a hash of its contents (including column names, dtypes and index)."""
+    storer = store.get_storer(key)
+    if storer.is_table:
+        chunks = store.select(key, chunksize=chunksize, iterator=True)
+    else:
+        chunks = [store.select(key)]
+
+    content_hash = hashlib.sha1()
+    nrows = 0
+    dtypes = None
+
+    for df in chunks:
+        if dtypes is None:
+            dtypes = {str(column): str(dtype) for column, dtype in df.dtypes.items()}
+            content_hash.update(json.dumps(dtypes, sort_keys=True).encode("utf-8"))
+        content_hash.update(hash_pandas_object(df, index=True).values.tobytes())
+        nrows += df.shape[0]
+
+    return nrows, dtypes or {}, content_hash.hexdigest()
+
+
+class HDFCatalog(object):
+    """Per-key row count, dtypes, byte size, `atlas_metadata` and content hash
+    of an HDF file. Use :py:meth:`~HDFCatalog.load` to get one: it reuses the
+    sidecar file as long as the HDF file's mtime and size haven't changed,
+    and otherwise rebuilds it with a single pass over the store."""
+
+    def __init__(self, file_name, tables, signature=None, data_info=None):
+        self.file_name = file_name
+        self.tables = tables
+        self.signature = signature
+        self.data_info = data_info or {}
+
+    @classmethod
+    def build(cls, file_name, chunksize=10 ** 6, data_info_key="/data_info"):
+        signature = file_signature(file_name)
+        tables = {}
+        data_info = {}
+
+        with pd.HDFStore(file_name, mode="r") as store:
+            for key in store.keys():
+                storer = store.get_storer(key)
+                nrows, dtypes, content_hash = scan_table(store, key, chunksize)
+                tables[key] = {
+                    "nrows": nrows,
+                    "dtypes": dtypes,
+                    "bytes": node_size(store, key),
+                    "atlas_metadata": getattr(storer.attrs, "atlas_metadata", None),
+                    "hash": content_hash,
+                }
+
+            # Keep the (tiny) data info table around so we don't have to open
+            # the store to find out the data version
+            if data_info_key in tables:
+                info_df = store.select(data_info_key)
+                data_info = dict(zip(info_df["key"], info_df["value"].astype(str)))
+
+        return cls(file_name, tables, signature=signature, data_info=data_info)
+
+    @classmethod
+    def load(cls, file_name, rebuild=False, **kwargs):
+        """Load the catalog from the sidecar file if it's still up to date,
+        or build and save a new one."""
+        sidecar = catalog_file_name(file_name)
+
+        if not rebuild and os.path.exists(sidecar):
+            with open(sidecar, "r") as f:
+                contents = json.loads(f.read())
+            if contents.get("catalog_version") == CATALOG_VERSION and contents.get(
+                "signature"
+            ) == file_signature(file_name):
+                return cls(
+                    file_name,
+                    contents["tables"],
+                    signature=contents["signature"],
+                    data_info=contents["data_info"],
+                )
+
+        catalog = cls.build(file_name, **kwargs)
+        catalog.save()
+        return catalog
+
+    def save(self):
+        contents = {
+            "catalog_version": CATALOG_VERSION,
+            "signature": self.signature,
+            "data_info": self.data_info,
+            "tables": self.tables,
+        }
+        sidecar = catalog_file_name(self.file_name)
+        with open(sidecar + ".tmp", "w") as f:
+            f.write(json.dumps(contents, indent=4, separators=(",", ": "), default=str))
+        os.replace(sidecar + ".tmp", sidecar)
+
+    @property
+    def data_version(self):
+        return self.data_info.get("output_data_version", None)
+
+    def metadata(self, key):
+        return self.tables[key]["atlas_metadata"]
+
+    def hdf_metadata(self, keys=None, metadata_keys=[]):
+        """Same output as pandas_to_postgres.hdf_metadata(), without opening
+        the HDF file: a mapping of sql table name to set of HDF keys, and a
+        mapping of each of `metadata_keys` to its value per HDF key."""
+        sql_to_hdf = defaultdict(set)
+        metadata_vars = defaultdict(dict)
+
+        for key in keys or self.tables.keys():
+            metadata = self.metadata(key)
+            if metadata is None:
+                continue
+
+            for metadata_key in metadata_keys:
+                metadata_vars[metadata_key][key] = metadata.get(metadata_key)
+
+            sql_table = metadata.get("sql_table_name", None)
+            if sql_table:
+                sql_to_hdf[sql_table].add(key)
+
+        return sql_to_hdf, metadata_vars
+
+    def table_sizes(self, keys=None):
+        """Total bytes per sql table, for scheduling the biggest loads
+        first."""
+        sql_to_hdf, _ = self.hdf_metadata(keys)
+        return {
+            sql_table: sum(self.tables[key]["bytes"] for key in hdf_keys)
+            for sql_table, hdf_keys in sql_to_hdf.items()
+        }
+
+    def content_hashes(self):
+        return {key: table["hash"] for key, table in self.tables.items()}
+
+    def diff(self, previous_hashes, keys=None):
+        """Compare against the content hashes of a previous load. Returns the
+        sql tables whose HDF keys are all unchanged (and so can be reused
+        as-is), and the HDF keys that need to be loaded again. An sql table
+        fed by several HDF keys is reloaded whole if any of them changed."""
+        sql_to_hdf, _ = self.hdf_metadata(keys)
+
+        unchanged_tables = set()
+        changed_keys = []
+        for sql_table, hdf_keys in sql_to_hdf.items():
+            if all(
+                previous_hashes.get(key, None) == self.tables[key]["hash"]
+                for key in hdf_keys
+            ):
+                unchanged_tables.add(sql_table)
+            else:
+                changed_keys.extend(sorted(hdf_keys))
+
+        return unchanged_tables, changed_keys
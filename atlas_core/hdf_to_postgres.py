@@ -1,20 +1,22 @@
+import logging
+
 from atlas_core import db
+from atlas_core.data_versions import coerce_data_version, DataVersionRegistry
+from atlas_core.data_import import (
+    loaded_table_hashes,
+    read_table_hashes,
+    write_table_hashes,
+    reusable_tables,
+)
 from multiprocessing import Pool
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import create_engine
 from sqlalchemy.engine.url import make_url
-import string
-from pandas_to_postgres import (
-    HDFTableCopy,
-    SmallHDFTableCopy,
-    BigHDFTableCopy,
-    cast_pandas,
-    hdf_metadata,
-    copy_worker,
-    get_logger,
-)
+from tempfile import TemporaryFile
 
-logger = get_logger("hdf_to_postgres")
+# pandas_to_postgres pulls in pandas, so it's imported only once a load
+# starts. Its get_logger() configures this same logger then.
+logger = logging.getLogger("hdf_to_postgres")
 
 
 def add_level_metadata(df, copy_obj, hdf_table, **kwargs):
@@ -44,6 +46,8 @@ def add_level_metadata(df, copy_obj, hdf_table, **kwargs):
 def create_table_objects(
     file_name, sql_to_hdf, csv_chunksize=10 ** 6, hdf_chunksize=10 ** 7, hdf_meta=None
 ):
+    from pandas_to_postgres import HDFTableCopy, SmallHDFTableCopy, BigHDFTableCopy
+
     classifications = []
     partners = []
     other = []
@@ -99,11 +103,23 @@ def hdf_to_postgres(
     maintenance_work_mem="1GB",
     hdf_chunksize: int = 10 ** 7,
     csv_chunksize: int = 10 ** 6,
+    catalog=None,
 ):
+    from pandas_to_postgres import cast_pandas, hdf_metadata, copy_worker, get_logger
 
-    sql_to_hdf, metadata_vars = hdf_metadata(
-        file_name, keys=keys, metadata_attr="atlas_metadata", metadata_keys=["levels"]
-    )
+    get_logger("hdf_to_postgres")
+
+    if catalog is not None:
+        sql_to_hdf, metadata_vars = catalog.hdf_metadata(
+            keys=keys, metadata_keys=["levels"]
+        )
+    else:
+        sql_to_hdf, metadata_vars = hdf_metadata(
+            file_name,
+            keys=keys,
+            metadata_attr="atlas_metadata",
+            metadata_keys=["levels"],
+        )
 
     classifications, tables = create_table_objects(
         file_name,
@@ -113,6 +129,12 @@ def hdf_to_postgres(
         hdf_meta=metadata_vars,
     )
 
+    # With sizes known up front, start the biggest tables first so they don't
+    # end up running alone at the end of the pool
+    if catalog is not None:
+        table_sizes = catalog.table_sizes(keys=keys)
+        tables.sort(key=lambda t: table_sizes.get(t.sql_table, 0), reverse=True)
+
     # Copy classifications first, not multiprocessed
     def coerce_classification(
         df, column_map={"index": "id"}, drop_cols=["name"], **kwargs
@@ -150,27 +172,30 @@ def hdf_to_postgres(
         result.get()
 
 
-def coerce_data_version(version):
-    """try to coerce a data version string into a valid sql92 database name.
-    according to the standard, db identifiers can only have letters,
-    underscores and digits:
-        https://db.apache.org/derby/docs/10.9/ref/crefsqlj1003454.html"""
-
-    # for name/date-based versions, replace dashes with underscores
-    version_new = version.replace("-", "_")
+def copy_table_between_databases(source_engine, dest_engine, table_name, columns):
+    """Copy a table from one postgres database to another with binary COPY,
+    without going through pandas."""
+    columns = ", ".join(f'"{column}"' for column in columns)
 
-    # for v2.3.1 style version,s replace dots with underscores
-    version_new = version_new.replace(".", "_")
+    with TemporaryFile() as buf:
+        source_conn = source_engine.raw_connection()
+        try:
+            source_conn.cursor().copy_expert(
+                f'COPY "{table_name}" ({columns}) TO STDOUT WITH (FORMAT binary)', buf
+            )
+        finally:
+            source_conn.close()
 
-    valid_chars = set(string.digits + string.ascii_letters + "_")
-    if not all(x in valid_chars for x in version_new):
-        raise ValueError(
-            "Database names can only contain ASCII letters and "
-            "numbers, and the underscore. You provided {} which we "
-            "coerced into {}.".format(version, version_new)
-        )
+        buf.seek(0)
 
-    return version_new
+        dest_conn = dest_engine.raw_connection()
+        try:
+            dest_conn.cursor().copy_expert(
+                f'COPY "{table_name}" ({columns}) FROM STDIN WITH (FORMAT binary)', buf
+            )
+            dest_conn.commit()
+        finally:
+            dest_conn.close()
 
 
 def multiload(
@@ -183,9 +208,37 @@ def multiload(
     hdf_chunksize=10 ** 7,
     csv_chunksize=10 ** 6,
     data_info_key="data_info",
+    registry_file=None,
+    catalog=None,
+    previous_db_name=None,
 ):
+    """Load an HDF file into a new postgres database named after its data
+    version. If `registry_file` is given, the new version is recorded in that
+    :py:class:`~atlas_core.data_versions.DataVersionRegistry` once the load is
+    done, so that apps can switch to it.
+
+    If an :py:class:`~atlas_core.hdf_catalog.HDFCatalog` is given, the data
+    version, table metadata and sizes are taken from it instead of the HDF
+    file, and the content hash of each HDF key is recorded in the new
+    database.
+
+    If `previous_db_name` is given, only HDF keys whose content hashes differ
+    from the ones recorded in that database are loaded from the HDF file.
+    All other tables are copied over from the previous database."""
+
+    from pandas_to_postgres import get_logger
+
+    get_logger("hdf_to_postgres")
+
+    if previous_db_name is not None and catalog is None:
+        from atlas_core.hdf_catalog import HDFCatalog
+
+        catalog = HDFCatalog.load(file_name)
 
     # Fetch database name from data version
+    if new_db_name is None and catalog is not None:
+        new_db_name = catalog.data_version
+
     if new_db_name is None:
         import pandas as pd
 
@@ -227,13 +280,61 @@ def multiload(
     load_engine = create_engine(load_url)
     db.metadata.create_all(load_engine)
 
-    # Load data into schema
-    hdf_to_postgres(
-        file_name=file_name,
-        keys=keys,
-        processes=processes,
-        engine_args=[load_url],
-        maintenance_work_mem=maintenance_work_mem,
-        hdf_chunksize=hdf_chunksize,
-        csv_chunksize=csv_chunksize,
-    )
+    # For incremental loads, find the tables we can reuse from the previous
+    # version, and only load the rest
+    reusable = {}
+    if previous_db_name is not None:
+        previous_url = make_url(str(engine.url))
+        previous_url.database = coerce_data_version(previous_db_name)
+        previous_engine = create_engine(str(previous_url))
+
+        previous_hashes = read_table_hashes(previous_engine)
+        reusable, keys = reusable_tables(
+            catalog, previous_hashes, previous_engine, load_engine, keys=keys
+        )
+        logger.info(f"Reusing {len(reusable)} unchanged tables from {previous_db_name}")
+        logger.info(f"Loading {len(keys)} changed HDF tables")
+
+        sql_to_hdf, _ = catalog.hdf_metadata()
+        is_classification = {
+            table_name: any("classifications/" in key for key in sql_to_hdf[table_name])
+            for table_name in reusable
+        }
+
+    def copy_reusable(classifications):
+        for table_name, columns in reusable.items():
+            if is_classification[table_name] == classifications:
+                logger.info(f"Copying unchanged table {table_name}")
+                copy_table_between_databases(
+                    previous_engine, load_engine, table_name, columns
+                )
+
+    # Classifications go in first, since the data tables refer to them
+    copy_reusable(classifications=True)
+
+    # Load data into schema. An empty list of keys would mean all keys, so
+    # skip if nothing changed.
+    if keys is None or len(keys) > 0:
+        hdf_to_postgres(
+            file_name=file_name,
+            keys=keys,
+            processes=processes,
+            engine_args=[load_url],
+            maintenance_work_mem=maintenance_work_mem,
+            hdf_chunksize=hdf_chunksize,
+            csv_chunksize=csv_chunksize,
+            catalog=catalog,
+        )
+
+    copy_reusable(classifications=False)
+
+    if catalog is not None:
+        # Only the keys that are actually in the new database
+        loaded_keys = set(catalog.tables) if keys is None else set(keys)
+        for table_name in reusable:
+            loaded_keys |= set(sql_to_hdf[table_name])
+        write_table_hashes(load_engine, loaded_table_hashes(catalog, loaded_keys))
+
+    if registry_file is not None:
+        DataVersionRegistry(registry_file).add_version(new_db_name)
+        logger.info(f"Added {new_db_name} to data version registry {registry_file}")
@@ -0,0 +1,275 @@
+"""Write the outputs of :py:func:`~atlas_core.data_ingestion.process_dataset`
+and the classification tables into an HDF file laid out the way
+:py:func:`~atlas_core.data_import.import_data` expects: one table per key
+with an `atlas_metadata` attribute, classifications under
+/classifications/, and a /data_info table with the data version."""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+#: Compressors that PyTables supports, see tables.filters.all_complibs
+COMPLIBS = [
+    "zlib",
+    "lzo",
+    "bzip2",
+    "blosc",
+    "blosc:blosclz",
+    "blosc:lz4",
+    "blosc:lz4hc",
+    "blosc:snappy",
+    "blosc:zlib",
+    "blosc:zstd",
+]
+
+#: Settings compared by :py:func:`~benchmark_hdf_settings` by default
+BENCHMARK_SETTINGS = [
+    {"complib": None, "complevel": 0},
+    {"complib": "zlib", "complevel": 1},
+    {"complib": "zlib", "complevel": 5},
+    {"complib": "blosc:lz4", "complevel": 5},
+    {"complib": "blosc:zstd", "complevel": 5},
+    {"complib": "blosc", "complevel": 9},
+]
+
+
+def facet_levels(dataset, facet_fields, agg_fields={}):
+    """Find the classification level of each entity in a facet, e.g.
+    {"product": "4digit", "location": "department"}, taking into account the
+    levels that a classification aggregation rolled fields up to."""
+    if isinstance(facet_fields, str):
+        facet_fields = [facet_fields]
+
+    levels = {}
+    for field in facet_fields:
+        if not field.endswith("_id"):
+            continue
+        entity = field[:-3]
+        if field in agg_fields:
+            levels[entity] = agg_fields[field]
+        elif entity in dataset["classification_fields"]:
+            levels[entity] = dataset["classification_fields"][entity]["level"]
+    return levels
+
+
+def plain_columns(df):
+    """Turn a facet output into a plain table: index fields become columns,
+    and categoricals are replaced by their values so they load into sql as
+    regular ints / strings."""
+    df = df.reset_index()
+    for column in df.columns:
+        if pd.api.types.is_categorical_dtype(df[column]):
+            df[column] = np.asarray(df[column])
+    return df
+
+
+class HDFWriter(object):
+    """Writes tables into an HDF file along with the `atlas_metadata`
+    attribute that tells loaders which sql table each one goes into.
+
+    Use it as a context manager:
+
+        with HDFWriter("data.h5", complib="blosc:lz4", complevel=5) as writer:
+            writer.write_classification("product", product_df)
+            writer.write_dataset(outputs, dataset, table_names)
+            writer.write_data_info({"output_data_version": "2019_06_01"})
+
+    `complib` and `complevel` pick the compressor (any of
+    :py:data:`~COMPLIBS`, or None) and its level (0-9). Tables are appended
+    `chunksize` rows at a time. HDF5 chunk shape is chosen by PyTables from
+    `expectedrows`, so pass a larger one for bigger chunks (better
+    compression and sequential reads) or a smaller one for smaller chunks.
+    Leave it as None to use each table's row count. Use
+    :py:func:`~benchmark_hdf_settings` to compare settings on real data."""
+
+    def __init__(
+        self,
+        file_name,
+        mode="w",
+        complib="blosc:lz4",
+        complevel=5,
+        chunksize=10 ** 6,
+        expectedrows=None,
+    ):
+        if complib is not None and complib not in COMPLIBS:
+            raise ValueError(
+                "complib must be one of {}, you gave {}".format(COMPLIBS, complib)
+            )
+        if not 0 <= complevel <= 9:
+            raise ValueError("complevel must be between 0 and 9")
+
+        self.file_name = file_name
+        self.mode = mode
+        self.complib = complib
+        self.complevel = complevel
+        self.chunksize = chunksize
+        self.expectedrows = expectedrows
+        self.store = None
+
+    def __enter__(self):
+        self.store = pd.HDFStore(
+            self.file_name,
+            mode=self.mode,
+            complib=self.complib,
+            complevel=self.complevel,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self.store.close()
+        self.store = None
+
+    def set_metadata(self, key, sql_table_name, levels=None):
+        metadata = {"sql_table_name": sql_table_name}
+        if levels:
+            metadata["levels"] = levels
+        self.store.get_storer(key).attrs.atlas_metadata = metadata
+
+    def write_table(self, key, data, sql_table_name, levels=None, overwrite=False):
+        """Write a dataframe, or an iterable of dataframe chunks, into a
+        table format HDF key. `levels` adds an `<entity>_level` column with
+        the given value when loading, e.g. {"product": "4digit"}.
+
+        Raises ValueError if the key is already in the file, whether it was
+        written earlier on or was there before opening it with mode "a",
+        unless `overwrite` is set."""
+        if key in self.store:
+            if not overwrite:
+                raise ValueError(
+                    "{} is already in {}, pass overwrite=True to replace "
+                    "it.".format(key, self.file_name)
+                )
+            self.store.remove(key)
+
+        if isinstance(data, pd.DataFrame):
+            expectedrows = self.expectedrows or data.shape[0]
+            data = [data]
+        else:
+            expectedrows = self.expectedrows
+
+        for chunk in data:
+            self.store.append(
+                key,
+                chunk,
+                format="table",
+                index=False,
+                chunksize=self.chunksize,
+                expectedrows=expectedrows,
+            )
+
+        self.set_metadata(key, sql_table_name, levels)
+
+    def write_classification(self, name, df, sql_table_name=None, overwrite=False):
+        """Write a classification table (e.g. linnaeus' product classification
+        dataframe) under /classifications/<name>. The index becomes the "id"
+        column when loading."""
+        df = df.copy()
+        df.index.name = "index"
+        self.write_table(
+            "/classifications/" + name,
+            df.reset_index(),
+            sql_table_name or name,
+            overwrite=overwrite,
+        )
+
+    def write_facet(self, key, df, sql_table_name, levels=None, overwrite=False):
+        self.write_table(
+            key, plain_columns(df), sql_table_name, levels, overwrite=overwrite
+        )
+
+    def write_dataset(
+        self, facet_outputs, dataset, table_names, prefix="/", overwrite=False
+    ):
+        """Write the outputs of process_dataset(). `table_names` maps facets
+        (e.g. ("location_id", "year")) and classification aggregation names
+        to the sql table they go into. Outputs not in `table_names` are
+        skipped. Keys are named after the sql table and the levels, so
+        several levels can go into the same sql table, but two outputs with
+        the same table and levels raise a ValueError before anything gets
+        written. `overwrite` replaces keys that are already in the file."""
+        clagg_outputs = facet_outputs.get("classification_aggregations", {})
+        clagg_settings = dataset.get("classification_aggregations", {})
+
+        # key -> (output name, dataframe, sql table, levels)
+        outputs = {}
+        for name, df in list(facet_outputs.items()) + list(clagg_outputs.items()):
+            if name == "classification_aggregations" or name not in table_names:
+                continue
+
+            if name in clagg_outputs:
+                levels = facet_levels(
+                    dataset,
+                    clagg_settings[name]["facet"],
+                    clagg_settings[name]["agg_fields"],
+                )
+            else:
+                levels = facet_levels(dataset, name)
+
+            sql_table_name = table_names[name]
+            key = prefix + "_".join(
+                [sql_table_name] + [levels[entity] for entity in sorted(levels)]
+            )
+            if key in outputs:
+                raise ValueError(
+                    "{} and {} would both be written to {}.".format(
+                        outputs[key][0], name, key
+                    )
+                )
+            outputs[key] = (name, df, sql_table_name, levels)
+
+        for key, (name, df, sql_table_name, levels) in outputs.items():
+            self.write_facet(key, df, sql_table_name, levels, overwrite=overwrite)
+
+        return list(outputs.keys())
+
+    def write_data_info(self, info, key="/data_info"):
+        """Write the key / value table that loaders get the data version
+        (`output_data_version`) from."""
+        info_df = pd.DataFrame(
+            {"key": list(info.keys()), "value": [str(x) for x in info.values()]}
+        )
+        self.store.put(key, info_df, format="table")
+
+
+def benchmark_hdf_settings(
+    df, settings=BENCHMARK_SETTINGS, directory=None, chunksize=10 ** 6, repeat=3
+):
+    """Write and read back a dataframe with each of the given
+    :py:class:`~HDFWriter` settings (complib, complevel, expectedrows), and
+    return a dataframe of the best write and read times in seconds and the
+    file size in bytes for each. Use a realistic facet output, since
+    compression ratios depend a lot on the data."""
+    results = []
+    directory = tempfile.mkdtemp() if directory is None else directory
+
+    for i, setting in enumerate(settings):
+        file_name = os.path.join(directory, "benchmark_{}.h5".format(i))
+        write_times = []
+        read_times = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with HDFWriter(file_name, chunksize=chunksize, **setting) as writer:
+                writer.write_table("/benchmark", df, "benchmark")
+            write_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with pd.HDFStore(file_name, mode="r") as store:
+                for _ in store.select("/benchmark", chunksize=chunksize):
+                    pass
+            read_times.append(time.perf_counter() - start)
+
+        results.append(
+            dict(
+                setting,
+                write_seconds=min(write_times),
+                read_seconds=min(read_times),
+                file_bytes=os.path.getsize(file_name),
+            )
+        )
+        os.remove(file_name)
+
+    return pd.DataFrame(results)
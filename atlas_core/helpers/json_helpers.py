@@ -2,7 +2,11 @@
 python standard library json."""
 
 import json
+import os
+import re
+import shutil
 from collections import OrderedDict
+from contextlib import suppress
 
 
 def add_preamble(file_name, key="data"):
@@ -25,3 +29,191 @@ def json_read(file_name):
     """Read a json file while maintaining record order."""
     with open(file_name, "r+") as f:
         return json.loads(f.read(), object_pairs_hook=OrderedDict)
+
+
+NON_WHITESPACE = re.compile(r"\S")
+#: Anything that can't be part of a number or of true / false / null
+SCALAR_END = re.compile(r"[^0-9a-zA-Z+\-.]")
+
+
+class JSONStreamReader(object):
+    """Reads a JSON document from a file piece by piece, so that big arrays
+    (e.g. millions of records) never have to be in memory all at once.
+
+    Walk the document with :py:meth:`~JSONStreamReader.iter_object` and
+    :py:meth:`~JSONStreamReader.iter_array`, which stop at each key / element
+    so you can then :py:meth:`~JSONStreamReader.decode` it,
+    :py:meth:`~JSONStreamReader.skip` it, iterate further into it, or
+    :py:meth:`~JSONStreamReader.copy` it to another file. Each key / element
+    has to be consumed before moving on to the next one:
+
+        reader = JSONStreamReader(f)
+        for key in reader.iter_object():
+            if key == "edges":
+                for _ in reader.iter_array():
+                    record = reader.decode()
+            else:
+                reader.skip()
+
+    Array elements are decoded whole, so they should be small-ish (e.g.
+    records), but arrays and objects containing them are streamed."""
+
+    def __init__(self, f, buffer_size=2 ** 20):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+    def fill(self):
+        """Read the next chunk of the file, dropping what's been consumed.
+        Returns False at the end of the file."""
+        chunk = self.f.read(self.buffer_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            match = NON_WHITESPACE.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError(
+                "Expected one of {!r} in JSON, got {!r}".format(list(chars), char)
+            )
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """Decode the next value whole."""
+        char = self.peek()
+
+        # Numbers and literals don't say where they end, so make sure the
+        # buffer has the end of one before decoding, else e.g. 1.25 split
+        # across chunks would decode as 1
+        if char is not None and char not in '[{"':
+            while not SCALAR_END.search(self.buffer, self.pos):
+                if not self.fill():
+                    break
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+    def iter_object(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def skip(self):
+        char = self.peek()
+        if char == "[":
+            for _ in self.iter_array():
+                self.decode()
+        elif char == "{":
+            for _ in self.iter_object():
+                self.skip()
+        else:
+            self.decode()
+
+    def copy(self, out):
+        """Write the next value to a file object, streaming through arrays
+        and objects."""
+        char = self.peek()
+        if char == "[":
+            out.write("[")
+            for i, _ in enumerate(self.iter_array()):
+                out.write(",\n" if i > 0 else "\n")
+                out.write(json.dumps(self.decode()))
+            out.write("\n]")
+        elif char == "{":
+            out.write("{")
+            for i, key in enumerate(self.iter_object()):
+                out.write(",\n" if i > 0 else "\n")
+                out.write(json.dumps(key) + ": ")
+                self.copy(out)
+            out.write("\n}")
+        else:
+            out.write(json.dumps(self.decode()))
+
+
+def iter_json_records(file_name, field, buffer_size=2 ** 20):
+    """Yield the elements of the array under `field` in a JSON object file
+    one at a time, e.g. the edges of a network file."""
+    with open(file_name, "r") as f:
+        reader = JSONStreamReader(f, buffer_size)
+        for key in reader.iter_object():
+            if key == field:
+                for _ in reader.iter_array():
+                    yield reader.decode()
+            else:
+                reader.skip()
+
+
+def add_preamble_streaming(file_name, key="data", buffer_size=2 ** 20):
+    """Same as :py:func:`~add_preamble`, but copies the file over in chunks
+    instead of loading it, and leaves its formatting alone."""
+    tmp_file_name = file_name + ".tmp"
+    with open(file_name, "r") as f, open(tmp_file_name, "w") as out:
+        out.write("{" + json.dumps(key) + ": ")
+        shutil.copyfileobj(f, out, buffer_size)
+        out.write("}\n")
+    os.replace(tmp_file_name, file_name)
+
+
+def strip_preamble_streaming(file_name, key="data"):
+    """Same as :py:func:`~strip_preamble`, but streams the value under `key`
+    into a new file without loading the whole document."""
+    tmp_file_name = file_name + ".tmp"
+    try:
+        with open(file_name, "r") as f, open(tmp_file_name, "w") as out:
+            reader = JSONStreamReader(f)
+            for this_key in reader.iter_object():
+                if this_key == key:
+                    reader.copy(out)
+                    break
+                reader.skip()
+            else:
+                raise KeyError(key)
+            out.write("\n")
+    except Exception:
+        # Opening the input may have failed before the tmp file got created
+        with suppress(FileNotFoundError):
+            os.remove(tmp_file_name)
+        raise
+    os.replace(tmp_file_name, file_name)
@@ -1,10 +1,18 @@
+import numpy as np
 import pandas as pd
 import json
 
 from . import json_helpers as j
 
 
-def read_network(file_name, nodes_field="nodes", edges_field="edges"):
+def read_network(file_name, nodes_field="nodes", edges_field="edges", chunksize=None):
+    """Read a network json file into nodes and edges dataframes, and a dict of
+    any other fields. With `chunksize`, the file is parsed incrementally and
+    records are turned into dataframes `chunksize` at a time, instead of
+    holding all of them as dicts at once."""
+    if chunksize is not None:
+        return read_network_chunked(file_name, nodes_field, edges_field, chunksize)
+
     network = j.json_read(file_name)
     nodes = network[nodes_field]
     edges = network[edges_field]
@@ -19,6 +27,33 @@ def read_network(file_name, nodes_field="nodes", edges_field="edges"):
     )
 
 
+def read_records_chunked(reader, chunksize):
+    chunks = []
+    records = []
+    for _ in reader.iter_array():
+        records.append(reader.decode())
+        if len(records) == chunksize:
+            chunks.append(pd.DataFrame.from_records(records))
+            records = []
+    if records or not chunks:
+        chunks.append(pd.DataFrame.from_records(records))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_network_chunked(file_name, nodes_field, edges_field, chunksize):
+    frames = {}
+    other_fields = {}
+    with open(file_name, "r") as f:
+        reader = j.JSONStreamReader(f)
+        for key in reader.iter_object():
+            if key in [nodes_field, edges_field]:
+                frames[key] = read_records_chunked(reader, chunksize)
+            else:
+                other_fields[key] = reader.decode()
+
+    return frames[nodes_field], frames[edges_field], other_fields
+
+
 def to_records(df):
     """Replacement for pandas' to_dict(orient="records") which has issues with
     upcasting ints to floats in the case of other floats being there.
@@ -28,16 +63,114 @@ def to_records(df):
     return json.loads(df.to_json(orient="records"))
 
 
+def write_records(f, df, chunksize=10 ** 5):
+    """Write a dataframe as a json array of records, one per line, straight
+    from to_json() `chunksize` rows at a time."""
+    f.write("[")
+    for start in range(0, df.shape[0], chunksize):
+        chunk = df.iloc[start : start + chunksize].to_json(orient="records", lines=True)
+        f.write(",\n" if start > 0 else "\n")
+        # Newlines inside of values are escaped, so these are between records
+        f.write(chunk.rstrip("\n").replace("\n", ",\n"))
+    f.write("\n]")
+
+
 def write_network(
-    file_name, nodes, edges, other_fields=None, nodes_field="nodes", edges_field="edges"
+    file_name,
+    nodes,
+    edges,
+    other_fields=None,
+    nodes_field="nodes",
+    edges_field="edges",
+    chunksize=10 ** 5,
 ):
+    """Write a network json file, serializing nodes and edges directly from
+    the dataframes in chunks of `chunksize` rows."""
     with open(file_name, "w") as f:
-        network = {}
-        network[nodes_field] = to_records(nodes)
-        network[edges_field] = to_records(edges)
+        f.write("{\n" + json.dumps(nodes_field) + ": ")
+        write_records(f, nodes, chunksize)
+        f.write(",\n" + json.dumps(edges_field) + ": ")
+        write_records(f, edges, chunksize)
         if other_fields is not None:
-            network.update(other_fields)
-        f.write(json.dumps(network, indent=4, separators=(",", ": ")))
+            for key, value in other_fields.items():
+                if key in [nodes_field, edges_field]:
+                    continue
+                f.write(",\n" + json.dumps(key) + ": ")
+                f.write(json.dumps(value, indent=4, separators=(",", ": ")))
+        f.write("\n}\n")
+
+
+class IdTranslation(object):
+    """Translates old ids to new ones with a single array lookup. If the old
+    ids are small non-negative ints, this is a dense array indexed by old id,
+    and otherwise a sorted array of old ids to searchsorted in."""
+
+    def __init__(self, conversion_mapping, max_dense_size=10 ** 8):
+        if isinstance(conversion_mapping, pd.DataFrame):
+            conversion_mapping = conversion_mapping.iloc[:, 0]
+
+        # Otherwise which of the new ids an old id gets is arbitrary
+        if conversion_mapping.index.has_duplicates:
+            duplicates = conversion_mapping.index[
+                conversion_mapping.index.duplicated()
+            ].unique()
+            raise ValueError(
+                "Conversion mapping has duplicate old ids: {}".format(
+                    duplicates.tolist()[:10]
+                )
+            )
+
+        old_ids = conversion_mapping.index.values
+        new_ids = conversion_mapping.values
+        self.new_ids_dtype = new_ids.dtype
+
+        self.dense = (
+            old_ids.dtype.kind in "iu"
+            and (len(old_ids) == 0 or old_ids.min() >= 0)
+            and (len(old_ids) == 0 or old_ids.max() < max_dense_size)
+        )
+
+        if self.dense:
+            size = int(old_ids.max()) + 1 if len(old_ids) else 0
+            self.positions = np.full(size, -1, dtype=np.int64)
+            self.positions[old_ids] = np.arange(len(old_ids))
+        else:
+            order = np.argsort(old_ids, kind="stable")
+            self.old_ids = old_ids[order]
+            self.order = order
+
+        self.new_ids = new_ids
+
+    def lookup(self, values):
+        """Position of each value in the conversion mapping, or -1."""
+        values = np.asarray(values)
+
+        if self.dense:
+            positions = np.full(len(values), -1, dtype=np.int64)
+            # Leave NaNs, negative and out of range ids as unmapped
+            valid = pd.notnull(values)
+            valid[valid] = (values[valid] >= 0) & (values[valid] < len(self.positions))
+            positions[valid] = self.positions[values[valid].astype(np.int64)]
+            return positions
+
+        if len(self.old_ids) == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        found = np.searchsorted(self.old_ids, values)
+        found = np.minimum(found, len(self.old_ids) - 1)
+        matched = self.old_ids[found] == values
+        return np.where(matched, self.order[found], -1)
+
+    def translate(self, values):
+        """New ids for the given old ids, with NaN where there's no mapping
+        (like a left merge would do), and a mask of the unmapped values."""
+        positions = self.lookup(values)
+        unmapped = positions == -1
+
+        translated = self.new_ids.take(np.maximum(positions, 0))
+        if unmapped.any():
+            translated = translated.astype(np.float64)
+            translated[unmapped] = np.nan
+        return translated, unmapped
 
 
 def remap_network_ids(
@@ -47,64 +180,252 @@ def remap_network_ids(
     id_field="id",
     source_field="source",
     target_field="target",
+    return_unmapped=False,
 ):
     """conversion_mapping is a series where the index is the old ids, and the
-    values are the new ones."""
-
-    conversion_mapping = conversion_mapping.copy()
-    conversion_mapping.columns = [id_field]
+    values are the new ones. Ids that aren't in it become NaN. With
+    `return_unmapped`, also return a dict of the old ids that didn't have a
+    mapping, per field."""
 
-    nodes = nodes.merge(
-        conversion_mapping,
-        left_on=id_field,
-        right_index=True,
-        how="left",
-        suffixes=("_old", ""),
-    )
+    translation = IdTranslation(conversion_mapping)
 
-    nodes = nodes.drop([x for x in nodes.columns if x.endswith("_old")], axis=1)
+    nodes = nodes.copy()
+    edges = edges.copy()
+    unmapped = {}
 
-    # merge-and-replace
-    # Merge column renaming semantics
-
-    conversion_mapping.columns = [source_field]
-    edges = edges.merge(
-        conversion_mapping,
-        left_on=source_field,
-        right_index=True,
-        how="left",
-        suffixes=("_old", ""),
-    )
-
-    conversion_mapping.columns = [target_field]
-    edges = edges.merge(
-        conversion_mapping,
-        left_on=target_field,
-        right_index=True,
-        how="left",
-        suffixes=("_old", ""),
-    )
-
-    edges = edges.drop([x for x in edges.columns if x.endswith("_old")], axis=1)
+    for df, field in [
+        (nodes, id_field),
+        (edges, source_field),
+        (edges, target_field),
+    ]:
+        old_ids = df[field].values
+        df[field], field_unmapped = translation.translate(old_ids)
+        unmapped[field] = np.unique(old_ids[field_unmapped])
 
+    if return_unmapped:
+        return nodes, edges, unmapped
     return nodes, edges
 
 
 def find_neighbors(nodes, edges, this_node, extra_fields=[]):
+    """Scans all edges, so for repeated lookups build a
+    :py:class:`~NetworkIndex` once instead."""
     connected_edges = edges[
         (edges.source == this_node) | (edges.target == this_node)
     ].copy()
 
-    def get_other_node(this_node):
-        def inner(df):
-            if df.source == this_node:
-                return int(df.target)
-            else:
-                return int(df.source)
-
-        return inner
-
-    connected_edges["id"] = connected_edges.apply(get_other_node(this_node), axis=1)
+    connected_edges["id"] = np.where(
+        connected_edges.source == this_node,
+        connected_edges.target,
+        connected_edges.source,
+    ).astype(int)
     connected_edges = connected_edges[["id"] + extra_fields]
 
     return to_records(connected_edges)
+
+
+def to_python_list(values):
+    """Array slice to a list of python values, with NaNs as None like
+    to_records() does."""
+    if values.dtype.kind == "f":
+        return [None if np.isnan(x) else x for x in values.tolist()]
+    return values.tolist()
+
+
+def columns_to_records(columns):
+    """[(name, values), ...] to a list of dicts, one per row."""
+    names = [name for name, _ in columns]
+    return [dict(zip(names, row)) for row in zip(*[values for _, values in columns])]
+
+
+class NetworkIndex(object):
+    """Adjacency of an undirected network (e.g. the product space) in
+    compressed sparse row form, so that neighbor lookups only touch the
+    edges of the node in question. Build it once from :py:func:`~read_network`
+    output:
+
+        index = NetworkIndex.from_file("network.json")
+        index.neighbors(23, extra_fields=["strength"])
+
+    For node at position i, `indices[indptr[i]:indptr[i + 1]]` are the
+    positions of its neighbors and `edge_positions[...]` the rows of the
+    edges connecting them, in the same order as in the edges dataframe.
+    `node_rows[i]` is its row in the nodes dataframe, or -1 if it only shows
+    up in edges. Edge attributes are kept as one array per field."""
+
+    def __init__(
+        self,
+        nodes,
+        edges,
+        id_field="id",
+        source_field="source",
+        target_field="target",
+        edge_fields=None,
+    ):
+        sources = edges[source_field].values.astype(np.int64)
+        targets = edges[target_field].values.astype(np.int64)
+
+        node_ids = np.asarray(
+            nodes[id_field].values if len(nodes) else [], dtype=np.int64
+        )
+        self.node_ids = np.unique(np.concatenate([node_ids, sources, targets]))
+        self.id_lookup = {x: i for i, x in enumerate(self.node_ids.tolist())}
+        self.node_rows = np.full(len(self.node_ids), -1, dtype=np.int64)
+        self.node_rows[np.searchsorted(self.node_ids, node_ids)] = np.arange(
+            len(node_ids)
+        )
+
+        source_positions = np.searchsorted(self.node_ids, sources)
+        target_positions = np.searchsorted(self.node_ids, targets)
+
+        # Each edge shows up under both of its nodes, except self loops which
+        # only show up once
+        edge_numbers = np.arange(len(edges))
+        not_loop = source_positions != target_positions
+        rows = np.concatenate([source_positions, target_positions[not_loop]])
+        columns = np.concatenate([target_positions, source_positions[not_loop]])
+        edge_positions = np.concatenate([edge_numbers, edge_numbers[not_loop]])
+
+        order = np.lexsort((edge_positions, rows))
+        self.indices = columns[order]
+        self.edge_positions = edge_positions[order]
+        self.indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.node_ids)), out=self.indptr[1:])
+
+        self.edge_sources = sources
+        self.edge_targets = targets
+
+        if edge_fields is None:
+            edge_fields = [
+                x for x in edges.columns if x not in [source_field, target_field]
+            ]
+        self.edge_attributes = {field: edges[field].values for field in edge_fields}
+
+    @classmethod
+    def from_arrays(
+        cls,
+        node_ids,
+        node_rows,
+        indptr,
+        indices,
+        edge_positions,
+        edge_sources,
+        edge_targets,
+        edge_attributes,
+    ):
+        """Make an index out of already built adjacency arrays, e.g. memory
+        mapped ones, see
+        :py:func:`~atlas_core.helpers.network_binary.load_network_index_binary`."""
+        index = cls.__new__(cls)
+        index.node_ids = node_ids
+        index.node_rows = node_rows
+        index.id_lookup = {x: i for i, x in enumerate(node_ids.tolist())}
+        index.indptr = indptr
+        index.indices = indices
+        index.edge_positions = edge_positions
+        index.edge_sources = edge_sources
+        index.edge_targets = edge_targets
+        index.edge_attributes = edge_attributes
+        return index
+
+    @classmethod
+    def from_file(cls, file_name, nodes_field="nodes", edges_field="edges", **kwargs):
+        nodes, edges, _ = read_network(file_name, nodes_field, edges_field)
+        return cls(nodes, edges, **kwargs)
+
+    def __contains__(self, node_id):
+        return node_id in self.id_lookup
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def edge_range(self, node_id):
+        position = self.id_lookup.get(node_id, None)
+        if position is None:
+            return 0, 0
+        return self.indptr[position], self.indptr[position + 1]
+
+    def node_frame_rows(self, node_ids):
+        """Rows of the given nodes in the nodes dataframe, in the order of the
+        dataframe, for nodes.iloc[]. Unknown ids are skipped."""
+        positions = [self.id_lookup[x] for x in node_ids if x in self.id_lookup]
+        rows = self.node_rows[positions]
+        return np.unique(rows[rows >= 0])
+
+    def degree(self, node_id):
+        start, end = self.edge_range(node_id)
+        return int(end - start)
+
+    def neighbor_ids(self, node_id):
+        start, end = self.edge_range(node_id)
+        return self.node_ids[self.indices[start:end]]
+
+    def neighbors(self, node_id, extra_fields=[]):
+        """Same output as :py:func:`~find_neighbors`: a list of dicts with the
+        id of each neighbor and the given edge fields."""
+        start, end = self.edge_range(node_id)
+        edge_positions = self.edge_positions[start:end]
+
+        columns = [("id", self.node_ids[self.indices[start:end]].tolist())]
+        for field in extra_fields:
+            columns.append(
+                (field, to_python_list(self.edge_attributes[field][edge_positions]))
+            )
+
+        return columns_to_records(columns)
+
+    def k_hop(self, node_id, k):
+        """Ids of all nodes within k hops of a node, not including itself."""
+        position = self.id_lookup.get(node_id, None)
+        if position is None:
+            return np.array([], dtype=self.node_ids.dtype)
+
+        visited = np.zeros(len(self.node_ids), dtype=bool)
+        visited[position] = True
+        frontier = np.array([position])
+
+        for _ in range(k):
+            if len(frontier) == 0:
+                break
+            starts, ends = self.indptr[frontier], self.indptr[frontier + 1]
+            reached = np.concatenate(
+                [self.indices[start:end] for start, end in zip(starts, ends)]
+            )
+            frontier = np.unique(reached[~visited[reached]])
+            visited[frontier] = True
+
+        visited[position] = False
+        return self.node_ids[visited]
+
+    def subgraph_edges(self, node_ids):
+        """Rows of the edges between the given nodes, i.e. the edges of their
+        induced subgraph, in the order of the edges dataframe."""
+        positions = [self.id_lookup[x] for x in node_ids if x in self.id_lookup]
+        in_subgraph = np.zeros(len(self.node_ids), dtype=bool)
+        in_subgraph[positions] = True
+
+        edge_positions = []
+        for position in positions:
+            start, end = self.indptr[position], self.indptr[position + 1]
+            connected = in_subgraph[self.indices[start:end]]
+            edge_positions.append(self.edge_positions[start:end][connected])
+
+        if len(edge_positions) == 0:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(edge_positions))
+
+    def subgraph(self, node_ids, extra_fields=[]):
+        """Edge records (source, target and the given edge fields) of the
+        subgraph induced by the given nodes."""
+        edge_positions = self.subgraph_edges(node_ids)
+
+        columns = [
+            ("source", self.edge_sources[edge_positions].tolist()),
+            ("target", self.edge_targets[edge_positions].tolist()),
+        ]
+        for field in extra_fields:
+            columns.append(
+                (field, to_python_list(self.edge_attributes[field][edge_positions]))
+            )
+
+        return columns_to_records(columns)
@@ -0,0 +1,211 @@
+"""A binary alternative to the network json files of
+:py:func:`~atlas_core.helpers.network.read_network`: a directory with one
+.npy file per column and per adjacency array, plus a small json header.
+Arrays are loaded memory mapped, so loading skips json parsing entirely,
+and all worker processes that load the same network share its pages."""
+
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from .network import NetworkIndex, read_network, write_network
+
+#: Bump this when the layout changes
+BINARY_FORMAT_VERSION = 2
+
+HEADER_FILE = "header.json"
+
+INDEX_ARRAYS = ["node_ids", "node_rows", "indptr", "indices", "edge_positions"]
+
+
+def column_kind(series):
+    """How a column gets stored: as is ("array"), as a fixed width unicode
+    array plus a null mask ("string"), or in the json header ("json") if
+    it's anything else."""
+    if series.dtype.kind in "biufM":
+        return "array"
+    values = series.dropna()
+    if series.dtype == object and all(isinstance(x, str) for x in values):
+        return "string"
+    return "json"
+
+
+def write_frame(directory, prefix, df):
+    columns = []
+    for i, column in enumerate(df.columns):
+        series = df[column]
+        kind = column_kind(series)
+        file_name = "{}_{}.npy".format(prefix, i)
+
+        if kind == "array":
+            np.save(os.path.join(directory, file_name), series.values)
+            columns.append(dict(name=column, kind=kind, file=file_name))
+        elif kind == "string":
+            nulls = series.isnull().values
+            values = np.array(series.fillna("").values.tolist(), dtype=str)
+            np.save(os.path.join(directory, file_name), values)
+            column_info = dict(name=column, kind=kind, file=file_name)
+            if nulls.any():
+                column_info["nulls"] = "{}_{}_nulls.npy".format(prefix, i)
+                np.save(os.path.join(directory, column_info["nulls"]), nulls)
+            columns.append(column_info)
+        else:
+            values = [None if pd.isnull(x) else x for x in series.values.tolist()]
+            columns.append(dict(name=column, kind=kind, values=values))
+
+    return dict(length=df.shape[0], columns=columns)
+
+
+def load_column(directory, column_info, mmap_mode="r"):
+    """Load a column as an array. Plain and non-null string columns stay
+    memory mapped."""
+    if column_info["kind"] == "json":
+        return np.array(column_info["values"], dtype=object)
+
+    values = np.load(os.path.join(directory, column_info["file"]), mmap_mode=mmap_mode)
+
+    if "nulls" in column_info:
+        nulls = np.load(os.path.join(directory, column_info["nulls"]))
+        values = values.astype(object)
+        values[nulls] = None
+
+    return values
+
+
+def read_frame(directory, frame_info, mmap_mode="r"):
+    columns = frame_info["columns"]
+    if len(columns) == 0:
+        return pd.DataFrame(index=pd.RangeIndex(frame_info["length"]))
+
+    return pd.DataFrame(
+        {
+            column_info["name"]: load_column(directory, column_info, mmap_mode)
+            for column_info in columns
+        },
+        columns=[column_info["name"] for column_info in columns],
+    )
+
+
+def write_network_binary(
+    directory,
+    nodes,
+    edges,
+    other_fields=None,
+    id_field="id",
+    source_field="source",
+    target_field="target",
+):
+    """Write a network in the binary format, including the adjacency arrays
+    of its :py:class:`~atlas_core.helpers.network.NetworkIndex`."""
+    os.makedirs(directory, exist_ok=True)
+
+    index = NetworkIndex(
+        nodes,
+        edges,
+        id_field=id_field,
+        source_field=source_field,
+        target_field=target_field,
+    )
+    for name in INDEX_ARRAYS:
+        np.save(
+            os.path.join(directory, "index_{}.npy".format(name)), getattr(index, name)
+        )
+
+    header = dict(
+        format_version=BINARY_FORMAT_VERSION,
+        id_field=id_field,
+        source_field=source_field,
+        target_field=target_field,
+        other_fields=other_fields or {},
+        nodes=write_frame(directory, "nodes", nodes),
+        edges=write_frame(directory, "edges", edges),
+    )
+
+    with open(os.path.join(directory, HEADER_FILE), "w") as f:
+        f.write(json.dumps(header, indent=4, separators=(",", ": ")))
+
+
+def read_header(directory):
+    with open(os.path.join(directory, HEADER_FILE), "r") as f:
+        header = json.loads(f.read())
+    if header["format_version"] != BINARY_FORMAT_VERSION:
+        raise ValueError(
+            "Network in {} is in binary format version {}, expected {}. "
+            "Convert it again.".format(
+                directory, header["format_version"], BINARY_FORMAT_VERSION
+            )
+        )
+    return header
+
+
+def read_network_binary(directory, mmap_mode="r"):
+    """Same output as :py:func:`~atlas_core.helpers.network.read_network`:
+    nodes and edges dataframes and a dict of other fields. Building the
+    dataframes copies the columns, so use
+    :py:func:`~load_network_index_binary` to keep sharing memory."""
+    header = read_header(directory)
+    return (
+        read_frame(directory, header["nodes"], mmap_mode),
+        read_frame(directory, header["edges"], mmap_mode),
+        header["other_fields"],
+    )
+
+
+def load_network_index_binary(directory, mmap_mode="r"):
+    """Load a :py:class:`~atlas_core.helpers.network.NetworkIndex` straight
+    from the memory mapped arrays, without building any dataframes."""
+    header = read_header(directory)
+
+    arrays = {
+        name: np.load(
+            os.path.join(directory, "index_{}.npy".format(name)), mmap_mode=mmap_mode
+        )
+        for name in INDEX_ARRAYS
+    }
+
+    edge_columns = {
+        column_info["name"]: load_column(directory, column_info, mmap_mode)
+        for column_info in header["edges"]["columns"]
+    }
+    edge_sources = edge_columns.pop(header["source_field"])
+    edge_targets = edge_columns.pop(header["target_field"])
+
+    return NetworkIndex.from_arrays(
+        edge_sources=edge_sources,
+        edge_targets=edge_targets,
+        edge_attributes=edge_columns,
+        **arrays
+    )
+
+
+def json_to_binary(json_file_name, directory, nodes_field="nodes", edges_field="edges"):
+    nodes, edges, other_fields = read_network(json_file_name, nodes_field, edges_field)
+    write_network_binary(directory, nodes, edges, other_fields)
+
+
+def binary_to_json(directory, json_file_name, nodes_field="nodes", edges_field="edges"):
+    nodes, edges, other_fields = read_network_binary(directory)
+    write_network(json_file_name, nodes, edges, other_fields, nodes_field, edges_field)
+
+
+def benchmark_network_load(json_file_name, directory, repeat=3):
+    """Best time in seconds (out of `repeat` tries) to load the same network
+    from json, from the binary format, and as a binary network index."""
+
+    def best_time(func):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return dict(
+        json=best_time(lambda: read_network(json_file_name)),
+        json_index=best_time(lambda: NetworkIndex(*read_network(json_file_name)[:2])),
+        binary=best_time(lambda: read_network_binary(directory)),
+        binary_index=best_time(lambda: load_network_index_binary(directory)),
+    )
@@ -36,3 +36,61 @@ def find_dict_in_list(l, exact_match=True, **kwargs):
         raise ValueError(
             "Too many matches!", dict(matches=filtered_list, predicates=kwargs)
         )
+
+
+class DictIndex(object):
+    """Same lookups as :py:func:`~find_dict_in_list`, but for repeated lookups
+    on the same list: the first query with a given set of keys builds a hash
+    index on those keys, and later ones with the same keys are O(1).
+
+    e.g.
+    >>> index = DictIndex([{"a":2, "b":5}, {"a":3, "b":5}])
+    >>> index.find(a=3)
+    {"a":3, "b":5}
+    >>> index.find(b=5, exact_match=False)
+    [{"a":2, "b":5}, {"a":3, "b":5}]
+
+    The list is copied when the index is made, so changes to the list after
+    that aren't seen. If some dicts don't have the queried keys, or values
+    aren't hashable, it falls back to scanning the list like
+    find_dict_in_list() does."""
+
+    def __init__(self, l):
+        self.l = list(l)
+        self.indexes = {}
+
+    def build_index(self, keys):
+        index = {}
+        try:
+            for d in self.l:
+                index.setdefault(tuple(d[k] for k in keys), []).append(d)
+        except (KeyError, TypeError):
+            # Missing keys or unhashable values
+            return None
+        return index
+
+    def find(self, exact_match=True, **kwargs):
+        keys = tuple(sorted(kwargs.keys()))
+        if keys not in self.indexes:
+            self.indexes[keys] = self.build_index(keys)
+        index = self.indexes[keys]
+
+        try:
+            if index is None:
+                raise TypeError
+            filtered_list = index.get(tuple(kwargs[k] for k in keys), [])
+        except TypeError:
+            return find_dict_in_list(self.l, exact_match=exact_match, **kwargs)
+
+        if not exact_match:
+            return list(filtered_list)
+
+        if len(filtered_list) == 1:
+            return filtered_list[0]
+        elif len(filtered_list) == 0:
+            return None
+        else:
+            raise ValueError(
+                "Too many matches!",
+                dict(matches=list(filtered_list), predicates=kwargs),
+            )
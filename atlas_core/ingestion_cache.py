@@ -0,0 +1,89 @@
+"""On-disk cache for intermediate results of
+:py:func:`~atlas_core.data_ingestion.process_dataset`, keyed by hashes of
+everything that went into computing them, so that tweaking one part of a
+dataset config only recomputes the stages that depend on it."""
+
+import functools
+import hashlib
+import inspect
+import os
+import re
+
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+# Default reprs of objects include their memory address, which changes from
+# one run to the next
+MEMORY_ADDRESS = re.compile(r" at 0x[0-9a-fA-F]+")
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, pd.DataFrame):
+        h.update(b"DataFrame")
+        _update_hash(h, [str(c) for c in obj.columns])
+        _update_hash(h, [str(d) for d in obj.dtypes])
+        h.update(hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(type(obj).__name__.encode("utf-8"))
+        _update_hash(h, [str(obj.name), str(obj.dtype)])
+        h.update(hash_pandas_object(obj).values.tobytes())
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for key in sorted(obj.keys(), key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode("utf-8"))
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, functools.partial):
+        h.update(b"partial")
+        _update_hash(h, [obj.func, obj.args, obj.keywords])
+    elif callable(obj) and hasattr(obj, "__code__"):
+        # Functions are hashed by their source code, so editing a hook or an
+        # aggregation invalidates whatever it produced. Values captured in
+        # closures aren't taken into account.
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = repr((obj.__code__.co_code, obj.__code__.co_consts))
+        h.update(source.encode("utf-8"))
+    else:
+        value = repr(obj)
+        if MEMORY_ADDRESS.search(value):
+            raise TypeError("Can't hash {} for the ingestion cache.".format(value))
+        h.update(value.encode("utf-8"))
+
+
+def hash_object(obj):
+    """Stable hash of dataframes, config dicts and lists, functions, partials
+    and plain values, and any nesting of those. Raises TypeError for objects
+    it can't hash stably, rather than giving a key that never hits."""
+    h = hashlib.sha1()
+    _update_hash(h, obj)
+    return h.hexdigest()
+
+
+class IngestionCache(object):
+    """Stores objects (mostly dataframes) in pickle files under a directory,
+    by stage name and hash key. Pickle is fast to read and write locally, and
+    keeps dtypes like categoricals intact."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stage, key):
+        return os.path.join(self.directory, "{}_{}.pkl".format(stage, key))
+
+    def get(self, stage, key):
+        path = self.path(stage, key)
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def put(self, stage, key, obj):
+        path = self.path(stage, key)
+        pd.to_pickle(obj, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return obj
@@ -0,0 +1,325 @@
+"""Request, cache and database metrics in the Prometheus text format.
+
+Under gunicorn each worker process keeps its own metrics, so for a scrape to
+see all of them, set a `directory` that all workers share: each one writes
+its metrics there (at most every `flush_interval` seconds, and on every
+scrape), and a scrape adds up the files of all workers. Counters and
+histograms of workers that have exited are still counted, like a Prometheus
+counter should be, so clear the directory when restarting the whole app,
+not when a single worker starts."""
+
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .classification import SQLAlchemyClassification
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+#: name -> (type, help, buckets)
+METRICS = {
+    "atlas_request_duration_seconds": (
+        "histogram",
+        "Request latency by endpoint.",
+        LATENCY_BUCKETS,
+    ),
+    "atlas_response_size_bytes": (
+        "histogram",
+        "Response body size by endpoint.",
+        SIZE_BUCKETS,
+    ),
+    "atlas_request_db_seconds": (
+        "histogram",
+        "Time spent in database queries per request, by endpoint.",
+        LATENCY_BUCKETS,
+    ),
+    "atlas_serializer_requests_total": ("counter", "Requests by serializer.", None),
+    "atlas_api_errors_total": ("counter", "APIErrors by status code.", None),
+    "atlas_classification_cache_hits_total": (
+        "counter",
+        "Classification cache hits by method.",
+        None,
+    ),
+    "atlas_classification_cache_misses_total": (
+        "counter",
+        "Classification cache misses by method.",
+        None,
+    ),
+}
+
+#: Cached methods of SQLAlchemyClassification
+CLASSIFICATION_CACHES = [
+    "get_all",
+    "get_by_id",
+    "get_level_by_id",
+    "aggregation_mapping",
+]
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def classification_cache_metrics():
+    """lru_cache statistics of the classification lookups, which are shared
+    between all SQLAlchemyClassification instances in a process."""
+    counters = []
+    for method in CLASSIFICATION_CACHES:
+        info = getattr(SQLAlchemyClassification, method).cache_info()
+        labels = [["method", method]]
+        counters.append(["atlas_classification_cache_hits_total", labels, info.hits])
+        counters.append(
+            ["atlas_classification_cache_misses_total", labels, info.misses]
+        )
+    return counters
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["atlas_query_start"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("atlas_query_start", None)
+    if start is not None and has_request_context() and "_metrics_start" in g:
+        g._metrics_db_seconds += time.perf_counter() - start
+
+
+_db_timing_lock = threading.Lock()
+_db_timing_enabled = False
+
+
+def enable_db_timing():
+    """Time queries on all engines, including the ones data version routers
+    create later on."""
+    global _db_timing_enabled
+    with _db_timing_lock:
+        if not _db_timing_enabled:
+            event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+            _db_timing_enabled = True
+
+
+class Metrics(object):
+    """A registry of the counters and histograms in :py:data:`~METRICS`,
+    labeled by endpoint, serializer etc. Call
+    :py:meth:`~Metrics.init_app` to have it measure every request."""
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = defaultdict(float)
+        # (name, labels) -> [count per bucket, then +Inf], sum
+        self.histograms = {}
+        self.collectors = [classification_cache_metrics]
+
+        self._last_flush = time.monotonic()
+
+    def inc(self, name, labels={}, value=1):
+        with self._lock:
+            self.counters[(name, label_key(labels))] += value
+
+    def observe(self, name, value, labels={}):
+        buckets = METRICS[name][2]
+        key = (name, label_key(labels))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            counts, _ = self.histograms[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+            counts[i] += 1
+            self.histograms[key][1] += value
+
+    def snapshot(self):
+        """Current values of this process as json serializable lists."""
+        with self._lock:
+            counters = [
+                [name, [list(x) for x in labels], value]
+                for (name, labels), value in self.counters.items()
+            ]
+            histograms = [
+                [name, [list(x) for x in labels], list(counts), total]
+                for (name, labels), (counts, total) in self.histograms.items()
+            ]
+        for collector in self.collectors:
+            counters.extend(collector())
+        return dict(counters=counters, histograms=histograms)
+
+    def flush(self):
+        """Write this process' metrics into `directory` for the others to
+        read."""
+        self._last_flush = time.monotonic()
+        file_name = os.path.join(self.directory, "metrics-{}.json".format(os.getpid()))
+        with open(file_name + ".tmp", "w") as f:
+            f.write(json.dumps(self.snapshot()))
+        os.replace(file_name + ".tmp", file_name)
+
+    def collect(self):
+        """Metrics of all processes sharing `directory`, or of just this one
+        if there is none, added up."""
+        if self.directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for file_name in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+                try:
+                    with open(file_name, "r") as f:
+                        snapshots.append(json.loads(f.read()))
+                except (OSError, ValueError):
+                    # Removed since the glob, e.g. the directory got cleared
+                    continue
+
+        counters = defaultdict(float)
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, counts, total in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                if key not in histograms:
+                    histograms[key] = [[0] * len(counts), 0.0]
+                histograms[key][0] = [a + b for a, b in zip(histograms[key][0], counts)]
+                histograms[key][1] += total
+
+        return counters, histograms
+
+    def exposition(self):
+        """All metrics in the Prometheus text format."""
+        counters, histograms = self.collect()
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+
+            if metric_type == "counter":
+                for (this_name, labels), value in sorted(counters.items()):
+                    if this_name == name:
+                        lines.append(
+                            "{}{} {}".format(
+                                name, format_labels(labels), format_value(value)
+                            )
+                        )
+                continue
+
+            for (this_name, labels), (counts, total) in sorted(histograms.items()):
+                if this_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + [float("inf")], counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", format_value(bound)),)
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, format_labels(bucket_labels), cumulative
+                        )
+                    )
+                lines.append(
+                    "{}_sum{} {}".format(name, format_labels(labels), repr(total))
+                )
+                lines.append(
+                    "{}_count{} {}".format(name, format_labels(labels), cumulative)
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def begin_request(self):
+        g._metrics_start = time.perf_counter()
+        g._metrics_db_seconds = 0.0
+
+    def record_response(self, response):
+        g._metrics_response_size = response.content_length
+        return response
+
+    def end_request(self, exc=None):
+        """Record the request in teardown rather than after_request, so that
+        requests that failed with an unhandled exception are counted too."""
+        start = g.pop("_metrics_start", None)
+        if start is None:
+            return
+
+        endpoint = request.endpoint or "unmatched"
+        labels = dict(endpoint=endpoint)
+        self.observe(
+            "atlas_request_duration_seconds", time.perf_counter() - start, labels
+        )
+        self.observe("atlas_request_db_seconds", g._metrics_db_seconds, labels)
+        response_size = g.pop("_metrics_response_size", None)
+        if response_size is not None:
+            self.observe("atlas_response_size_bytes", response_size, labels)
+
+        # Only requests that went through get_serializer()
+        serializer = g.pop("_serializer_name", None)
+        if serializer is not None:
+            self.inc("atlas_serializer_requests_total", dict(serializer=serializer))
+
+        if (
+            self.directory is not None
+            and time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def count_api_errors(self, handler):
+        """Wrap an :py:class:`~atlas_core.helpers.flask.APIError` handler to
+        count errors by status code."""
+
+        def counting_handler(error):
+            self.inc("atlas_api_errors_total", dict(status_code=error.status_code))
+            return handler(error)
+
+        return counting_handler
+
+    def init_app(self, app):
+        app.extensions["metrics"] = self
+        app.before_request(self.begin_request)
+        app.after_request(self.record_response)
+        app.teardown_request(self.end_request)
+        enable_db_timing()
+        return app
+
+
+def register_metrics_endpoint(app, url_pattern="/metrics"):
+    """Register an endpoint that Prometheus can scrape."""
+    metrics = app.extensions["metrics"]
+
+    def metrics_api():
+        return app.response_class(
+            metrics.exposition(), mimetype="text/plain; version=0.0.4"
+        )
+
+    app.add_url_rule(url_pattern, endpoint="metrics", view_func=metrics_api)
+
+    return app
@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import json
+
+from flask import current_app, request
+
+from .helpers.flask import abort
+from .helpers.network import NetworkIndex, read_network, to_records
+from .serializers import get_serializer
+
+
+class PreparedResponse(object):
+    """A JSON response body that's serialized and gzipped once up front, with
+    an ETag so clients can revalidate without downloading it again."""
+
+    def __init__(self, data, compresslevel=6):
+        self.body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        self.gzipped_body = gzip.compress(self.body, compresslevel=compresslevel)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+    def respond(self):
+        """Send the gzipped body if the client accepts it, and a 304 if the
+        client already has this version."""
+        if "gzip" in request.accept_encodings:
+            response = current_app.response_class(
+                self.gzipped_body, mimetype="application/json"
+            )
+            response.headers["Content-Encoding"] = "gzip"
+            # Different bytes, so they need a different ETag
+            response.set_etag(self.etag + "-gzip")
+        else:
+            response = current_app.response_class(
+                self.body, mimetype="application/json"
+            )
+            response.set_etag(self.etag)
+
+        response.vary.add("Accept-Encoding")
+        return response.make_conditional(request)
+
+
+def load_network(settings):
+    """Read a network file once and index it."""
+    nodes, edges, other_fields = read_network(
+        settings["file_name"],
+        nodes_field=settings.get("nodes_field", "nodes"),
+        edges_field=settings.get("edges_field", "edges"),
+    )
+    index = NetworkIndex(nodes, edges, id_field=settings.get("id_field", "id"))
+    return nodes, edges, other_fields, index
+
+
+def make_network_api(settings, api_metadata={}):
+    """Generate the handlers for the full network, the neighbors of a node and
+    the subgraph induced by a set of nodes, for one network. The network is
+    read and indexed only once, here."""
+
+    if isinstance(settings, str):
+        settings = {"file_name": settings}
+
+    nodes, edges, other_fields, index = load_network(settings)
+
+    full_network = dict(other_fields)
+    full_network.update(nodes=to_records(nodes), edges=to_records(edges))
+    full_network_response = PreparedResponse(
+        dict(data=full_network, api_metadata=api_metadata)
+    )
+
+    def edge_fields():
+        fields = request.args.get("fields", None)
+        if fields is None:
+            return list(index.edge_attributes.keys())
+
+        fields = [x for x in fields.split(",") if x]
+        invalid = [x for x in fields if x not in index.edge_attributes]
+        if invalid:
+            abort(
+                400,
+                message="Unknown edge fields: {}".format(invalid),
+                payload=dict(fields=list(index.edge_attributes.keys())),
+            )
+        return fields
+
+    def network_api():
+        """Get the whole network, i.e. nodes, edges and any other fields in
+        the network file. This is pre-serialized, so it's always JSON and
+        ignores the `serializer` argument."""
+        return full_network_response.respond()
+
+    def neighbors_api(node_id):
+        """Get the neighbors of a node.
+
+        :param node_id: Node id
+        :type node_id: int
+        :param fields: Comma separated edge fields to include, all by default
+        :type fields: str
+        :code 404: Node isn't in the network
+        """
+        if node_id not in index:
+            abort(404, message="Node {} is not in the network.".format(node_id))
+
+        data = index.neighbors(node_id, extra_fields=edge_fields())
+        return get_serializer().serialize(data=data, api_metadata=api_metadata)
+
+    def subgraph_api():
+        """Get the nodes and the edges between them for a set of nodes.
+
+        :param nodes: Comma separated node ids
+        :type nodes: str
+        :param fields: Comma separated edge fields to include, all by default
+        :type fields: str
+        """
+        try:
+            node_ids = [int(x) for x in request.args.get("nodes", "").split(",") if x]
+        except ValueError:
+            abort(400, message="nodes should be a comma separated list of ids.")
+
+        data = dict(
+            nodes=to_records(nodes.iloc[index.node_frame_rows(node_ids)]),
+            edges=index.subgraph(node_ids, extra_fields=edge_fields()),
+        )
+        return get_serializer().serialize(data=data, api_metadata=api_metadata)
+
+    return network_api, neighbors_api, subgraph_api
+
+
+def register_network_apis(app, networks, url_prefix="networks", api_metadata=[]):
+    """Given network files, read them in once and register URL routes with
+    flask for each network. `networks` maps network names to a file name, or
+    a dict with a `file_name` and optionally `nodes_field`, `edges_field` and
+    `id_field`."""
+
+    api_metadata = {x: app.config[x] for x in api_metadata}
+
+    for network_name, settings in networks.items():
+
+        network_api_func, neighbors_api_func, subgraph_api_func = make_network_api(
+            settings, api_metadata
+        )
+
+        # Full network e.g. /networks/product_space/
+        app.add_url_rule(
+            "/{url_prefix}/{network_name}/".format(
+                network_name=network_name, url_prefix=url_prefix
+            ),
+            endpoint=network_name + "_network",
+            view_func=network_api_func,
+        )
+
+        # Neighbors endpoint e.g. /networks/product_space/7/neighbors
+        app.add_url_rule(
+            "/{url_prefix}/{network_name}/<int:node_id>/neighbors".format(
+                network_name=network_name, url_prefix=url_prefix
+            ),
+            endpoint=network_name + "_neighbors",
+            view_func=neighbors_api_func,
+        )
+
+        # Subgraph endpoint e.g. /networks/product_space/subgraph?nodes=1,2,3
+        app.add_url_rule(
+            "/{url_prefix}/{network_name}/subgraph".format(
+                network_name=network_name, url_prefix=url_prefix
+            ),
+            endpoint=network_name + "_subgraph",
+            view_func=subgraph_api_func,
+        )
+
+    return app
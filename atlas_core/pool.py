@@ -0,0 +1,253 @@
+"""Connection pool settings, warmup and statistics. Pool exhaustion under load
+shows up as requests waiting on :py:meth:`Pool.connect`, so
+:py:class:`~PoolStats` keeps track of how long that takes, along with how
+many connections are checked out, overflowing and how old they are."""
+
+import logging
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+logger = logging.getLogger(__name__)
+
+#: Config variables that set create_engine() pool arguments
+POOL_CONFIG = {
+    "DB_POOL_SIZE": "pool_size",
+    "DB_MAX_OVERFLOW": "max_overflow",
+    "DB_POOL_TIMEOUT": "pool_timeout",
+    "DB_POOL_RECYCLE": "pool_recycle",
+    "DB_POOL_PRE_PING": "pool_pre_ping",
+}
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS, plus the pool arguments from any of the
+    :py:data:`~POOL_CONFIG` variables that are set. Not every pool class
+    takes every argument (e.g. sqlite files use a NullPool, which has no
+    size), so unset ones are left out."""
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    for config_name, option_name in POOL_CONFIG.items():
+        if config.get(config_name, None) is not None:
+            options[option_name] = config[config_name]
+    return options
+
+
+#: Connections to open in each process if DB_WARMUP_CONNECTIONS isn't set
+DEFAULT_WARMUP_CONNECTIONS = 0
+
+
+def warmup_engine(engine, num_connections):
+    """Open up `num_connections` connections in the pool in advance so the
+    first requests don't pay for connection setup."""
+    connections = []
+    try:
+        for _ in range(num_connections):
+            conn = engine.connect()
+            conn.execute("SELECT 1")
+            connections.append(conn)
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+class PoolWarmup(object):
+    """Runs the engine hooks (e.g. :py:func:`~watch_pool`) and warms up the
+    pool of the app's engine before the first request of each process.
+    Doing this in create_app() instead would open connections before
+    gunicorn --preload forks its workers, which would then all share them.
+
+    This is only tried once per process. If it fails (e.g. the database is
+    down), the error gets logged and the request goes ahead, so routes that
+    don't use the database keep working."""
+
+    def __init__(self, num_connections=DEFAULT_WARMUP_CONNECTIONS, engine_hooks=[]):
+        self.num_connections = num_connections
+        self.engine_hooks = list(engine_hooks)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def warmup(self):
+        if self._pid == os.getpid():
+            return
+
+        from .core import db
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            try:
+                engine = db.get_engine()
+                for hook in self.engine_hooks:
+                    hook(engine)
+                warmup_engine(engine, self.num_connections)
+            except Exception:
+                logger.exception("Couldn't warm up the connection pool")
+
+    def init_app(self, app):
+        app.extensions["pool_warmup"] = self
+        app.before_request(self.warmup)
+        return app
+
+
+def pool_value(pool, name):
+    """Call one of the pool's counters (e.g. "checkedout"), or None if this
+    kind of pool doesn't have it."""
+    func = getattr(pool, name, None)
+    return func() if func is not None else None
+
+
+class PoolStats(object):
+    """Collects statistics for the connection pool of an engine, including
+    pools that the engine recreates when disposed. Use
+    :py:func:`~watch_pool` rather than creating these directly."""
+
+    def __init__(self, engine):
+        # Not a strong reference, so that the engine and its entry in
+        # _pool_stats can get garbage collected
+        self._engine = weakref.ref(engine)
+        self._lock = threading.Lock()
+        # connection record -> when its current connection was opened
+        self._connected_at = {}
+        self.reset()
+
+        for name in ["connect", "checkout", "invalidate", "close", "detach"]:
+            event.listen(engine, name, getattr(self, "on_" + name))
+        event.listen(engine, "engine_disposed", self.on_engine_disposed)
+        self.wrap_pool(engine.pool)
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.waits = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def wrap_pool(self, pool):
+        """Time how long it takes to get a connection from the pool, by
+        wrapping the methods the engine gets connections with."""
+
+        def timed(connect):
+            def timed_connect():
+                start = time.perf_counter()
+                try:
+                    return connect()
+                except PoolTimeoutError:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise
+                finally:
+                    self.record_wait(time.perf_counter() - start)
+
+            return timed_connect
+
+        pool.connect = timed(pool.connect)
+        pool.unique_connection = timed(pool.unique_connection)
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+            self._connected_at[connection_record] = time.monotonic()
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+            self._connected_at.pop(connection_record, None)
+
+    def on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._connected_at.pop(connection_record, None)
+
+    on_detach = on_close
+
+    def on_engine_disposed(self, engine):
+        with self._lock:
+            self._connected_at = {}
+        self.wrap_pool(engine.pool)
+
+    @property
+    def engine(self):
+        return self._engine()
+
+    def stats(self):
+        engine = self.engine
+        if engine is None:
+            return None
+        pool = engine.pool
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - x for x in self._connected_at.values()]
+            return dict(
+                pool_class=type(pool).__name__,
+                size=pool_value(pool, "size"),
+                checked_out=pool_value(pool, "checkedout"),
+                checked_in=pool_value(pool, "checkedin"),
+                overflow=pool_value(pool, "overflow"),
+                connections=len(ages),
+                connects=self.connects,
+                checkouts=self.checkouts,
+                invalidations=self.invalidations,
+                timeouts=self.timeouts,
+                wait_seconds_total=self.wait_seconds_total,
+                wait_seconds_max=self.wait_seconds_max,
+                wait_seconds_mean=(
+                    self.wait_seconds_total / self.waits if self.waits else 0.0
+                ),
+                connection_age_max=max(ages) if ages else 0.0,
+                connection_age_mean=sum(ages) / len(ages) if ages else 0.0,
+            )
+
+
+_pool_stats = weakref.WeakKeyDictionary()
+_pool_stats_lock = threading.Lock()
+
+
+def watch_pool(engine):
+    """Start collecting statistics for an engine's pool, if not already, and
+    return its :py:class:`~PoolStats`."""
+    with _pool_stats_lock:
+        if engine not in _pool_stats:
+            _pool_stats[engine] = PoolStats(engine)
+        return _pool_stats[engine]
+
+
+def get_pool_stats(engine):
+    """Statistics of an engine's pool, or None if it's not being watched."""
+    pool_stats = _pool_stats.get(engine, None)
+    return pool_stats.stats() if pool_stats is not None else None
+
+
+def register_pool_stats_endpoint(app, url_pattern="/admin/pool"):
+    """Register an admin endpoint that shows the pool statistics of the
+    engine currently in use. This does no authentication, so make sure to
+    protect this URL."""
+    from .core import db
+    from .helpers.flask import abort
+    from .serializers import get_serializer
+
+    def pool_stats():
+        stats = get_pool_stats(db.get_engine())
+        if stats is None:
+            abort(404, message="Connection pool statistics are not enabled.")
+        return get_serializer().serialize(data=stats)
+
+    app.add_url_rule(url_pattern, endpoint="pool_stats", view_func=pool_stats)
+
+    return app
@@ -0,0 +1,252 @@
+"""A sampling profiler that's cheap enough to leave on in production, unlike
+werkzeug's ProfilerMiddleware (see :py:func:`~atlas_core.add_profiler`) which
+profiles every request with cProfile, and a worker startup time benchmark."""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, request
+
+#: Modules that a serving process shouldn't need to import, see
+#: :py:func:`~measure_startup`. Anything that uses them should import them
+#: inside functions.
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "tables",
+    "clint",
+    "pandas_to_postgres",
+    "atlas_core.data_ingestion",
+    "atlas_core.hdf_to_postgres",
+]
+
+STARTUP_SCRIPT = """
+import json, sys, time
+
+start = time.perf_counter()
+import atlas_core
+imported = time.perf_counter()
+atlas_core.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+
+print(json.dumps(dict(
+    import_seconds=imported - start,
+    create_app_seconds=created - imported,
+    modules=sorted(sys.modules),
+)))
+"""
+
+
+def frame_name(frame):
+    return "{}:{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_name)
+
+
+def collapse_stack(frame):
+    """Stack of a frame in collapsed format, i.e. frame names from the
+    outermost to the innermost separated by semicolons."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of threads handling requests every `interval`
+    seconds from a background thread, and keeps the stack counts per
+    endpoint for:
+
+    - a random `sample_rate` fraction of requests, and
+    - requests that took longer than `slow_threshold` seconds, if given.
+
+    Since we can't know in advance which requests will be slow, setting a
+    threshold means every request gets sampled, and the samples of fast
+    ones are thrown away. Sampling costs one walk over the stack of each
+    active request per interval, so it's still cheap.
+
+    Results are in collapsed stack format (one "endpoint;frame;frame count"
+    line per stack), which flamegraph.pl, speedscope etc. can read. Get them
+    with :py:meth:`~SamplingProfiler.collapsed`, from the admin endpoint (see
+    :py:func:`~register_profiler_endpoint`), or have them dumped to
+    `profile_dir` every `dump_interval` seconds."""
+
+    def __init__(
+        self,
+        sample_rate=0.01,
+        slow_threshold=None,
+        interval=0.005,
+        profile_dir=None,
+        dump_interval=60,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.dump_interval = dump_interval
+
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        # thread id -> Counter of stacks for the request it's handling
+        self._active = {}
+        self.stacks = defaultdict(Counter)
+        self.num_requests = Counter()
+
+        self._thread = None
+        self._last_dump = time.monotonic()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self.run, name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                continue
+
+            # Walk the stacks without holding the lock, so that requests
+            # starting or ending don't wait for it
+            frames = sys._current_frames()
+            stacks = [
+                (thread_id, samples, collapse_stack(frames[thread_id]))
+                for thread_id, samples in active
+                if thread_id in frames
+            ]
+            del frames
+
+            with self._lock:
+                for thread_id, samples, stack in stacks:
+                    # Skip requests that ended in the meantime
+                    if self._active.get(thread_id, None) is samples:
+                        samples[stack] += 1
+
+    def begin_request(self):
+        selected = random.random() < self.sample_rate
+        if not selected and self.slow_threshold is None:
+            return
+
+        g._profiler_selected = selected
+        g._profiler_start = time.monotonic()
+        g._profiler_samples = Counter()
+        with self._lock:
+            self._active[threading.get_ident()] = g._profiler_samples
+        self.start()
+
+    def end_request(self, exc=None):
+        samples = g.pop("_profiler_samples", None)
+        if samples is None:
+            return
+
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+        duration = time.monotonic() - g._profiler_start
+        slow = self.slow_threshold is not None and duration >= self.slow_threshold
+        if g._profiler_selected or slow:
+            self.record(request.endpoint or "<no endpoint>", samples)
+
+        if (
+            self.profile_dir is not None
+            and time.monotonic() - self._last_dump >= self.dump_interval
+        ):
+            self.dump()
+
+    def record(self, endpoint, samples):
+        with self._lock:
+            self.stacks[endpoint].update(samples)
+            self.num_requests[endpoint] += 1
+
+    def collapsed(self, endpoint=None):
+        with self._lock:
+            lines = [
+                "{};{} {}".format(this_endpoint, stack, count)
+                for this_endpoint, stacks in sorted(self.stacks.items())
+                if endpoint is None or this_endpoint == endpoint
+                for stack, count in stacks.most_common()
+            ]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def reset(self):
+        with self._lock:
+            self.stacks = defaultdict(Counter)
+            self.num_requests = Counter()
+
+    def dump(self):
+        """Write the collapsed stacks so far to a file per process in
+        `profile_dir`."""
+        file_name = os.path.join(
+            self.profile_dir, "profile-{}.collapsed".format(os.getpid())
+        )
+        # Requests ending at the same time would write the same tmp file
+        with self._dump_lock:
+            self._last_dump = time.monotonic()
+            with open(file_name + ".tmp", "w") as f:
+                f.write(self.collapsed())
+            os.replace(file_name + ".tmp", file_name)
+
+    def init_app(self, app):
+        app.extensions["sampling_profiler"] = self
+        app.before_request(self.begin_request)
+        app.teardown_request(self.end_request)
+        return app
+
+
+def register_profiler_endpoint(app, url_pattern="/admin/profile"):
+    """Register an admin endpoint that shows the collapsed stacks of the
+    sampling profiler on GET (optionally only for the `endpoint` parameter),
+    and clears them on DELETE. This does no authentication, so make sure to
+    protect this URL."""
+    profiler = app.extensions["sampling_profiler"]
+
+    def profile():
+        if request.method == "DELETE":
+            profiler.reset()
+            return app.response_class("", status=204)
+
+        return app.response_class(
+            profiler.collapsed(request.args.get("endpoint", None)),
+            mimetype="text/plain",
+        )
+
+    app.add_url_rule(
+        url_pattern, endpoint="profile", view_func=profile, methods=["GET", "DELETE"]
+    )
+
+    return app
+
+
+def measure_startup(config={}, repeat=3):
+    """Time `import atlas_core` and `create_app(config)` in fresh python
+    processes, like a worker booting. Returns the best times in seconds out
+    of `repeat` tries, and which of the :py:data:`~HEAVY_MODULES` got
+    imported along the way."""
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_dir] + [x for x in [env.get("PYTHONPATH", None)] if x]
+    )
+
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SCRIPT, json.dumps(config)], env=env
+        )
+        runs.append(json.loads(output.decode("utf-8").splitlines()[-1]))
+
+    return dict(
+        import_seconds=min(run["import_seconds"] for run in runs),
+        create_app_seconds=min(run["create_app_seconds"] for run in runs),
+        heavy_modules=[x for x in HEAVY_MODULES if x in runs[0]["modules"]],
+    )
@@ -1,6 +1,6 @@
 from .interfaces import ISerializerStrategy
 
-from flask import jsonify, current_app, request
+from flask import jsonify, current_app, g, request
 
 
 def simplify_obj(obj):
@@ -48,18 +48,24 @@ def get_serializer(serializer=None):
         # Alternatively, we could use the `Accept` request header, but parsing
         # this is a bit more tricky.
 
+    # Which serializer this request used, for metrics. Unknown ones are
+    # lumped together so clients can't make up new metric labels.
     if serializer:
         if serializer in current_app.serializers:
+            g._serializer_name = serializer
             return current_app.serializers[serializer]
         else:
             from .helpers.flask import abort  # avoid circular import
 
+            g._serializer_name = "invalid"
             abort(400, message="Serializer {} does not exist".format(serializer))
     else:
         default_serializer = current_app.config.get("default_serializer", None)
         if default_serializer:
+            g._serializer_name = default_serializer
             return current_app.serializers[default_serializer]
         else:
+            g._serializer_name = "default"
             return JsonifySerializer
 
 
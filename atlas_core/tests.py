@@ -1,5 +1,7 @@
 import json
 import copy
+import os
+import tempfile
 
 from flask import request
 import pytest
@@ -24,6 +26,11 @@ from .query_processing import (
 from .metadata import register_metadata_apis
 from .slice_lookup import SQLAlchemyLookup
 from .helpers.flask import register_config_endpoint
+from .data_versions import (
+    DataVersionRegistry,
+    DataVersionRouter,
+    register_data_version_endpoint,
+)
 
 
 class ProductClassificationTest(object):
@@ -640,3 +647,1479 @@ class JSONEncodingTest(BaseTestCase):
         response = self.test_client.get("/metadata/hs_product/")
         assert response.status_code == 200
         assert len(response.json["data"]) == 2
+
+
+class DataVersionTest(BaseTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.registry = DataVersionRegistry(os.path.join(self.tmpdir, "registry.json"))
+        self.registry.add_version("v1.0")
+        self.registry.add_version("v2.0")
+        self.registry.set_current("v1.0")
+
+        self.app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                + os.path.join(self.tmpdir, "base.db"),
+                "DATA_VERSION_REGISTRY": self.registry.file_name,
+                "TESTING": True,
+            }
+        )
+        self.app = register_data_version_endpoint(self.app)
+        self.router = self.app.extensions["data_version_router"]
+        self.test_client = self.app.test_client()
+
+    def test_switch(self):
+        # Nothing gets opened until the first request
+        assert self.router.current is None
+        response = self.test_client.get("/admin/data_version")
+        assert response.json["data"]["current"] == "v1_0"
+        with self.app.app_context():
+            assert self.router.current == "v1_0"
+            assert db.engine.url.database.endswith("v1_0.db")
+
+        self.router.prepare("v2.0")
+        assert self.router.next == "v2_0"
+        assert self.router.current == "v1_0"
+
+        # Switch by editing the registry file
+        self.registry.set_current("v2.0")
+        self.router.poll_registry(force=True)
+        with self.app.app_context():
+            assert self.router.current == "v2_0"
+            assert self.router.next is None
+            assert db.engine.url.database.endswith("v2_0.db")
+
+        # Switch through admin endpoint
+        response = self.test_client.post(
+            "/admin/data_version", data={"version": "v1.0"}
+        )
+        assert response.status_code == 200
+        assert response.json["data"]["current"] == "v1_0"
+        assert self.registry.current == "v1_0"
+
+        response = self.test_client.post("/admin/data_version", data={"version": "v3"})
+        assert response.status_code == 400
+
+    def test_background_switch(self):
+        import threading
+
+        self.test_client.get("/admin/data_version")
+        self.router.poll_interval = 0
+        prepared = threading.Event()
+        self.router.warmup_hooks.append(lambda engine: prepared.wait(5))
+
+        # Requests keep being served by the current version while the next
+        # one gets prepared
+        self.registry.set_current("v2.0")
+        for _ in range(2):
+            response = self.test_client.get("/admin/data_version")
+            assert response.json["data"]["current"] == "v1_0"
+
+        prepared.set()
+        self.router._switch_thread.join()
+        assert self.router.current == "v2_0"
+        assert self.router.next is None
+
+    def test_set_current_during_background_switch(self):
+        import threading
+
+        self.test_client.get("/admin/data_version")
+        self.router.poll_interval = 0
+        prepared = threading.Event()
+        self.router.warmup_hooks.append(lambda engine: prepared.wait(5))
+
+        # Starts switching to v2.0 in the background
+        self.registry.set_current("v2.0")
+        self.test_client.get("/admin/data_version")
+
+        # Switching back waits for it, rather than being undone by it
+        setter = threading.Thread(target=self.router.set_current, args=("v1.0",))
+        setter.start()
+        prepared.set()
+        setter.join()
+        self.router._switch_thread.join()
+        assert self.router.current == "v1_0"
+        assert self.registry.current == "v1_0"
+
+        engine_kwargs = {"echo": False}
+        router = DataVersionRouter("sqlite://", engine_kwargs=engine_kwargs)
+        assert router.engine_kwargs == engine_kwargs
+        assert router.engine_kwargs is not engine_kwargs
+
+    def test_fork(self):
+        self.test_client.get("/admin/data_version")
+        parent_engine = self.router.engine
+
+        # A forked worker doesn't use the engine it inherited
+        self.router._pid = None
+        self.test_client.get("/admin/data_version")
+        assert self.router.current == "v1_0"
+        assert self.router.engine is not parent_engine
+        assert self.router._inherited == [parent_engine]
+
+
+class SQLiteImportTest(BaseTestCase):
+    def setUp(self):
+        import pandas as pd
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmpdir, "data.h5")
+
+        classification = pd.DataFrame(
+            {"code": ["A", "B"], "name": ["Cars", "Trucks"], "level": ["4digit"] * 2}
+        )
+        classification.index.name = "index"
+        classification = classification.reset_index()
+        data = pd.DataFrame(
+            {
+                "product_id": [0, 1, 0, 1],
+                "year": [2007, 2007, 2008, 2008],
+                "export_value": [1.5, 2.0, None, 4.0],
+            }
+        )
+
+        with pd.HDFStore(self.file_name, mode="w") as store:
+            store.put("/classifications/product", classification, format="table")
+            store.get_storer("/classifications/product").attrs.atlas_metadata = {
+                "sql_table_name": "product"
+            }
+            store.put("/product_year", data, format="table")
+            store.get_storer("/product_year").attrs.atlas_metadata = {
+                "sql_table_name": "product_year",
+                "levels": {"product": "4digit"},
+            }
+
+    def load(self, fast):
+        from sqlalchemy import create_engine
+        from .data_import import import_data_sqlite
+
+        engine = create_engine(
+            "sqlite:///" + os.path.join(self.tmpdir, "fast_{}.db".format(fast))
+        )
+        engine.execute(
+            "CREATE TABLE product_year (product_id INTEGER, product_level TEXT, "
+            "year INTEGER, export_value FLOAT)"
+        )
+        engine.execute("CREATE INDEX product_year_idx ON product_year (product_id)")
+
+        import_data_sqlite(self.file_name, engine, source_chunksize=3, fast=fast)
+        return engine
+
+    def test_fast_matches_to_sql(self):
+        queries = [
+            "SELECT id, code, name_en, level FROM product ORDER BY id",
+            "SELECT product_id, product_level, year, export_value FROM product_year "
+            "ORDER BY year, product_id",
+        ]
+
+        slow, fast = self.load(False), self.load(True)
+        for query in queries:
+            assert slow.execute(query).fetchall() == fast.execute(query).fetchall()
+
+        assert fast.execute("SELECT count(*) FROM product_year").scalar() == 4
+        assert fast.execute("PRAGMA journal_mode").scalar() != "off"
+        assert fast.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall() == [("product_year_idx",)]
+
+    def test_prefetch(self):
+        from .data_import import prefetch
+
+        assert list(prefetch(range(10), maxsize=2)) == list(range(10))
+        assert list(prefetch(range(10), maxsize=0)) == list(range(10))
+
+        def broken():
+            yield 1
+            raise KeyError("broken")
+
+        with pytest.raises(KeyError):
+            list(prefetch(broken()))
+
+    def test_catalog(self):
+        from .hdf_catalog import HDFCatalog, catalog_file_name
+
+        catalog = HDFCatalog.load(self.file_name)
+        assert os.path.exists(catalog_file_name(self.file_name))
+        assert set(catalog.tables.keys()) == {
+            "/classifications/product",
+            "/product_year",
+        }
+        assert catalog.tables["/product_year"]["nrows"] == 4
+        assert catalog.tables["/product_year"]["bytes"] > 0
+        assert catalog.table_sizes().keys() == {"product", "product_year"}
+
+        sql_to_hdf, metadata_vars = catalog.hdf_metadata(metadata_keys=["levels"])
+        assert sql_to_hdf == {
+            "product": {"/classifications/product"},
+            "product_year": {"/product_year"},
+        }
+        assert metadata_vars["levels"]["/product_year"] == {"product": "4digit"}
+
+        # Reused as long as the file is unchanged
+        reloaded = HDFCatalog.load(self.file_name)
+        assert reloaded.content_hashes() == catalog.content_hashes()
+
+        engine = self.load(False)
+        from .data_import import import_data_sqlite
+
+        import_data_sqlite(self.file_name, engine, catalog=reloaded)
+        assert engine.execute("SELECT count(*) FROM product_year").scalar() == 8
+
+    def test_incremental(self):
+        import pandas as pd
+        from sqlalchemy import create_engine
+        from .hdf_catalog import HDFCatalog
+        from .data_import import (
+            copy_unchanged_tables_sqlite,
+            import_data_sqlite,
+            read_table_hashes,
+            write_table_hashes,
+        )
+
+        previous = self.load(False)
+        catalog = HDFCatalog.load(self.file_name)
+        write_table_hashes(previous, catalog.content_hashes())
+
+        # Change just the data table
+        data = pd.DataFrame(
+            {"product_id": [0, 1], "year": [2009, 2009], "export_value": [7.0, 8.0]}
+        )
+        with pd.HDFStore(self.file_name, mode="a") as store:
+            store.put("/product_year", data, format="table")
+            store.get_storer("/product_year").attrs.atlas_metadata = {
+                "sql_table_name": "product_year",
+                "levels": {"product": "4digit"},
+            }
+
+        new_catalog = HDFCatalog.load(self.file_name)
+        assert new_catalog.diff(catalog.content_hashes()) == (
+            {"product"},
+            ["/product_year"],
+        )
+
+        engine = create_engine("sqlite:///" + os.path.join(self.tmpdir, "new.db"))
+        engine.execute(
+            "CREATE TABLE product_year (product_id INTEGER, product_level TEXT, "
+            "year INTEGER, export_value FLOAT)"
+        )
+        engine.execute(
+            "CREATE TABLE product (id INTEGER, code TEXT, name_en TEXT, level TEXT)"
+        )
+        previous_file = previous.url.database
+        assert copy_unchanged_tables_sqlite(engine, previous_file, new_catalog) == [
+            "/product_year"
+        ]
+        engine.execute("DELETE FROM product")
+
+        import_data_sqlite(self.file_name, engine, previous_database=previous_file)
+        assert engine.execute("SELECT count(*) FROM product").scalar() == 2
+        assert engine.execute("SELECT count(*) FROM product_year").scalar() == 2
+        assert read_table_hashes(engine) == new_catalog.content_hashes()
+
+    def test_incremental_partial(self):
+        from sqlalchemy import create_engine
+        from .hdf_catalog import HDFCatalog
+        from .data_import import import_data_sqlite, read_table_hashes
+
+        catalog = HDFCatalog.load(self.file_name)
+        hashes = catalog.content_hashes()
+
+        # Keys that weren't asked for don't get a hash
+        partial = create_engine("sqlite:///" + os.path.join(self.tmpdir, "partial.db"))
+        import_data_sqlite(
+            self.file_name, partial, keys=["/product_year"], catalog=catalog
+        )
+        assert read_table_hashes(partial) == {"/product_year": hashes["/product_year"]}
+
+        # Neither do keys that failed to load
+        failed = create_engine("sqlite:///" + os.path.join(self.tmpdir, "failed.db"))
+        failed.execute(
+            "CREATE TABLE product_year (product_id INTEGER, product_level TEXT, "
+            "year INTEGER, export_value FLOAT, extra TEXT NOT NULL)"
+        )
+        import_data_sqlite(self.file_name, failed, catalog=catalog)
+        assert failed.execute("SELECT count(*) FROM product_year").scalar() == 0
+        assert read_table_hashes(failed) == {
+            "/classifications/product": hashes["/classifications/product"]
+        }
+
+        # So the next incremental load loads the failed table from the file
+        # instead of copying the empty one
+        engine = create_engine("sqlite:///" + os.path.join(self.tmpdir, "next.db"))
+        engine.execute(
+            "CREATE TABLE product (id INTEGER, code TEXT, name_en TEXT, level TEXT)"
+        )
+        import_data_sqlite(
+            self.file_name,
+            engine,
+            catalog=catalog,
+            previous_database=failed.url.database,
+        )
+        assert engine.execute("SELECT count(*) FROM product").scalar() == 2
+        assert engine.execute("SELECT count(*) FROM product_year").scalar() == 4
+        assert read_table_hashes(engine) == hashes
+
+
+class FakeClassification(object):
+    """Mimics the parts of a linnaeus classification that process_dataset
+    uses."""
+
+    def __init__(self, table, levels):
+        self.table = table
+        self.levels = levels
+
+    def level(self, level):
+        return self.table[self.table.level == level]
+
+    def aggregation_table(self, from_level, to_level):
+        parents = self.level(from_level)[["parent_id"]]
+        for _ in range(self.levels[from_level] - self.levels[to_level] - 1):
+            parents = parents.replace({"parent_id": self.table.parent_id.to_dict()})
+        return parents
+
+
+def make_ingestion_dataset():
+    import pandas as pd
+
+    products = FakeClassification(
+        pd.DataFrame(
+            {
+                "code": ["01", "02", "0101", "0102", "0201"],
+                "level": ["2digit", "2digit", "4digit", "4digit", "4digit"],
+                "parent_id": [None, None, 0, 0, 1],
+            }
+        ),
+        {"2digit": 0, "4digit": 1},
+    )
+    locations = FakeClassification(
+        pd.DataFrame(
+            {
+                "code": ["COL", "05", "08"],
+                "level": ["country", "department", "department"],
+                "parent_id": [None, 0, 0],
+            }
+        ),
+        {"country": 0, "department": 1},
+    )
+
+    rows = []
+    for year in [2007, 2008]:
+        for i, location in enumerate(["05", "08"]):
+            for j, product in enumerate([101, 102, 201]):
+                rows.append([location, product, year, 10.0 * i + j + year % 10])
+    raw = pd.DataFrame(rows, columns=["dept", "hs4", "yr", "value"])
+
+    return {
+        "read_function": lambda: raw.copy(),
+        "field_mapping": {
+            "dept": "location",
+            "hs4": "product",
+            "yr": "year",
+            "value": "export_value",
+        },
+        "classification_fields": {
+            "location": {"classification": locations, "level": "department"},
+            "product": {"classification": products, "level": "4digit"},
+        },
+        "digit_padding": {"product": 4},
+        "facet_fields": ["location", "product", "year"],
+        "facets": {
+            ("location_id", "year"): {"export_value": lambda x: x.sum()},
+            ("product_id", "year"): {"export_value": lambda x: x.sum()},
+            ("location_id", "product_id", "year"): {
+                "export_value": lambda x: x.first()
+            },
+        },
+        "classification_aggregations": {
+            "country_2digit": {
+                "facet": ("location_id", "product_id", "year"),
+                "agg_fields": {"location_id": "country", "product_id": "2digit"},
+                "agg_params": {"export_value": "sum"},
+            }
+        },
+    }
+
+
+class DataIngestionTest(BaseTestCase):
+    def setUp(self):
+        from .data_ingestion import process_dataset
+
+        self.process_dataset = process_dataset
+        self.expected = process_dataset(make_ingestion_dataset())
+
+    def assert_same_outputs(self, outputs):
+        import pandas.testing as pdt
+
+        for facet, facet_df in self.expected.items():
+            if facet == "classification_aggregations":
+                for clagg, clagg_df in facet_df.items():
+                    pdt.assert_frame_equal(
+                        outputs[facet][clagg].sort_index(), clagg_df.sort_index()
+                    )
+            else:
+                pdt.assert_frame_equal(outputs[facet], facet_df)
+
+    def test_process_dataset(self):
+        py = self.expected[("product_id", "year")]
+        assert py.loc[(2, 2007), "export_value"] == 0 + 10 + 2 * 7
+        country_2digit = self.expected["classification_aggregations"]["country_2digit"]
+        assert country_2digit.loc[(0, 0, 2008), "export_value"] == 8 + 9 + 18 + 19
+
+    def test_parallel_facets(self):
+        for executor in ["thread", "process"]:
+            outputs = self.process_dataset(
+                make_ingestion_dataset(), facet_executor=executor, facet_workers=2
+            )
+            self.assert_same_outputs(outputs)
+
+    def test_chunked(self):
+        dataset = make_ingestion_dataset()
+        dataset["facets"] = {
+            ("location_id", "year"): {"export_value": "sum"},
+            ("location_id", "product_id", "year"): {"export_value": "first"},
+            ("product_id", "year"): {"export_value": "max"},
+        }
+        expected = self.process_dataset(dataset)
+
+        read_function = dataset["read_function"]
+
+        def read_chunks():
+            raw = read_function()
+            for start in range(0, raw.shape[0], 5):
+                yield raw.iloc[start : start + 5]
+
+        dataset["read_function"] = read_chunks
+        outputs = self.process_dataset(dataset)
+
+        for facet in dataset["facets"]:
+            assert (
+                outputs[facet].reset_index().astype(float).values.tolist()
+                == expected[facet].reset_index().astype(float).values.tolist()
+            )
+
+        clagg = "country_2digit"
+        assert (
+            outputs["classification_aggregations"][clagg].sort_index().values.tolist()
+            == expected["classification_aggregations"][clagg]
+            .sort_index()
+            .values.tolist()
+        )
+
+        # Arbitrary functions can't be combined across chunks
+        dataset["facets"][("product_id", "year")] = {"export_value": lambda x: x.sum()}
+        with pytest.raises(ValueError):
+            self.process_dataset(dataset)
+
+    def test_cache(self):
+        from .ingestion_cache import IngestionCache
+
+        cache = IngestionCache(tempfile.mkdtemp())
+        dataset = make_ingestion_dataset()
+        self.assert_same_outputs(self.process_dataset(dataset, cache=cache))
+        assert len(os.listdir(cache.directory)) == 4
+
+        # Everything cached: the raw data doesn't get read if there's an
+        # input hash
+        dataset["input_hash"] = "raw_v1"
+        self.process_dataset(dataset, cache=cache)
+        files = set(os.listdir(cache.directory))
+        dataset["read_function"] = None
+        self.assert_same_outputs(self.process_dataset(dataset, cache=cache))
+
+        # Changing one facet only recomputes that facet
+        dataset["facets"][("product_id", "year")] = {"export_value": "max"}
+        outputs = self.process_dataset(dataset, cache=cache)
+        assert len(set(os.listdir(cache.directory)) - files) == 1
+        assert outputs[("product_id", "year")].loc[(2, 2007), "export_value"] == 17
+
+    def test_cache_chunked(self):
+        from .ingestion_cache import IngestionCache
+
+        dataset = make_ingestion_dataset()
+        dataset["facets"] = {
+            ("location_id", "year"): {"export_value": "sum"},
+            ("location_id", "product_id", "year"): {"export_value": "first"},
+            ("product_id", "year"): {"export_value": "max"},
+        }
+        expected = self.process_dataset(dataset)
+        read_function = dataset["read_function"]
+
+        def read_chunks():
+            raw = read_function()
+            for start in range(0, raw.shape[0], 5):
+                yield raw.iloc[start : start + 5]
+
+        # With an input hash, the reader only gets called once the cache
+        # misses, and still falls back to chunked processing
+        cache = IngestionCache(tempfile.mkdtemp())
+        dataset["read_function"] = read_chunks
+        dataset["input_hash"] = "raw_v1"
+        outputs = self.process_dataset(dataset, cache=cache, check_sample=0.5)
+        for facet in dataset["facets"]:
+            assert (
+                outputs[facet].reset_index().astype(float).values.tolist()
+                == expected[facet].reset_index().astype(float).values.tolist()
+            )
+        assert os.listdir(cache.directory) == []
+
+    def test_hash_object(self):
+        import functools
+        from .ingestion_cache import hash_object
+
+        def scale(x, factor=1):
+            return x * factor
+
+        assert hash_object(functools.partial(scale, factor=2)) == hash_object(
+            functools.partial(scale, factor=2)
+        )
+        assert hash_object(functools.partial(scale, factor=2)) != hash_object(
+            functools.partial(scale, factor=3)
+        )
+        with pytest.raises(TypeError):
+            hash_object({"hook": object()})
+
+    def test_low_memory(self):
+        from unittest import mock
+
+        import numpy as np
+        import pandas as pd
+        from . import data_ingestion
+
+        dataset = make_ingestion_dataset()
+        self.assert_same_outputs(self.process_dataset(dataset, low_memory=True))
+
+        # Codes and years become categoricals, other ints get downcast and
+        # floats are left alone
+        raw = data_ingestion.clean_columns(dataset["read_function"](), dataset)
+        raw["count"] = np.arange(raw.shape[0], dtype=np.int64)
+        shrunk = data_ingestion.shrink_dtypes(raw.copy(), dataset)
+        for column in ["location", "product", "year"]:
+            assert pd.api.types.is_categorical_dtype(shrunk[column])
+        assert shrunk["count"].dtype == np.int8
+        assert shrunk["export_value"].dtype == np.float64
+        assert shrunk.memory_usage(deep=True).sum() < raw.memory_usage(deep=True).sum()
+
+        with mock.patch.object(data_ingestion, "puts") as puts:
+            low = data_ingestion.prepare_dataset(
+                dataset["read_function"](), dataset, low_memory=True
+            )
+            messages = [call[0][0] for call in puts.call_args_list]
+        normal = data_ingestion.prepare_dataset(dataset["read_function"](), dataset)
+
+        for column in ["location", "product", "year"]:
+            assert pd.api.types.is_categorical_dtype(low[column])
+        assert normal["location"].dtype == object
+        low_bytes = low.memory_usage(deep=True).sum()
+        assert low_bytes < normal.memory_usage(deep=True).sum()
+
+        # Memory gets reported after each step, including the dataframe size
+        reports = [x for x in messages if x.startswith("Memory after")]
+        assert [x.split(":")[0] for x in reports] == [
+            "Memory after reading",
+            "Memory after checks",
+            "Memory after merging classifications",
+        ]
+        assert reports[-1].endswith(
+            "dataframe 12 x 6 is {}".format(data_ingestion.format_bytes(low_bytes))
+        )
+
+        current, peak = data_ingestion.memory_usage()
+        assert current > 0 and peak > 0
+        assert data_ingestion.format_bytes(1536) == "1.5KB"
+        assert data_ingestion.format_bytes(None) == "?"
+
+    def test_shared_rollups(self):
+        import pandas.testing as pdt
+
+        dataset = make_ingestion_dataset()
+        claggs = dataset["classification_aggregations"]
+        claggs["country_2digit_max"] = dict(
+            claggs["country_2digit"], agg_params={"export_value": "max"}
+        )
+        claggs["country"] = {
+            "facet": ("location_id", "product_id", "year"),
+            "agg_fields": {"location_id": "country"},
+            "agg_params": {"export_value": "sum"},
+        }
+        outputs = self.process_dataset(dataset)["classification_aggregations"]
+
+        pdt.assert_frame_equal(
+            outputs["country_2digit"],
+            self.expected["classification_aggregations"]["country_2digit"],
+        )
+        assert outputs["country_2digit_max"].loc[(0, 0, 2008), "export_value"] == 19
+        assert outputs["country"].loc[(0, 2, 2007), "export_value"] == 7 + 17
+
+    def test_hdf_writer(self):
+        import pandas as pd
+        from sqlalchemy import create_engine
+        from .data_import import import_data_sqlite
+        from .hdf_catalog import HDFCatalog
+        from .hdf_writer import HDFWriter, benchmark_hdf_settings
+
+        dataset = make_ingestion_dataset()
+        tmpdir = tempfile.mkdtemp()
+        file_name = os.path.join(tmpdir, "data.h5")
+
+        with HDFWriter(file_name, complib="zlib", complevel=1, chunksize=4) as writer:
+            writer.write_classification(
+                "product",
+                dataset["classification_fields"]["product"]["classification"].table,
+            )
+            keys = writer.write_dataset(
+                self.expected,
+                dataset,
+                {
+                    ("product_id", "year"): "product_year",
+                    "country_2digit": "country_product_year",
+                    ("location_id", "product_id", "year"): "country_product_year",
+                },
+            )
+            writer.write_data_info({"output_data_version": "v1"})
+
+            # Keys don't get silently replaced
+            with pytest.raises(ValueError):
+                writer.write_dataset(
+                    self.expected, dataset, {("product_id", "year"): "product_year"},
+                )
+            # Nor do outputs with the same table and levels overwrite each
+            # other
+            facet = ("location_id", "product_id", "year")
+            same_levels = dict(
+                dataset,
+                classification_aggregations={
+                    "copy": {"facet": facet, "agg_fields": {}},
+                },
+            )
+            with pytest.raises(ValueError, match="would both be written"):
+                writer.write_dataset(
+                    {
+                        facet: self.expected[facet],
+                        "classification_aggregations": {"copy": self.expected[facet]},
+                    },
+                    same_levels,
+                    {facet: "location_product_year", "copy": "location_product_year"},
+                )
+            assert "/location_product_year_department_4digit" not in writer.store
+
+        # Unless asked to, also in a file opened for appending
+        with HDFWriter(file_name, mode="a") as writer:
+            with pytest.raises(ValueError):
+                writer.write_classification("product", pd.DataFrame({"code": []}))
+            writer.write_dataset(
+                self.expected,
+                dataset,
+                {("product_id", "year"): "product_year"},
+                overwrite=True,
+            )
+
+        assert sorted(keys) == [
+            "/country_product_year_country_2digit",
+            "/country_product_year_department_4digit",
+            "/product_year_4digit",
+        ]
+
+        catalog = HDFCatalog.load(file_name)
+        assert catalog.data_version == "v1"
+        assert catalog.metadata("/country_product_year_country_2digit") == {
+            "sql_table_name": "country_product_year",
+            "levels": {"location": "country", "product": "2digit"},
+        }
+
+        engine = create_engine("sqlite:///" + os.path.join(tmpdir, "data.db"))
+        import_data_sqlite(file_name, engine, catalog=catalog)
+
+        assert engine.execute("SELECT count(*) FROM product").scalar() == 5
+        rows = engine.execute(
+            "SELECT product_level, location_level, count(*), sum(export_value) "
+            "FROM country_product_year GROUP BY 1, 2 ORDER BY 1"
+        ).fetchall()
+        total = self.expected[("location_id", "product_id", "year")].export_value.sum()
+        assert rows == [
+            ("2digit", "country", 4, total),
+            ("4digit", "department", 12, total),
+        ]
+
+        results = benchmark_hdf_settings(
+            self.expected[("location_id", "product_id", "year")].reset_index(),
+            settings=[
+                {"complib": None, "complevel": 0},
+                {"complib": "blosc", "complevel": 9},
+            ],
+            directory=tmpdir,
+            repeat=1,
+        )
+        assert results.shape[0] == 2
+        assert (
+            (results[["write_seconds", "read_seconds", "file_bytes"]] > 0).all().all()
+        )
+
+    def test_validate_dataset(self):
+        import numpy as np
+        import pandas as pd
+        from . import data_assertions as assertions
+
+        products = make_ingestion_dataset()["classification_fields"]["product"]
+        product_level = products["classification"].level("4digit")
+        df = pd.DataFrame(
+            {
+                "product": [101, 102, 201, 101, 102, 999],
+                "year": [2007, 2007, 2007, 2008, 2008, np.nan],
+            }
+        )
+
+        report = assertions.validate_dataset(
+            df,
+            ["product", "year"],
+            digit_padding={"product": 4},
+            classification_levels={"product": product_level},
+        )
+
+        assert report.missing == {"product": 0, "year": 1}
+        assert report.zeropadded == {"product": False}
+        assert report.rectangularized is False
+        assert report.num_duplicated == 0
+        assert len(report.failures()) == 4
+        with pytest.raises(AssertionError):
+            report.assert_passed()
+
+        padded = df.assign(product=df["product"].astype(str).str.zfill(4))
+        expected = assertions.matching_stats(padded["product"], product_level)
+        stats = report.matching["product"]
+        assert stats[:2] == expected[:2]
+        assert stats.codes_missing.tolist() == ["0999"]
+        assert stats.codes_unused.tolist() == expected.codes_unused.tolist() == []
+
+        df = pd.DataFrame({"product": ["0101", "0102"] * 2, "year": [2007] * 4})
+        report = assertions.validate_dataset(df, ["product", "year"])
+        assert report.duplicated.tolist() == [True] * 4
+        assert report.rectangularized is False
+        assert report.failures() == [
+            "Dataset is not rectangularized.",
+            "Dataset has 4 rows with duplicated entities.",
+        ]
+
+        report = assertions.validate_dataset(df.iloc[:2], ["product", "year"])
+        assert report.passed
+
+    def test_sparse_fillin(self):
+        import pandas as pd
+        import pandas.testing as pdt
+        from . import data_assertions as assertions
+
+        df = pd.DataFrame(
+            {
+                "location": ["05", "05", "08", "11"],
+                "product": ["0101", "0102", "0101", "0201"],
+                "year": [2007, 2008, 2008, 2007],
+                "export_value": [1.0, 2.0, 3.0, 4.0],
+            }
+        )
+        entities = ["location", "product", "year"]
+        filled = assertions.fillin(df, entities)
+
+        pdt.assert_frame_equal(pd.concat(assertions.iter_fillin(df, entities)), filled)
+        by_year = pd.concat(assertions.iter_fillin(df, entities, chunk_entity="year"))
+        pdt.assert_frame_equal(
+            by_year.reorder_levels(entities).sort_index(), filled.sort_index()
+        )
+
+        missing = assertions.missing_combinations(df, entities)
+        expected = filled[filled.export_value.isnull()].index.to_frame(index=False)
+        pdt.assert_frame_equal(missing, expected)
+
+        missing = assertions.missing_combinations(df, entities, chunk_entity="year")
+        assert missing.shape[0] == 3 * 3 * 2 - 4
+        assert missing.columns.tolist() == ["year", "location", "product"]
+
+        assert not assertions.is_rectangularized([3, 3, 2], df.shape[0])
+        assert assertions.is_rectangularized([3, 3, 2], filled.shape[0])
+        assert assertions.missing_combinations(filled.reset_index(), entities).empty
+
+    def test_check_sample(self):
+        import pandas as pd
+        from . import data_assertions as assertions
+
+        self.assert_same_outputs(
+            self.process_dataset(make_ingestion_dataset(), check_sample=0.5)
+        )
+
+        df = pd.DataFrame(
+            {
+                "product": ["0101", "0102", "9999", None] * 250,
+                "year": [2007] * 500 + [2008] * 500,
+            }
+        )
+        sample = assertions.stratified_sample(df, 0.1, strata=["year"])
+        assert sample.year.value_counts().tolist() == [50, 50]
+        assert sample.index.equals(
+            assertions.stratified_sample(df, 0.1, strata=["year"]).index
+        )
+        assert sample.index.is_monotonic_increasing
+        assert len(assertions.stratified_sample(df, 0.1)) == 100
+
+        # Tiny strata still get a row
+        tiny = pd.concat([df, pd.DataFrame({"product": ["0101"], "year": [2009]})])
+        tiny_sample = assertions.stratified_sample(tiny, 0.1, strata=["year"])
+        assert tiny_sample.year.value_counts().sort_index().tolist() == [50, 50, 1]
+
+        products = make_ingestion_dataset()["classification_fields"]["product"]
+        report = assertions.validate_dataset(
+            df,
+            ["product", "year"],
+            classification_levels={
+                "product": products["classification"].level("4digit")
+            },
+            sample_fraction=0.1,
+            strata=["year"],
+        )
+        assert report.sampled and report.num_checked_rows == 100
+        assert report.rectangularized is None
+
+        stats = report.matching["product"]
+        estimate = stats.percent_rows_not_in_classification
+        assert (
+            estimate
+            == 100.0
+            * (sample["product"].isin(["9999"]) | sample["product"].isnull()).mean()
+        )
+        low, high = report.bounds[("nonmatching", "product")]
+        assert 0 < low < estimate < high < 100
+
+        low, high = report.bounds[("missing", "product")]
+        assert low < 100.0 * report.missing["product"] / 100 < high
+
+        assert assertions.proportion_bounds(5, 10, population_size=10) == (50, 50)
+        low, high = assertions.proportion_bounds(5, 10)
+        assert 20 < low < 50 < high < 80
+
+    def test_code_to_id_mapper(self):
+        import numpy as np
+        import pandas as pd
+        from . import data_assertions as assertions
+        import warnings
+
+        from .data_ingestion import (
+            CodeToIdMapper,
+            code_to_id_mapper,
+            merge_classifications,
+            merge_ids_from_codes,
+        )
+
+        products = make_ingestion_dataset()["classification_fields"]["product"]
+        classification = products["classification"]
+        product_level = classification.level("4digit")
+        series = pd.Series(["0201", "0101", "9999", np.nan, "0201"])
+
+        for values in [series, series.astype("category")]:
+            ids, stats = CodeToIdMapper(product_level).map(values)
+            assert ids.categories.tolist() == [2, 3, 4]
+            assert list(ids[[0, 1, 4]]) == [4, 2, 4]
+            assert pd.isnull(ids[2]) and pd.isnull(ids[3])
+
+            expected = assertions.matching_stats(series, product_level)
+            assert stats[:2] == expected[:2]
+            assert stats.codes_missing.tolist()[0] == "9999"
+            assert stats.codes_unused.tolist() == expected.codes_unused.tolist()
+
+        mapper = code_to_id_mapper(classification, "4digit")
+        assert mapper is code_to_id_mapper(classification, "4digit")
+
+        # Rebuilt when the classification changes
+        classification.table.loc[3, "code"] = "0103"
+        changed = code_to_id_mapper(classification, "4digit")
+        assert changed is not mapper
+        assert changed.positions(np.array(["0103"], dtype=object)).tolist() == [1]
+        classification.table.loc[3, "code"] = "0102"
+
+        # Doesn't touch the input
+        df = pd.DataFrame({"code": series})
+        merged = merge_ids_from_codes(df, "code", product_level, "product_id")
+        assert df.columns.tolist() == ["code"]
+        assert merged.columns.tolist() == ["code", "product_id"]
+        assert merged.product_id.iloc[0] == 4
+        assert mapper.positions(np.array([101, "0102"], dtype=object)).tolist() == [
+            -1,
+            1,
+        ]
+
+        # Dropping nonmatching rows doesn't leave a view to assign ids into
+        dataset = make_ingestion_dataset()
+        df = pd.DataFrame(
+            {
+                "location": ["05", "05", "08"],
+                "product": ["0201", "9999", "0101"],
+                "year": [2007] * 3,
+            }
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", pd.core.common.SettingWithCopyWarning)
+            merged = merge_classifications(df, dataset)
+        assert merged.product_id.tolist() == [4, 2]
+
+
+class NetworkTest(BaseTestCase):
+    def setUp(self):
+        import pandas as pd
+
+        self.nodes = pd.DataFrame({"id": [1, 2, 3, 4, 5, 9], "x": [0.0] * 6})
+        self.edges = pd.DataFrame(
+            {
+                "source": [1, 2, 3, 1, 4, 5],
+                "target": [2, 3, 1, 4, 4, 1],
+                "strength": [0.5, 0.25, None, 1.0, 0.1, 0.2],
+            }
+        )
+
+    def test_network_index(self):
+        from .helpers.network import NetworkIndex, find_neighbors, write_network
+
+        file_name = os.path.join(tempfile.mkdtemp(), "network.json")
+        write_network(file_name, self.nodes, self.edges, {"name": "test"})
+        index = NetworkIndex.from_file(file_name)
+
+        for node_id in [1, 2, 3, 4, 5, 9]:
+            assert index.neighbors(node_id, ["strength"]) == find_neighbors(
+                self.nodes, self.edges, node_id, ["strength"]
+            )
+            assert index.degree(node_id) == len(
+                find_neighbors(self.nodes, self.edges, node_id)
+            )
+
+        assert index.neighbor_ids(1).tolist() == [2, 3, 4, 5]
+        assert index.neighbors(3, ["strength"])[1] == {"id": 1, "strength": None}
+        assert index.degree(4) == 2
+        assert index.degree(9) == 0 and 9 in index
+        assert index.degree(100) == 0 and 100 not in index
+
+        assert index.k_hop(5, 1).tolist() == [1]
+        assert index.k_hop(5, 2).tolist() == [1, 2, 3, 4]
+        assert index.k_hop(9, 3).tolist() == []
+
+        # Rows in the nodes dataframe, skipping ids that aren't nodes
+        assert index.node_frame_rows([9, 1, 100, 1]).tolist() == [0, 5]
+        partial = NetworkIndex(self.nodes.iloc[1:], self.edges)
+        assert partial.node_frame_rows([1, 2, 9]).tolist() == [0, 4]
+
+    def test_network_apis(self):
+        import gzip
+        from .helpers.network import write_network
+        from .network import register_network_apis
+
+        file_name = os.path.join(tempfile.mkdtemp(), "network.json")
+        write_network(file_name, self.nodes, self.edges, {"name": "test"})
+
+        app = create_app({"TESTING": True})
+        app = register_network_apis(app, {"product_space": file_name})
+        client = app.test_client()
+
+        response = client.get("/networks/product_space/")
+        assert response.status_code == 200
+        assert response.json["data"]["name"] == "test"
+        assert len(response.json["data"]["edges"]) == 6
+        etag = response.headers["ETag"]
+
+        response = client.get(
+            "/networks/product_space/", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+
+        response = client.get(
+            "/networks/product_space/", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["ETag"] != etag
+        network = json.loads(gzip.decompress(response.get_data()).decode("utf-8"))
+        assert network["data"]["nodes"][0] == {"id": 1, "x": 0.0}
+
+        response = client.get("/networks/product_space/3/neighbors")
+        assert response.json["data"] == [
+            {"id": 2, "strength": 0.25},
+            {"id": 1, "strength": None},
+        ]
+        response = client.get("/networks/product_space/100/neighbors")
+        assert response.status_code == 404
+        response = client.get("/networks/product_space/3/neighbors?fields=bogus")
+        assert response.status_code == 400
+
+        response = client.get(
+            "/networks/product_space/subgraph?nodes=9,1,4,100&fields=strength"
+        )
+        assert [x["id"] for x in response.json["data"]["nodes"]] == [1, 4, 9]
+        assert response.json["data"]["edges"] == [
+            {"source": 1, "target": 4, "strength": 1.0},
+            {"source": 4, "target": 4, "strength": 0.1},
+        ]
+
+    def test_remap_network_ids(self):
+        import numpy as np
+        import pandas as pd
+        import pandas.testing as pdt
+        from .helpers.network import remap_network_ids
+
+        for old_ids in [[1, 2, 3, 4, 5], [10 ** 12 + x for x in range(1, 6)]]:
+            offset = old_ids[0] - 1
+            nodes = self.nodes.assign(id=self.nodes.id + offset)
+            edges = self.edges.assign(
+                source=self.edges.source + offset, target=self.edges.target + offset
+            )
+            mapping = pd.DataFrame({"new": [10, 20, 30, 40, 50]}, index=old_ids)
+
+            new_nodes, new_edges, unmapped = remap_network_ids(
+                nodes, edges, mapping, return_unmapped=True
+            )
+
+            assert new_nodes.columns.tolist() == ["id", "x"]
+            assert new_nodes.id.tolist()[:5] == [10, 20, 30, 40, 50]
+            assert np.isnan(new_nodes.id.iloc[5])
+            pdt.assert_series_equal(
+                new_edges.source, (self.edges.source * 10).rename("source")
+            )
+            assert new_edges.target.tolist() == [20, 30, 10, 40, 40, 10]
+            assert new_edges.target.dtype == np.int64
+            assert unmapped["id"].tolist() == [9 + offset]
+            assert len(unmapped["source"]) == len(unmapped["target"]) == 0
+
+            # Inputs are left alone
+            assert nodes.id.tolist() == [x + offset for x in [1, 2, 3, 4, 5, 9]]
+
+            # An old id can't map to two new ones
+            duplicated = pd.DataFrame(
+                {"new": [10, 20, 30]}, index=old_ids[:2] + [old_ids[0]]
+            )
+            with pytest.raises(ValueError):
+                remap_network_ids(nodes, edges, duplicated)
+
+    def test_streaming_json(self):
+        import io
+        import pandas.testing as pdt
+        from .helpers import json_helpers as j
+        from .helpers.network import read_network, write_network
+
+        file_name = os.path.join(tempfile.mkdtemp(), "network.json")
+        write_network(
+            file_name,
+            self.nodes,
+            self.edges,
+            {"name": "test", "meta": [1, 2]},
+            chunksize=4,
+        )
+
+        nodes, edges, other_fields = read_network(file_name)
+        pdt.assert_frame_equal(edges, self.edges)
+        for chunksize in [1, 4, 100]:
+            chunked = read_network(file_name, chunksize=chunksize)
+            pdt.assert_frame_equal(chunked[0], nodes)
+            pdt.assert_frame_equal(chunked[1], edges)
+            assert chunked[2] == other_fields == {"name": "test", "meta": [1, 2]}
+
+        records = list(j.iter_json_records(file_name, "edges"))
+        assert records == j.json_read(file_name)["edges"]
+
+        document = j.json_read(file_name)
+        j.add_preamble_streaming(file_name, buffer_size=5)
+        assert j.json_read(file_name) == {"data": document}
+        j.strip_preamble_streaming(file_name)
+        assert j.json_read(file_name) == document
+        with pytest.raises(KeyError):
+            j.strip_preamble_streaming(file_name, key="bogus")
+        assert j.json_read(file_name) == document
+        assert not os.path.exists(file_name + ".tmp")
+        # The original error, not one from cleaning up the tmp file
+        with pytest.raises(FileNotFoundError) as error:
+            j.strip_preamble_streaming(file_name + ".missing")
+        assert error.value.filename == file_name + ".missing"
+
+        # Values split across buffer boundaries
+        text = '{"a": [12345, -1.5e10, "x\\"y", true, null], "b": {"c": {}}}'
+        out = io.StringIO()
+        j.JSONStreamReader(io.StringIO(text), buffer_size=3).copy(out)
+        assert json.loads(out.getvalue()) == json.loads(text)
+
+        # Numbers and literals split at every possible point
+        text = "[1.25, -3.5e+10, 7, true, null, 0]"
+        records_file_name = os.path.join(tempfile.mkdtemp(), "records.json")
+        with open(records_file_name, "w") as f:
+            f.write('{"records": ' + text + "}")
+        for buffer_size in range(1, 20):
+            reader = j.JSONStreamReader(io.StringIO(text), buffer_size=buffer_size)
+            assert [reader.decode() for _ in reader.iter_array()] == json.loads(text)
+            records = j.iter_json_records(
+                records_file_name, "records", buffer_size=buffer_size
+            )
+            assert list(records) == json.loads(text)
+
+    def test_binary_network(self):
+        import numpy as np
+        import pandas.testing as pdt
+        from .helpers import json_helpers as j
+        from .helpers import network_binary as nb
+        from .helpers.network import NetworkIndex, read_network, write_network
+
+        tmpdir = tempfile.mkdtemp()
+        json_file_name = os.path.join(tmpdir, "network.json")
+        binary_directory = os.path.join(tmpdir, "network")
+
+        nodes = self.nodes.assign(
+            name=["a", "b", None, "d", "e", "f"], tags=[[1], [], None, [2], [3], [4]]
+        )
+        edges = self.edges.assign(kind=["x", "y", "x", "y", "x", "y"])
+        write_network(json_file_name, nodes, edges, {"name": "test"})
+
+        nb.json_to_binary(json_file_name, binary_directory)
+        nodes, edges, other_fields = read_network(json_file_name)
+        binary = nb.read_network_binary(binary_directory)
+        pdt.assert_frame_equal(binary[0], nodes)
+        pdt.assert_frame_equal(binary[1], edges)
+        assert binary[2] == other_fields
+
+        roundtrip_file_name = os.path.join(tmpdir, "roundtrip.json")
+        nb.binary_to_json(binary_directory, roundtrip_file_name)
+        assert j.json_read(roundtrip_file_name) == j.json_read(json_file_name)
+
+        index = nb.load_network_index_binary(binary_directory)
+        json_index = NetworkIndex(nodes, edges)
+        assert isinstance(index.indptr, np.memmap)
+        for node_id in [1, 3, 4, 9]:
+            assert index.neighbors(
+                node_id, ["strength", "kind"]
+            ) == json_index.neighbors(node_id, ["strength", "kind"])
+        assert index.k_hop(5, 2).tolist() == [1, 2, 3, 4]
+        assert index.node_frame_rows([9, 1]).tolist() == [0, 5]
+
+        timings = nb.benchmark_network_load(json_file_name, binary_directory, repeat=1)
+        assert sorted(timings) == ["binary", "binary_index", "json", "json_index"]
+
+
+class DictIndexTest(BaseTestCase):
+    def test_same_as_find_dict_in_list(self):
+        from .helpers.python import DictIndex, find_dict_in_list
+
+        l = [
+            {"a": 2, "b": 5, "c": [1]},
+            {"a": 3, "b": 5, "c": [2]},
+            {"a": 3, "b": 6, "c": [2]},
+        ]
+        index = DictIndex(l)
+
+        queries = [
+            dict(a=3),
+            dict(b=7),
+            dict(a=3, b=6),
+            dict(b=5, a=2),
+            dict(c=[2], a=3),
+            dict(c=[3]),
+            dict(),
+        ]
+        for query in queries:
+            for exact_match in [True, False]:
+                try:
+                    expected = find_dict_in_list(l, exact_match=exact_match, **query)
+                except ValueError as exc:
+                    with pytest.raises(ValueError) as excinfo:
+                        index.find(exact_match=exact_match, **query)
+                    assert excinfo.value.args == exc.args
+                else:
+                    assert index.find(exact_match=exact_match, **query) == expected
+
+        assert ("a", "b") in index.indexes
+        assert index.indexes[("a", "c")] is None
+
+        with pytest.raises(KeyError):
+            DictIndex(l).find(d=1)
+
+
+class SamplingProfilerTest(BaseTestCase):
+    def setUp(self):
+        import time
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite://",
+                "PROFILE_SAMPLE_RATE": 0,
+                "PROFILE_SLOW_THRESHOLD": 0.05,
+                "PROFILE_SAMPLE_INTERVAL": 0.001,
+                "PROFILE_DIR": self.tmpdir,
+                "TESTING": True,
+            }
+        )
+
+        def slow_view():
+            time.sleep(0.1)
+            return "slow"
+
+        def fast_view():
+            return "fast"
+
+        self.app.add_url_rule("/slow", "slow", slow_view)
+        self.app.add_url_rule("/fast", "fast", fast_view)
+
+        from .profiling import register_profiler_endpoint
+
+        self.app = register_profiler_endpoint(self.app)
+        self.profiler = self.app.extensions["sampling_profiler"]
+        self.test_client = self.app.test_client()
+
+    def test_slow_requests(self):
+        assert self.test_client.get("/fast").status_code == 200
+        assert self.test_client.get("/slow").status_code == 200
+        assert self.profiler.num_requests == {"slow": 1}
+
+        response = self.test_client.get("/admin/profile")
+        lines = response.get_data(as_text=True).splitlines()
+        assert len(lines) > 0
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert stack.startswith("slow;")
+            assert int(count) > 0
+        assert any("slow_view" in line for line in lines)
+
+        response = self.test_client.get("/admin/profile?endpoint=fast")
+        assert response.get_data(as_text=True) == ""
+
+        self.profiler.dump()
+        file_name = os.path.join(
+            self.tmpdir, "profile-{}.collapsed".format(os.getpid())
+        )
+        with open(file_name) as f:
+            assert f.read() == self.profiler.collapsed()
+
+        assert self.test_client.delete("/admin/profile").status_code == 204
+        assert self.profiler.collapsed() == ""
+
+    def test_sample_rate(self):
+        self.profiler.slow_threshold = None
+        self.profiler.sample_rate = 1
+        assert self.test_client.get("/fast").status_code == 200
+        assert self.profiler.num_requests == {"fast": 1}
+
+    def test_concurrent_dumps(self):
+        import threading
+
+        assert self.test_client.get("/slow").status_code == 200
+        errors = []
+
+        def dump():
+            try:
+                for _ in range(50):
+                    self.profiler.dump()
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=dump) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert os.listdir(self.tmpdir) == ["profile-{}.collapsed".format(os.getpid())]
+
+
+class StartupTest(BaseTestCase):
+    #: Seconds for import atlas_core plus create_app(), generous enough for CI
+    STARTUP_BUDGET = 3.0
+
+    def test_startup(self):
+        from .profiling import measure_startup
+
+        timings = measure_startup({"SQLALCHEMY_DATABASE_URI": "sqlite://"}, repeat=2)
+        assert timings["heavy_modules"] == []
+        assert (
+            timings["import_seconds"] + timings["create_app_seconds"]
+            < self.STARTUP_BUDGET
+        )
+
+
+class PoolStatsTest(BaseTestCase):
+    def setUp(self):
+        from sqlalchemy.pool import QueuePool
+
+        from .pool import register_pool_stats_endpoint
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                + os.path.join(self.tmpdir, "pool.db"),
+                "SQLALCHEMY_ENGINE_OPTIONS": {"poolclass": QueuePool},
+                "DB_POOL_SIZE": 2,
+                "DB_MAX_OVERFLOW": 1,
+                "DB_POOL_TIMEOUT": 0.1,
+                "DB_WARMUP_CONNECTIONS": 2,
+                "DB_POOL_STATS": True,
+                "TESTING": True,
+            }
+        )
+        self.app = register_pool_stats_endpoint(self.app)
+        self.test_client = self.app.test_client()
+
+    def test_pool_stats(self):
+        from sqlalchemy.exc import TimeoutError
+
+        from .pool import get_pool_stats
+
+        with self.app.app_context():
+            engine = db.get_engine()
+
+        # Warmed up on the first request, not in create_app()
+        assert get_pool_stats(engine) is None
+        assert self.test_client.get("/admin/pool").status_code == 200
+        stats = get_pool_stats(engine)
+        assert stats["pool_class"] == "QueuePool"
+        assert stats["size"] == 2
+        assert stats["connects"] == 2
+        assert stats["connections"] == 2
+        assert stats["checked_in"] == 2
+        assert stats["checked_out"] == 0
+
+        connections = [engine.connect() for _ in range(3)]
+        stats = get_pool_stats(engine)
+        assert stats["checked_out"] == 3
+        assert stats["overflow"] == 1
+        assert stats["connects"] == 3
+        assert stats["timeouts"] == 0
+
+        with pytest.raises(TimeoutError):
+            engine.connect()
+        stats = get_pool_stats(engine)
+        assert stats["timeouts"] == 1
+        assert stats["wait_seconds_max"] >= 0.1
+        assert stats["connection_age_max"] >= stats["connection_age_mean"] > 0
+
+        for conn in connections:
+            conn.close()
+
+        # Overflow connection gets closed on checkin
+        response = self.test_client.get("/admin/pool")
+        assert response.status_code == 200
+        assert response.json["data"]["checked_out"] == 0
+        assert response.json["data"]["connections"] == 2
+
+        # Still tracked after the engine recreates its pool
+        engine.dispose()
+        engine.connect().close()
+        stats = get_pool_stats(engine)
+        assert stats["connections"] == 1
+
+    def test_warmup_failure(self):
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+                + os.path.join(self.tmpdir, "missing", "pool.db"),
+                "DB_WARMUP_CONNECTIONS": 2,
+                "TESTING": True,
+            }
+        )
+        app.add_url_rule("/hello", endpoint="hello", view_func=lambda: "hello")
+        test_client = app.test_client()
+
+        # Routes that don't need the database still work, and warmup isn't
+        # retried on every request
+        warmup = app.extensions["pool_warmup"]
+        assert test_client.get("/hello").status_code == 200
+        assert warmup._pid == os.getpid()
+        assert test_client.get("/hello").status_code == 200
+
+        # Nothing gets set up by default
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True})
+        assert "pool_warmup" not in app.extensions
+
+    def test_engine_collected(self):
+        import gc
+        import weakref
+
+        from sqlalchemy import create_engine
+
+        from .pool import _pool_stats, watch_pool
+
+        engine = create_engine("sqlite://")
+        watch_pool(engine)
+        engine_ref = weakref.ref(engine)
+        del engine
+        gc.collect()
+        assert engine_ref() is None
+        assert len([x for x in _pool_stats.values() if x.engine is None]) == 0
+
+
+class MetricsTest(BaseTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app(
+            {"METRICS": True, "METRICS_DIR": self.tmpdir, "TESTING": True}
+        )
+        self.app = register_endpoints(self.app, entities, datasets, endpoints)
+        self.test_client = self.app.test_client()
+
+    def test_metrics(self):
+        for _ in range(2):
+            response = self.test_client.get(
+                "/data/product/23/exporters/?level=department"
+            )
+            assert response.status_code == 200
+        response = self.test_client.get("/data/product/?level=nonexistent")
+        assert response.status_code == 400
+
+        # Another worker process
+        other_worker = dict(
+            counters=[["atlas_api_errors_total", [["status_code", 400]], 3]],
+            histograms=[
+                [
+                    "atlas_request_duration_seconds",
+                    [["endpoint", "product_exporters"]],
+                    [1] + [0] * 11,
+                    0.001,
+                ]
+            ],
+        )
+        with open(os.path.join(self.tmpdir, "metrics-1.json"), "w") as f:
+            f.write(json.dumps(other_worker))
+
+        response = self.test_client.get("/metrics")
+        assert response.status_code == 200
+        lines = response.get_data(as_text=True).splitlines()
+
+        assert 'atlas_api_errors_total{status_code="400"} 4' in lines
+        assert 'atlas_serializer_requests_total{serializer="json"} 3' in lines
+        assert (
+            'atlas_request_duration_seconds_count{endpoint="product_exporters"} 3'
+            in lines
+        )
+        assert (
+            'atlas_request_duration_seconds_bucket{endpoint="product_exporters",'
+            'le="+Inf"} 3' in lines
+        )
+        assert (
+            'atlas_response_size_bytes_count{endpoint="product_exporters"} 2' in lines
+        )
+        assert 'atlas_request_db_seconds_count{endpoint="product_exporters"} 2' in lines
+        assert any(
+            line.startswith('atlas_classification_cache_hits_total{method="get_all"}')
+            for line in lines
+        )
+
+        assert os.path.exists(
+            os.path.join(self.tmpdir, "metrics-{}.json".format(os.getpid()))
+        )
+
+    def test_labels_and_errors(self):
+        def broken():
+            raise KeyError("broken")
+
+        self.app.add_url_rule("/broken", endpoint="broken", view_func=broken)
+        self.app.config["PROPAGATE_EXCEPTIONS"] = False
+
+        assert self.test_client.get("/broken").status_code == 500
+        assert self.test_client.get("/nonexistent").status_code == 404
+        for serializer in ["json", "not-a-serializer", "json"]:
+            self.test_client.get("/data/product/?level=4digit&serializer=" + serializer)
+        self.test_client.get("/metrics")
+
+        # Only requests that serialized something count towards serializers
+        lines = self.test_client.get("/metrics").get_data(as_text=True).splitlines()
+        assert 'atlas_request_duration_seconds_count{endpoint="broken"} 1' in lines
+        assert 'atlas_request_duration_seconds_count{endpoint="metrics"} 1' in lines
+        assert 'atlas_serializer_requests_total{serializer="json"} 2' in lines
+        assert 'atlas_serializer_requests_total{serializer="invalid"} 1' in lines
+        assert not any("not-a-serializer" in line for line in lines)
@@ -7,3 +7,26 @@ PROFILE = False
 PROFILE_DIR = None
 
 LANGUAGES = {"en": "English"}
+
+# Sampled profiling, e.g. 0.01 to profile 1% of requests and / or 1.0 to
+# profile requests that take longer than a second
+PROFILE_SAMPLE_RATE = None
+PROFILE_SLOW_THRESHOLD = None
+
+# Connection pool settings, passed on to create_engine() when set. Also see
+# SQLALCHEMY_ENGINE_OPTIONS.
+DB_POOL_SIZE = None
+DB_MAX_OVERFLOW = None
+DB_POOL_TIMEOUT = None
+DB_POOL_RECYCLE = None
+DB_POOL_PRE_PING = None
+# Connections to open in each worker process before its first request
+DB_WARMUP_CONNECTIONS = 0
+# Collect connection pool statistics, see register_pool_stats_endpoint()
+DB_POOL_STATS = False
+
+# Prometheus metrics at METRICS_URL. With several worker processes, point
+# METRICS_DIR to a directory they share and clear it when restarting.
+METRICS = False
+METRICS_DIR = None
+METRICS_URL = "/metrics"